@@ -1,7 +1,9 @@
 import logging
 import asyncio
+import functools
 import pytz
-from datetime import time
+from apscheduler.events import EVENT_JOB_MISSED
+from datetime import datetime, time, timedelta
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (
     ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, 
@@ -10,6 +12,10 @@ from telegram.ext import (
 import config
 import database
 import keyboards
+import metrics
+import outbox
+import render
+from update_processor import PerUserUpdateProcessor
 import utils
 import scheduler
 
@@ -62,518 +68,559 @@ async def show_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(text, parse_mode='Markdown')
 
-async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    if not query:
+def _format_ms(value):
+    return "-" if value is None else f"{value / 1000:.1f}s" if value >= 1000 else f"{value:.0f}ms"
+
+async def perf(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin only: reminder latency percentiles and scheduler health"""
+    if update.effective_user.id not in config.ADMIN_IDS:
         return
+    snapshot = metrics.snapshot()
+    counters, gauges = snapshot['counters'], snapshot['gauges']
     
-    # Always answer the callback query first to prevent "loading" state
-    try:
-        await query.answer()
-    except Exception as e:
-        logger.error(f"Error answering callback query: {e}", exc_info=True)
+    text = "📈 Performance\n"
+    for title, prefix in (("Fire time → job ran", "reminders.fire_lag_ms"),
+                          ("Fire time → Telegram ack", "reminders.delivery_ms")):
+        text += f"\n{title} (p50 / p90 / p99 / max):\n"
+        for reminder_type, _ in scheduler.REMINDER_OFFSETS:
+            stats = metrics.summary(f"{prefix}.{reminder_type}")
+            text += (f"  {reminder_type}: {_format_ms(stats['p50'])} / {_format_ms(stats['p90'])} / "
+                     f"{_format_ms(stats['p99'])} / {_format_ms(stats['max'])} (n={stats['count']})\n")
+    text += (f"\nReminders queued: {counters.get('reminders.queued', 0)}, "
+             f"expired: {counters.get('reminders.expired', 0)}, "
+             f"suppressed by settings: {counters.get('reminders.suppressed', 0)}\n")
+    text += f"Missed job runs: {counters.get('jobs.missed', 0)}\n"
+    text += (f"Outbox depth: {gauges.get('outbox.depth', 0)}, sent: {counters.get('outbox.sent', 0)}, "
+             f"dropped: {counters.get('outbox.dropped', 0)}")
+    text += (f"\nUpdates in flight: {gauges.get('updates.in_flight', 0)}, "
+             f"waiting: {gauges.get('updates.waiting', 0)}")
+    text += (f"\nMessage edits: {counters.get('render.edits', 0)}, "
+             f"skipped as unchanged: {counters.get('render.edits_skipped', 0)}")
+    cache_hits = counters.get('timeline_cache.hits', 0) + counters.get('profile_cache.hits', 0)
+    cache_misses = counters.get('timeline_cache.misses', 0) + counters.get('profile_cache.misses', 0)
+    text += (f"\nCache hits: {cache_hits}, misses: {cache_misses}, "
+             f"evictions: {counters.get('cache.evictions', 0)} "
+             f"({gauges.get('cache.entries', 0)} entries, {gauges.get('cache.bytes', 0) // 1024} KB)")
     
-    try:
-        log_user_action(update, f"Menu action: {query.data}")
+    menu_actions = sorted(name for name in snapshot['histograms'] if name.startswith("menu."))
+    if menu_actions:
+        text += "\n\nMenu actions (p50 / p99, calls, errors):\n"
+        for name in menu_actions:
+            action = name[len("menu."):-len("_ms")]
+            stats = snapshot['histograms'][name]
+            text += (f"  {action}: {_format_ms(stats['p50'])} / {_format_ms(stats['p99'])}, "
+                     f"{stats['count']}, {counters.get(f'menu.{action}.errors', 0)}\n")
+    
+    await update.message.reply_text(text)
+
+def _traced(action):
+    """Count calls and errors of a callback handler and time it as menu.<action>_ms"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            metrics.inc(f"menu.{action}.calls")
+            try:
+                with metrics.timer(f"menu.{action}_ms"):
+                    return await handler(*args, **kwargs)
+            except Exception:
+                metrics.inc(f"menu.{action}.errors")
+                raise
+        return wrapper
+    return decorator
+
+@_traced("back_to_menu")
+async def _menu_back_to_menu(query, today_str, now):
+    await render.edit_message(
+        query,
+        "🏠 **Main Menu**", 
+        parse_mode='Markdown',
+        reply_markup=keyboards.main_menu_keyboard()
+    )
+
+async def _load_day_snapshot(user_id, today_str, now):
+    """Today's snapshot, generating today's tasks from the recurring schedule first if needed"""
+    current_time_str = now.strftime("%H:%M")
+    snapshot = await database.get_day_snapshot(user_id, today_str, current_time_str)
+    if snapshot['needs_generation']:
+        count = await database.generate_daily_tasks_from_recurring(user_id, now)
+        if count > 0:
+            snapshot = await database.get_day_snapshot(user_id, today_str, current_time_str)
+            # Schedule notifications for new tasks
+            for t in snapshot['tasks']:
+                t_time = datetime.strptime(t['scheduled_time'], "%H:%M").time()
+                await scheduler.schedule_task_notifications(
+                    user_id, t['id'], t['task_name'], t_time, t['date']
+                )
+    return snapshot
+
+@_traced("what_now")
+async def _menu_what_now(query, today_str, now):
+    snapshot = await _load_day_snapshot(query.from_user.id, today_str, now)
+    
+    # "What now?" should ONLY show what you should be doing RIGHT NOW
+    if snapshot['current'] is None:
+        logger.info(f"Debug - Current time: {now.strftime('%H:%M')}, {len(snapshot['tasks'])} tasks, "
+                    f"{len(snapshot['missed'])} missed")
+        text = "✅ No current task right now. Check 'What's next?' for upcoming tasks."
+    else:
+        current_task = snapshot['tasks'][snapshot['current']]
+        task_name = current_task['task_name']
+        # How long the task should have been running; both times are local wall-clock time
+        task_datetime = datetime.strptime(f"{today_str} {current_task['scheduled_time']}", "%Y-%m-%d %H:%M")
+        duration_seconds = int((now.replace(tzinfo=None) - task_datetime).total_seconds())
         
-        if query.data == 'back_to_menu':
-            await query.edit_message_text(
-                "🏠 **Main Menu**", 
-                parse_mode='Markdown',
-                reply_markup=keyboards.main_menu_keyboard()
-            )
-            return
+        # Format duration
+        hours = duration_seconds // 3600
+        minutes = (duration_seconds % 3600) // 60
+        
+        if hours >= 1:
+            if minutes > 0:
+                duration_text = f" for {hours} hour{'s' if hours > 1 else ''} and {minutes} minute{'s' if minutes > 1 else ''}"
+            else:
+                duration_text = f" for {hours} hour{'s' if hours > 1 else ''}"
+        else:
+            duration_text = f" for {minutes} minute{'s' if minutes > 1 else ''}"
+        
+        # Check if it's a commute task
+        is_commute = 'Commute' in task_name or '🚶' in task_name or '🚕' in task_name or '🚌' in task_name
+        
+        if is_commute:
+            if 'Home' in task_name:
+                text = f"🔥 You should be {task_name.replace('🚶 ', '').replace('🚕 ', '').replace('🚌 ', '')}{duration_text}. Stay safe!"
+            else:
+                text = f"🔥 You should be {task_name.replace('🚶 ', '').replace('🚕 ', '').replace('🚌 ', '')}{duration_text}."
+        else:
+            text = f"🔥 You should be doing: {task_name}{duration_text}"
+    
+    await render.edit_message(
+        query,
+        text=text,
+        parse_mode='Markdown',
+        reply_markup=keyboards.what_now_submenu_keyboard()
+    )
 
-        today_str = utils.get_today_str()
+@_traced("whats_next")
+async def _menu_whats_next(query, today_str, now):
+    try:
+        snapshot = await _load_day_snapshot(query.from_user.id, today_str, now)
         
-        if query.data == 'what_now':
-            from datetime import datetime
-            import pytz
-            # TIMEZONE is now a timezone object, not a string
-            tz = config.TIMEZONE
-            # Get UTC time first, then convert to target timezone to avoid system timezone issues
-            now = datetime.now(pytz.utc).astimezone(tz)
-            current_time_str = now.strftime("%H:%M")
-            
-            # Auto-generate tasks if none exist
-            tasks = await database.get_tasks(query.from_user.id, today_str)
-            if not tasks:
-                count = await database.generate_daily_tasks_from_recurring(query.from_user.id, now)
-                if count > 0:
-                    # Schedule notifications for new tasks
-                    tasks = await database.get_tasks(query.from_user.id, today_str)
-                    for t in tasks:
-                        t_time = datetime.strptime(t['scheduled_time'], "%H:%M").time()
-                        scheduler.schedule_task_notifications(
-                            context.job_queue, query.from_user.id, t['task_name'], t_time, t['date']
-                        )
+        if snapshot['next'] is not None:
+            next_task = snapshot['tasks'][snapshot['next']]
+            prio_icon = "🔴" if next_task['priority'] == 'High' else "🟡" if next_task['priority'] == 'Medium' else "🟢"
+            text = f"🔜 **What's Next?**\n\n"
+            text += f"⏰ {next_task['scheduled_time']} {prio_icon} {next_task['task_name']}\n\n"
             
-            # "What now?" should ONLY show what you should be doing RIGHT NOW
-            current_task = await database.get_current_task(query.from_user.id, today_str, current_time_str)
+            # Calculate time until next task; both times are local wall-clock time
+            task_time = datetime.strptime(f"{today_str} {next_task['scheduled_time']}", "%Y-%m-%d %H:%M")
+            time_diff = task_time - now.replace(tzinfo=None)
             
-            # Debug: If no current task, check all tasks to see what's available
-            if not current_task:
-                all_tasks = await database.get_tasks(query.from_user.id, today_str)
-                # Filter to see what tasks exist around this time
-                import utils
-                real_tasks = utils.filter_real_tasks(all_tasks)
-                logger.info(f"Debug - Current time: {current_time_str}, Found {len(real_tasks)} real tasks")
-                for t in real_tasks:
-                    if t['scheduled_time'] <= current_time_str and t['status'] != 'done':
-                        logger.info(f"Debug - Task {t['task_name']} at {t['scheduled_time']} status: {t['status']}")
-            
-            if current_task:
-                task_name = current_task['task_name']
-                # Calculate how long the task should have been running
-                task_time_str = current_task['scheduled_time']
-                # Parse as naive, then convert to timezone-aware using UTC method for consistency
-                task_datetime_naive = datetime.strptime(f"{today_str} {task_time_str}", "%Y-%m-%d %H:%M")
-                # Use the same method as 'now' - convert via UTC to ensure consistency
-                task_datetime = pytz.utc.localize(task_datetime_naive.replace(tzinfo=None)).astimezone(tz)
-                duration = now - task_datetime
-                duration_seconds = int(duration.total_seconds())
-                
-                # Only show task if it has actually started (duration >= 0)
-                if duration_seconds >= 0:
-                    # Format duration
-                    hours = duration_seconds // 3600
-                    minutes = (duration_seconds % 3600) // 60
-                    
-                    if hours >= 1:
-                        if minutes > 0:
-                            duration_text = f" for {hours} hour{'s' if hours > 1 else ''} and {minutes} minute{'s' if minutes > 1 else ''}"
-                        else:
-                            duration_text = f" for {hours} hour{'s' if hours > 1 else ''}"
-                    else:
-                        duration_text = f" for {minutes} minute{'s' if minutes > 1 else ''}"
-                    
-                    # Check if it's a commute task
-                    is_commute = 'Commute' in task_name or '🚶' in task_name or '🚕' in task_name or '🚌' in task_name
-                    
-                    if is_commute:
-                        if 'Home' in task_name:
-                            text = f"🔥 You should be {task_name.replace('🚶 ', '').replace('🚕 ', '').replace('🚌 ', '')}{duration_text}. Stay safe!"
-                        else:
-                            text = f"🔥 You should be {task_name.replace('🚶 ', '').replace('🚕 ', '').replace('🚌 ', '')}{duration_text}."
-                    else:
-                        text = f"🔥 You should be doing: {task_name}{duration_text}"
+            if time_diff.total_seconds() > 0:
+                hours = int(time_diff.total_seconds() // 3600)
+                minutes = int((time_diff.total_seconds() % 3600) // 60)
+                if hours > 0:
+                    text += f"⏳ In {hours}h {minutes}m"
                 else:
-                    # Task hasn't started yet
-                    text = "✅ No current task right now. Check 'What's next?' for upcoming tasks."
-            else:
-                # No current task found
-                text = "✅ No current task right now. Check 'What's next?' for upcoming tasks."
-            
-            await query.edit_message_text(
-                text=text,
-                parse_mode='Markdown',
-                reply_markup=keyboards.what_now_submenu_keyboard()
-            )
-        
-        elif query.data == 'whats_next':
-            try:
-                from datetime import datetime
-                import pytz
-                # TIMEZONE is now a timezone object, not a string
-                tz = config.TIMEZONE
-                # Get UTC time first, then convert to target timezone to avoid system timezone issues
-                now = datetime.now(pytz.utc).astimezone(tz)
-                current_time_str = now.strftime("%H:%M")
-                
-                # Auto-generate tasks if none exist
-                tasks = await database.get_tasks(query.from_user.id, today_str)
-                if not tasks:
-                    count = await database.generate_daily_tasks_from_recurring(query.from_user.id, now)
-                    if count > 0:
-                        tasks = await database.get_tasks(query.from_user.id, today_str)
-                        for t in tasks:
-                            t_time = datetime.strptime(t['scheduled_time'], "%H:%M").time()
-                            scheduler.schedule_task_notifications(
-                                context.job_queue, query.from_user.id, t['task_name'], t_time, t['date']
-                            )
-                
-                # Get next real task (filter out non-tasks)
-                all_tasks = await database.get_tasks(query.from_user.id, today_str)
-                real_tasks = utils.filter_real_tasks(all_tasks)
-                
-                # Find next task from real tasks
-                next_task = None
-                for task in real_tasks:
-                    if task['scheduled_time'] > current_time_str and task['status'] != 'done':
-                        next_task = task
-                        break
-                
-                if next_task:
-                    prio_icon = "🔴" if next_task['priority'] == 'High' else "🟡" if next_task['priority'] == 'Medium' else "🟢"
-                    text = f"🔜 **What's Next?**\n\n"
-                    text += f"⏰ {next_task['scheduled_time']} {prio_icon} {next_task['task_name']}\n\n"
-                    
-                    # Calculate time until next task
-                    from datetime import timedelta
-                    task_time_naive = datetime.strptime(f"{today_str} {next_task['scheduled_time']}", "%Y-%m-%d %H:%M")
-                    # Use the same method as 'now' - convert via UTC to ensure consistency
-                    task_time = pytz.utc.localize(task_time_naive.replace(tzinfo=None)).astimezone(tz)
-                    time_diff = task_time - now
-                    
-                    if time_diff.total_seconds() > 0:
-                        hours = int(time_diff.total_seconds() // 3600)
-                        minutes = int((time_diff.total_seconds() % 3600) // 60)
-                        if hours > 0:
-                            text += f"⏳ In {hours}h {minutes}m"
-                        else:
-                            text += f"⏳ In {minutes} minutes"
-                else:
-                    text = "✅ No more tasks scheduled for today!"
-                
-                await query.edit_message_text(
-                    text=text,
-                    parse_mode='Markdown',
-                    reply_markup=keyboards.what_now_submenu_keyboard()
-                )
-            except Exception as e:
-                logger.error(f"Error in whats_next: {e}", exc_info=True)
-                await query.edit_message_text(
-                    f"❌ Error loading next task: {str(e)}",
-                    reply_markup=keyboards.what_now_submenu_keyboard()
-                )
+                    text += f"⏳ In {minutes} minutes"
+        else:
+            text = "✅ No more tasks scheduled for today!"
         
-        elif query.data == 'what_missed':
-            try:
-                from datetime import datetime
-                import pytz
-                # TIMEZONE is now a timezone object, not a string
-                tz = config.TIMEZONE
-                # Get UTC time first, then convert to target timezone to avoid system timezone issues
-                now = datetime.now(pytz.utc).astimezone(tz)
-                current_time_str = now.strftime("%H:%M")
-                
-                incomplete = await database.get_incomplete_tasks(query.from_user.id, today_str, current_time_str)
-                # Filter out non-tasks
-                incomplete = utils.filter_real_tasks(incomplete)
-                
-                if not incomplete:
-                    text = f"✅ Great! No missed tasks today. All tasks are either done or haven't started yet."
-                else:
-                    text = f"❌ **What did I miss?**\n\n"
-                    text += "*Pending tasks from earlier today:*\n\n"
-                    for t in incomplete:
-                        prio_icon = "🔴" if t['priority'] == 'High' else "🟡" if t['priority'] == 'Medium' else "🟢"
-                        text += f"⏰ {t['scheduled_time']} {prio_icon} {t['task_name']}\n"
-                
-                await query.edit_message_text(
-                    text=text,
-                    parse_mode='Markdown',
-                    reply_markup=keyboards.what_now_submenu_keyboard()
-                )
-            except Exception as e:
-                logger.error(f"Error in what_missed: {e}", exc_info=True)
-                await query.edit_message_text(
-                    f"❌ Error loading missed tasks: {str(e)}",
-                    reply_markup=keyboards.what_now_submenu_keyboard()
-                )
+        await render.edit_message(
+            query,
+            text=text,
+            parse_mode='Markdown',
+            reply_markup=keyboards.what_now_submenu_keyboard()
+        )
+    except Exception as e:
+        logger.error(f"Error in whats_next: {e}", exc_info=True)
+        metrics.inc("menu.whats_next.errors")
+        await render.edit_message(
+            query,
+            f"❌ Error loading next task: {str(e)}",
+            reply_markup=keyboards.what_now_submenu_keyboard()
+        )
+
+@_traced("what_missed")
+async def _menu_what_missed(query, today_str, now):
+    try:
+        snapshot = await database.get_day_snapshot(query.from_user.id, today_str, now.strftime("%H:%M"))
         
-        elif query.data == 'view_today':
-            try:
-                tasks = await database.get_tasks(query.from_user.id, today_str)
-                if not tasks:
-                    # Try to generate tasks from recurring schedule
-                    from datetime import datetime
-                    import pytz
-                    # TIMEZONE is now a timezone object, not a string
-                    tz = config.TIMEZONE
-                    # Get UTC time first, then convert to target timezone to avoid system timezone issues
-                    now = datetime.now(pytz.utc).astimezone(tz)
-                    count = await database.generate_daily_tasks_from_recurring(query.from_user.id, now)
-                    
-                    if count > 0:
-                        # Re-fetch tasks and schedule notifications
-                        tasks = await database.get_tasks(query.from_user.id, today_str)
-                        for t in tasks:
-                            t_time = datetime.strptime(t['scheduled_time'], "%H:%M").time()
-                            scheduler.schedule_task_notifications(
-                                context.job_queue, query.from_user.id, t['task_name'], t_time, t['date']
-                            )
-                        # Filter out non-tasks
-                        tasks = utils.filter_real_tasks(tasks)
-                        if tasks:
-                            text = f"📅 **Today's Plan ({today_str}):**\n\n"
-                            text += f"_Generated {len(tasks)} tasks from your schedule_\n\n"
-                            for t in tasks:
-                                icon = "✅" if t['status'] == 'done' else "⬜"
-                                prio_icon = "🔴" if t['priority'] == 'High' else "🟡" if t['priority'] == 'Medium' else "🟢"
-                                text += f"{icon} {t['scheduled_time']} {prio_icon} {t['task_name']}\n"
-                        else:
-                            text = f"📅 No tasks scheduled for today ({today_str})."
-                    else:
-                        text = f"📅 No tasks scheduled for today ({today_str}).\n\n"
-                        text += "💡 Run /sync to generate tasks from your recurring schedule, or use '➕ Add Task' to add one manually."
-                else:
-                    # Filter out non-tasks
-                    tasks = utils.filter_real_tasks(tasks)
-                    if not tasks:
-                        text = f"📅 No tasks scheduled for today ({today_str})."
-                    else:
-                        text = f"📅 **Today's Plan ({today_str}):**\n\n"
-                        for t in tasks:
-                            icon = "✅" if t['status'] == 'done' else "⬜"
-                            prio_icon = "🔴" if t['priority'] == 'High' else "🟡" if t['priority'] == 'Medium' else "🟢"
-                            text += f"{icon} {t['scheduled_time']} {prio_icon} {t['task_name']}\n"
-                
-                await query.edit_message_text(
-                    text=text, 
-                    parse_mode='Markdown', 
-                    reply_markup=keyboards.back_only_keyboard()
-                )
-            except Exception as e:
-                logger.error(f"Error in view_today: {e}", exc_info=True)
-                await query.edit_message_text(
-                    f"❌ Error loading today's plan: {str(e)}",
-                    reply_markup=keyboards.back_only_keyboard()
-                )
+        if not snapshot['missed']:
+            text = f"✅ Great! No missed tasks today. All tasks are either done or haven't started yet."
+        else:
+            text = f"❌ **What did I miss?**\n\n"
+            text += "*Pending tasks from earlier today:*\n\n"
+            for i in snapshot['missed']:
+                t = snapshot['tasks'][i]
+                prio_icon = "🔴" if t['priority'] == 'High' else "🟡" if t['priority'] == 'Medium' else "🟢"
+                text += f"⏰ {t['scheduled_time']} {prio_icon} {t['task_name']}\n"
         
-        elif query.data == 'mark_done':
-            try:
+        await render.edit_message(
+            query,
+            text=text,
+            parse_mode='Markdown',
+            reply_markup=keyboards.what_now_submenu_keyboard()
+        )
+    except Exception as e:
+        logger.error(f"Error in what_missed: {e}", exc_info=True)
+        metrics.inc("menu.what_missed.errors")
+        await render.edit_message(
+            query,
+            f"❌ Error loading missed tasks: {str(e)}",
+            reply_markup=keyboards.what_now_submenu_keyboard()
+        )
+
+@_traced("view_today")
+async def _menu_view_today(query, today_str, now):
+    try:
+        tasks = await database.get_tasks(query.from_user.id, today_str)
+        if not tasks:
+            # Try to generate tasks from recurring schedule
+            count = await database.generate_daily_tasks_from_recurring(query.from_user.id, now)
+
+            if count > 0:
+                # Re-fetch tasks and schedule notifications
                 tasks = await database.get_tasks(query.from_user.id, today_str)
-                # Filter out non-tasks
-                tasks = utils.filter_real_tasks(tasks)
-                if not tasks:
-                    await query.edit_message_text(
-                        f"📝 No tasks found for today ({today_str}).",
-                        reply_markup=keyboards.back_only_keyboard()
+                for t in tasks:
+                    t_time = datetime.strptime(t['scheduled_time'], "%H:%M").time()
+                    await scheduler.schedule_task_notifications(
+                        query.from_user.id, t['id'], t['task_name'], t_time, t['date']
                     )
-                else:
-                    text = f"📝 **Mark tasks as done ({today_str}):**\n\nClick on a task to mark it as complete.\n"
-                    await query.edit_message_text(
-                        text=text,
-                        parse_mode='Markdown',
-                        reply_markup=keyboards.mark_done_keyboard(tasks)
-                    )
-            except Exception as e:
-                logger.error(f"Error in mark_done: {e}", exc_info=True)
-                await query.edit_message_text(
-                    f"❌ Error loading tasks: {str(e)}",
-                    reply_markup=keyboards.back_only_keyboard()
-                )
-        
-        elif query.data == 'stats':
-            try:
-                stats = await database.get_user_stats(query.from_user.id, today_str)
-                if stats:
-                    text = f"📊 **Your Statistics**\n\n"
-                    text += f"📅 Today: {stats['today_done']}/{stats['today_total']} tasks done\n"
-                    text += f"🔥 Current Streak: {stats['streak']} days\n"
-                    text += f"🎯 Total Completed: {stats['total_completed']} tasks"
-                else:
-                    text = "📊 **Your Statistics**\n\nNo statistics available yet."
-                
-                await query.edit_message_text(
-                    text=text,
-                    parse_mode='Markdown',
-                    reply_markup=keyboards.back_only_keyboard()
-                )
-            except Exception as e:
-                logger.error(f"Error in stats: {e}", exc_info=True)
-                await query.edit_message_text(
-                    f"❌ Error loading statistics: {str(e)}",
-                    reply_markup=keyboards.back_only_keyboard()
-                )
-        
-        elif query.data == 'view_tomorrow':
-            try:
-                tomorrow_str = utils.get_tomorrow_str()
-                tasks = await database.get_tasks(query.from_user.id, tomorrow_str)
-                
-                if not tasks:
-                    # Generate preview from recurring_tasks
-                    from datetime import datetime, timedelta
-                    import pytz
-                    # TIMEZONE is now a timezone object, not a string
-                    tz = config.TIMEZONE
-                    # Get UTC time first, then convert to target timezone to avoid system timezone issues
-                    today = datetime.now(pytz.utc).astimezone(tz)
-                    tomorrow = today + timedelta(days=1)
-                    day_name = tomorrow.strftime("%A").upper()  # MONDAY, TUESDAY...
-                    recurring = await database.get_recurring_tasks_for_day(query.from_user.id, day_name)
-                    
-                    if recurring:
-                        # Filter out non-tasks
-                        recurring = utils.filter_real_tasks(recurring)
-                        if recurring:
-                            text = f"📅 **Tomorrow's Preview ({tomorrow_str}):**\n\n"
-                            text += "*Based on your recurring schedule:*\n\n"
-                            for t in recurring:
-                                text += f"⏰ {t['scheduled_time']} {t['task_name']}\n"
-                        else:
-                            text = f"📅 No tasks scheduled for tomorrow ({tomorrow_str})."
-                    else:
-                        text = f"📅 No tasks scheduled for tomorrow ({tomorrow_str})."
-                else:
-                    # Filter out non-tasks
-                    tasks = utils.filter_real_tasks(tasks)
-                    if not tasks:
-                        text = f"📅 No tasks scheduled for tomorrow ({tomorrow_str})."
-                    else:
-                        text = f"📅 **Tomorrow's Plan ({tomorrow_str}):**\n\n"
-                        for t in tasks:
-                            icon = "✅" if t['status'] == 'done' else "⬜"
-                            prio_icon = "🔴" if t['priority'] == 'High' else "🟡" if t['priority'] == 'Medium' else "🟢"
-                            text += f"{icon} {t['scheduled_time']} {prio_icon} {t['task_name']}\n"
-                
-                await query.edit_message_text(
-                    text=text,
-                    parse_mode='Markdown',
-                    reply_markup=keyboards.back_only_keyboard()
-                )
-            except Exception as e:
-                logger.error(f"Error in view_tomorrow: {e}", exc_info=True)
-                await query.edit_message_text(
-                    f"❌ Error loading tomorrow's plan: {str(e)}",
-                    reply_markup=keyboards.back_only_keyboard()
-                )
-        
-        elif query.data == 'view_incomplete':
-            try:
-                from datetime import datetime
-                import pytz
-                # TIMEZONE is now a timezone object, not a string
-                tz = config.TIMEZONE
-                # Get UTC time first, then convert to target timezone to avoid system timezone issues
-                now = datetime.now(pytz.utc).astimezone(tz)
-                current_time_str = now.strftime("%H:%M")
-                
-                incomplete = await database.get_incomplete_tasks(query.from_user.id, today_str, current_time_str)
                 # Filter out non-tasks
-                incomplete = utils.filter_real_tasks(incomplete)
-                
-                if not incomplete:
-                    text = f"✅ Great! No missed tasks today. All tasks are either done or haven't started yet."
-                else:
-                    text = f"❌ **Missed/Incomplete Tasks ({today_str}):**\n\n"
-                    text += "*Tasks that have passed their start time but are still pending:*\n\n"
-                    for t in incomplete:
+                tasks = utils.filter_real_tasks(tasks)
+                if tasks:
+                    text = f"📅 **Today's Plan ({today_str}):**\n\n"
+                    text += f"_Generated {len(tasks)} tasks from your schedule_\n\n"
+                    for t in tasks:
+                        icon = "✅" if t['status'] == 'done' else "⬜"
                         prio_icon = "🔴" if t['priority'] == 'High' else "🟡" if t['priority'] == 'Medium' else "🟢"
-                        text += f"⏰ {t['scheduled_time']} {prio_icon} {t['task_name']}\n"
-                
-                await query.edit_message_text(
-                    text=text,
-                    parse_mode='Markdown',
-                    reply_markup=keyboards.back_only_keyboard()
-                )
-            except Exception as e:
-                logger.error(f"Error in view_incomplete: {e}", exc_info=True)
-                await query.edit_message_text(
-                    f"❌ Error loading incomplete tasks: {str(e)}",
-                    reply_markup=keyboards.back_only_keyboard()
-                )
-        
-        elif query.data == 'settings':
-            settings = await database.get_user_settings(query.from_user.id)
-            if settings:
-                notif_status = "✅ ON" if settings['notification_enabled'] else "❌ OFF"
-                text = f"⚙️ **Settings**\n\n"
-                text += f"🔔 Notifications: {notif_status}\n\n"
-                text += "Click below to toggle notifications:"
-                
-                toggle_text = "🔕 Turn OFF" if settings['notification_enabled'] else "🔔 Turn ON"
-                keyboard = [
-                    [InlineKeyboardButton(toggle_text, callback_data='toggle_notifications')],
-                    [InlineKeyboardButton("🔙 Back to Menu", callback_data='back_to_menu')]
-                ]
-                await query.edit_message_text(
-                    text=text,
-                    parse_mode='Markdown',
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
+                        text += f"{icon} {t['scheduled_time']} {prio_icon} {t['task_name']}\n"
+                else:
+                    text = f"📅 No tasks scheduled for today ({today_str})."
             else:
-                await query.edit_message_text(
-                    "❌ Error loading settings.",
-                    reply_markup=keyboards.back_only_keyboard()
-                )
-        
-        elif query.data == 'toggle_notifications':
-            new_status = await database.toggle_notifications(query.from_user.id)
-            if new_status is not None:
-                status_text = "✅ ON" if new_status else "❌ OFF"
-                text = f"⚙️ **Settings**\n\n"
-                text += f"🔔 Notifications: {status_text}\n\n"
-                text += "Click below to toggle notifications:"
-                
-                toggle_text = "🔕 Turn OFF" if new_status else "🔔 Turn ON"
-                keyboard = [
-                    [InlineKeyboardButton(toggle_text, callback_data='toggle_notifications')],
-                    [InlineKeyboardButton("🔙 Back to Menu", callback_data='back_to_menu')]
-                ]
-                await query.edit_message_text(
-                    text=text,
-                    parse_mode='Markdown',
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
+                text = f"📅 No tasks scheduled for today ({today_str}).\n\n"
+                text += "💡 Run /sync to generate tasks from your recurring schedule, or use '➕ Add Task' to add one manually."
+        else:
+            # Filter out non-tasks
+            tasks = utils.filter_real_tasks(tasks)
+            if not tasks:
+                text = f"📅 No tasks scheduled for today ({today_str})."
             else:
-                await query.answer("❌ Error toggling notifications.", show_alert=True)
-        
-        elif query.data == 'debug_time':
-            from datetime import datetime
-            import pytz
-            
-            # TIMEZONE is now a timezone object, not a string
-            tz = config.TIMEZONE
-            # Get UTC time first, then convert to target timezone
-            utc_now = datetime.now(pytz.utc)
-            local_now = utc_now.astimezone(tz)
-            
-            # Also get system time for comparison
-            system_now = datetime.now()
-            
-            # Format timezone display nicely
-            offset_hours = int(local_now.utcoffset().total_seconds() / 3600)
-            timezone_display = f"UTC+{offset_hours}" if offset_hours >= 0 else f"UTC{offset_hours}"
-            
-            text = f"🕐 **Debug: Current Time**\n\n"
-            text += f"📍 **Configured Timezone**: {timezone_display} (Fixed Offset)\n"
-            text += f"🌍 **UTC Time**: {utc_now.strftime('%Y-%m-%d %H:%M:%S %Z')}\n"
-            text += f"📍 **Local Time ({timezone_display})**: {local_now.strftime('%Y-%m-%d %H:%M:%S')}\n"
-            text += f"⏰ **Time Display**: {local_now.strftime('%H:%M')}\n"
-            text += f"📅 **Date**: {local_now.strftime('%A, %B %d, %Y')}\n\n"
-            text += f"💻 **System Local Time**: {system_now.strftime('%Y-%m-%d %H:%M:%S')}\n"
-            text += f"🔧 **UTC Offset**: {local_now.utcoffset()}\n"
-            text += f"🌐 **Timezone Type**: Fixed Offset (UTC+5)\n\n"
-            text += f"📊 **Time Calculation Method**:\n"
-            text += f"`datetime.now(pytz.utc).astimezone(tz)`"
-            
-            await query.edit_message_text(
+                text = f"📅 **Today's Plan ({today_str}):**\n\n"
+                for t in tasks:
+                    icon = "✅" if t['status'] == 'done' else "⬜"
+                    prio_icon = "🔴" if t['priority'] == 'High' else "🟡" if t['priority'] == 'Medium' else "🟢"
+                    text += f"{icon} {t['scheduled_time']} {prio_icon} {t['task_name']}\n"
+
+        await render.edit_message(
+            query,
+            text=text, 
+            parse_mode='Markdown', 
+            reply_markup=keyboards.back_only_keyboard()
+        )
+    except Exception as e:
+        logger.error(f"Error in view_today: {e}", exc_info=True)
+        metrics.inc("menu.view_today.errors")
+        await render.edit_message(
+            query,
+            f"❌ Error loading today's plan: {str(e)}",
+            reply_markup=keyboards.back_only_keyboard()
+        )
+
+@_traced("mark_done")
+async def _menu_mark_done(query, today_str, now):
+    try:
+        tasks = await database.get_tasks(query.from_user.id, today_str, real_only=True)
+        if not tasks:
+            await render.edit_message(
+                query,
+                f"📝 No tasks found for today ({today_str}).",
+                reply_markup=keyboards.back_only_keyboard()
+            )
+        else:
+            text = f"📝 **Mark tasks as done ({today_str}):**\n\nClick on a task to mark it as complete.\n"
+            await render.edit_message(
+                query,
                 text=text,
                 parse_mode='Markdown',
-                reply_markup=keyboards.back_only_keyboard()
+                reply_markup=keyboards.mark_done_keyboard(tasks)
             )
-        
-        elif query.data.startswith('done_'):
-            try:
-                # Mark task as done
-                task_id = int(query.data.split('_')[1])
-                await database.update_task_status(task_id, 'done')
-                
-                # Refresh the mark_done list
-                tasks = await database.get_tasks(query.from_user.id, today_str)
-                # Filter out non-tasks
-                tasks = utils.filter_real_tasks(tasks)
-                text = f"📝 **Mark tasks as done ({today_str}):**\n\nClick on a task to mark it as complete.\n"
-                await query.edit_message_text(
-                    text=text,
-                    parse_mode='Markdown',
-                    reply_markup=keyboards.mark_done_keyboard(tasks)
-                )
-                await query.answer("✅ Task marked as done!")
-            except Exception as e:
-                logger.error(f"Error marking task as done: {e}", exc_info=True)
-                await query.answer("❌ Error marking task as done.", show_alert=True)
-    
+    except Exception as e:
+        logger.error(f"Error in mark_done: {e}", exc_info=True)
+        metrics.inc("menu.mark_done.errors")
+        await render.edit_message(
+            query,
+            f"❌ Error loading tasks: {str(e)}",
+            reply_markup=keyboards.back_only_keyboard()
+        )
+
+@_traced("stats")
+async def _menu_stats(query, today_str, now):
+    try:
+        stats = await database.get_user_stats(query.from_user.id, today_str)
+        if stats:
+            text = f"📊 **Your Statistics**\n\n"
+            text += f"📅 Today: {stats['today_done']}/{stats['today_total']} tasks done\n"
+            text += f"🔥 Current Streak: {stats['streak']} days\n"
+            text += f"🎯 Total Completed: {stats['total_completed']} tasks"
         else:
-            # Handle unhandled callback_data
-            logger.warning(f"Unhandled callback_data: {query.data}")
-            try:
-                await query.answer("⚠️ This action is not available right now.", show_alert=True)
-            except Exception as e:
-                logger.error(f"Error answering unhandled callback: {e}", exc_info=True)
+            text = "📊 **Your Statistics**\n\nNo statistics available yet."
+
+        await render.edit_message(
+            query,
+            text=text,
+            parse_mode='Markdown',
+            reply_markup=keyboards.back_only_keyboard()
+        )
+    except Exception as e:
+        logger.error(f"Error in stats: {e}", exc_info=True)
+        metrics.inc("menu.stats.errors")
+        await render.edit_message(
+            query,
+            f"❌ Error loading statistics: {str(e)}",
+            reply_markup=keyboards.back_only_keyboard()
+        )
+
+@_traced("view_tomorrow")
+async def _menu_view_tomorrow(query, today_str, now):
+    try:
+        tomorrow_str = (now + timedelta(days=1)).strftime("%Y-%m-%d")
+        tasks = await database.get_tasks(query.from_user.id, tomorrow_str)
+
+        if not tasks:
+            # Generate preview from recurring_tasks
+            tomorrow = now + timedelta(days=1)
+            day_name = tomorrow.strftime("%A").upper()  # MONDAY, TUESDAY...
+            recurring = await database.get_recurring_tasks_for_day(
+                query.from_user.id, day_name, real_only=True
+            )
+
+            if recurring:
+                text = f"📅 **Tomorrow's Preview ({tomorrow_str}):**\n\n"
+                text += "*Based on your recurring schedule:*\n\n"
+                for t in recurring:
+                    text += f"⏰ {t['scheduled_time']} {t['task_name']}\n"
+            else:
+                text = f"📅 No tasks scheduled for tomorrow ({tomorrow_str})."
+        else:
+            # Filter out non-tasks
+            tasks = utils.filter_real_tasks(tasks)
+            if not tasks:
+                text = f"📅 No tasks scheduled for tomorrow ({tomorrow_str})."
+            else:
+                text = f"📅 **Tomorrow's Plan ({tomorrow_str}):**\n\n"
+                for t in tasks:
+                    icon = "✅" if t['status'] == 'done' else "⬜"
+                    prio_icon = "🔴" if t['priority'] == 'High' else "🟡" if t['priority'] == 'Medium' else "🟢"
+                    text += f"{icon} {t['scheduled_time']} {prio_icon} {t['task_name']}\n"
+
+        await render.edit_message(
+            query,
+            text=text,
+            parse_mode='Markdown',
+            reply_markup=keyboards.back_only_keyboard()
+        )
+    except Exception as e:
+        logger.error(f"Error in view_tomorrow: {e}", exc_info=True)
+        metrics.inc("menu.view_tomorrow.errors")
+        await render.edit_message(
+            query,
+            f"❌ Error loading tomorrow's plan: {str(e)}",
+            reply_markup=keyboards.back_only_keyboard()
+        )
+
+@_traced("view_incomplete")
+async def _menu_view_incomplete(query, today_str, now):
+    try:
+        current_time_str = now.strftime("%H:%M")
+
+        incomplete = await database.get_incomplete_tasks(
+            query.from_user.id, today_str, current_time_str, real_only=True
+        )
+
+        if not incomplete:
+            text = f"✅ Great! No missed tasks today. All tasks are either done or haven't started yet."
+        else:
+            text = f"❌ **Missed/Incomplete Tasks ({today_str}):**\n\n"
+            text += "*Tasks that have passed their start time but are still pending:*\n\n"
+            for t in incomplete:
+                prio_icon = "🔴" if t['priority'] == 'High' else "🟡" if t['priority'] == 'Medium' else "🟢"
+                text += f"⏰ {t['scheduled_time']} {prio_icon} {t['task_name']}\n"
+
+        await render.edit_message(
+            query,
+            text=text,
+            parse_mode='Markdown',
+            reply_markup=keyboards.back_only_keyboard()
+        )
+    except Exception as e:
+        logger.error(f"Error in view_incomplete: {e}", exc_info=True)
+        metrics.inc("menu.view_incomplete.errors")
+        await render.edit_message(
+            query,
+            f"❌ Error loading incomplete tasks: {str(e)}",
+            reply_markup=keyboards.back_only_keyboard()
+        )
+
+@_traced("settings")
+async def _menu_settings(query, today_str, now):
+    settings = await database.get_user_settings(query.from_user.id)
+    if settings:
+        notif_status = "✅ ON" if settings['notification_enabled'] else "❌ OFF"
+        text = f"⚙️ **Settings**\n\n"
+        text += f"🔔 Notifications: {notif_status}\n\n"
+        text += "Click below to toggle notifications:"
+
+        toggle_text = "🔕 Turn OFF" if settings['notification_enabled'] else "🔔 Turn ON"
+        keyboard = [
+            [InlineKeyboardButton(toggle_text, callback_data='toggle_notifications')],
+            [InlineKeyboardButton("🔙 Back to Menu", callback_data='back_to_menu')]
+        ]
+        await render.edit_message(
+            query,
+            text=text,
+            parse_mode='Markdown',
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    else:
+        await render.edit_message(
+            query,
+            "❌ Error loading settings.",
+            reply_markup=keyboards.back_only_keyboard()
+        )
+
+@_traced("toggle_notifications")
+async def _menu_toggle_notifications(query, today_str, now):
+    new_status = await database.toggle_notifications(query.from_user.id)
+    if new_status:
+        # Turning off already cancelled the pending reminders in the same write
+        await scheduler.reschedule_user_reminders(query.from_user.id)
+    if new_status is not None:
+        status_text = "✅ ON" if new_status else "❌ OFF"
+        text = f"⚙️ **Settings**\n\n"
+        text += f"🔔 Notifications: {status_text}\n\n"
+        text += "Click below to toggle notifications:"
+
+        toggle_text = "🔕 Turn OFF" if new_status else "🔔 Turn ON"
+        keyboard = [
+            [InlineKeyboardButton(toggle_text, callback_data='toggle_notifications')],
+            [InlineKeyboardButton("🔙 Back to Menu", callback_data='back_to_menu')]
+        ]
+        await render.edit_message(
+            query,
+            text=text,
+            parse_mode='Markdown',
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    else:
+        await query.answer("❌ Error toggling notifications.", show_alert=True)
+
+@_traced("debug_time")
+async def _menu_debug_time(query, today_str, now):
+
+    local_now = now
+    utc_now = now.astimezone(pytz.utc)
+
+    # Also get system time for comparison
+    system_now = datetime.now()
+
+    # Format timezone display nicely
+    offset_hours = int(local_now.utcoffset().total_seconds() / 3600)
+    timezone_display = f"UTC+{offset_hours}" if offset_hours >= 0 else f"UTC{offset_hours}"
+
+    text = f"🕐 **Debug: Current Time**\n\n"
+    text += f"📍 **Configured Timezone**: {timezone_display} (Fixed Offset)\n"
+    text += f"🌍 **UTC Time**: {utc_now.strftime('%Y-%m-%d %H:%M:%S %Z')}\n"
+    text += f"📍 **Local Time ({timezone_display})**: {local_now.strftime('%Y-%m-%d %H:%M:%S')}\n"
+    text += f"⏰ **Time Display**: {local_now.strftime('%H:%M')}\n"
+    text += f"📅 **Date**: {local_now.strftime('%A, %B %d, %Y')}\n\n"
+    text += f"💻 **System Local Time**: {system_now.strftime('%Y-%m-%d %H:%M:%S')}\n"
+    text += f"🔧 **UTC Offset**: {local_now.utcoffset()}\n"
+    text += f"🌐 **Timezone Type**: Fixed Offset (UTC+5)\n\n"
+    text += f"📊 **Time Calculation Method**:\n"
+    text += f"`datetime.now(pytz.utc).astimezone(tz)`"
+
+    await render.edit_message(
+        query,
+        text=text,
+        parse_mode='Markdown',
+        reply_markup=keyboards.back_only_keyboard()
+    )
+
+@_traced("done")
+async def _menu_done(query, today_str, now, param):
+    try:
+        # Mark task as done
+        task_id = int(param)
+        await database.update_task_status(task_id, 'done')
+
+        # Refresh the mark_done list
+        tasks = await database.get_tasks(query.from_user.id, today_str, real_only=True)
+        text = f"📝 **Mark tasks as done ({today_str}):**\n\nClick on a task to mark it as complete.\n"
+        await render.edit_message(
+            query,
+            text=text,
+            parse_mode='Markdown',
+            reply_markup=keyboards.mark_done_keyboard(tasks)
+        )
+        await query.answer("✅ Task marked as done!")
+    except Exception as e:
+        logger.error(f"Error marking task as done: {e}", exc_info=True)
+        metrics.inc("menu.done.errors")
+        await query.answer("❌ Error marking task as done.", show_alert=True)
+
+# callback_data -> handler(query, today_str, now)
+MENU_ACTIONS = {
+    'back_to_menu': _menu_back_to_menu,
+    'what_now': _menu_what_now,
+    'whats_next': _menu_whats_next,
+    'what_missed': _menu_what_missed,
+    'view_today': _menu_view_today,
+    'mark_done': _menu_mark_done,
+    'stats': _menu_stats,
+    'view_tomorrow': _menu_view_tomorrow,
+    'view_incomplete': _menu_view_incomplete,
+    'settings': _menu_settings,
+    'toggle_notifications': _menu_toggle_notifications,
+    'debug_time': _menu_debug_time,
+}
+# callback_data prefix -> handler(query, today_str, now, rest of callback_data)
+MENU_PREFIX_ACTIONS = {
+    'done_': _menu_done,
+}
+
+async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if not query:
+        return
+    
+    # Always answer the callback query first to prevent "loading" state
+    try:
+        await query.answer()
+    except Exception as e:
+        logger.error(f"Error answering callback query: {e}", exc_info=True)
+    
+    try:
+        log_user_action(update, f"Menu action: {query.data}")
+        
+        now = utils.get_user_now(await database.get_user_timezone(query.from_user.id))
+        today_str = now.strftime("%Y-%m-%d")
+        
+        handler = MENU_ACTIONS.get(query.data)
+        if handler is not None:
+            await handler(query, today_str, now)
+            return
+        prefix, separator, param = query.data.partition('_')
+        handler = MENU_PREFIX_ACTIONS.get(prefix + separator)
+        if handler is not None:
+            await handler(query, today_str, now, param)
+            return
+        
+        # Handle unhandled callback_data
+        logger.warning(f"Unhandled callback_data: {query.data}")
+        try:
+            await query.answer("⚠️ This action is not available right now.", show_alert=True)
+        except Exception as e:
+            logger.error(f"Error answering unhandled callback: {e}", exc_info=True)
     
     except Exception as e:
         logger.error(f"Error in menu_callback: {e}", exc_info=True)
@@ -586,7 +633,8 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start_add_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text(
+    await render.edit_message(
+        query,
         "✍️ Enter task name:",
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Cancel", callback_data='cancel_add')]])
     )
@@ -603,7 +651,8 @@ async def receive_task_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def back_to_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text(
+    await render.edit_message(
+        query,
         "✍️ Enter task name:",
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Cancel", callback_data='cancel_add')]])
     )
@@ -620,39 +669,43 @@ async def receive_task_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🔥 Select Priority:", reply_markup=keyboards.priority_keyboard())
     return config.TASK_PRIORITY
 
+@_traced("time")
 async def task_time_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     time_str = query.data.split('_')[1]
     context.user_data['new_task_time'] = utils.parse_time(time_str)
     
-    await query.edit_message_text("🔥 Select Priority:", reply_markup=keyboards.priority_keyboard())
+    await render.edit_message(query, "🔥 Select Priority:", reply_markup=keyboards.priority_keyboard())
     return config.TASK_PRIORITY
 
 async def back_to_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text(
+    await render.edit_message(
+        query,
         "⏰ Select start time (Astana Time) or type HH:MM:", 
         reply_markup=keyboards.time_picker_keyboard()
     )
     return config.TASK_TIME
 
+@_traced("prio")
 async def receive_priority(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     priority = query.data.split('_')[1]
     context.user_data['new_task_priority'] = priority
     
-    await query.edit_message_text("📂 Select Category:", reply_markup=keyboards.category_keyboard())
+    await render.edit_message(query, "📂 Select Category:", reply_markup=keyboards.category_keyboard())
     return config.TASK_CATEGORY
 
 async def back_to_priority(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("🔥 Select Priority:", reply_markup=keyboards.priority_keyboard())
+    await render.edit_message(query, "🔥 Select Priority:", reply_markup=keyboards.priority_keyboard())
     return config.TASK_PRIORITY
 
+@_traced("cat")
 async def receive_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -663,16 +716,25 @@ async def receive_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
     time_obj = context.user_data['new_task_time']
     time_str = time_obj.strftime("%H:%M")
     prio = context.user_data['new_task_priority']
-    date_str = utils.get_today_str()
-    
-    await database.add_task(user_id, name, time_str, prio, category, date_str)
+    date_str = utils.get_today_str(await database.get_user_timezone(user_id))
     
+    task_id = await database.add_task(user_id, name, time_str, prio, category, date_str)
+    if task_id is None:
+        await render.edit_message(
+            query,
+            f"⚠️ *{name}* is already on today's plan.",
+            parse_mode='Markdown',
+            reply_markup=keyboards.main_menu_keyboard()
+        )
+        return ConversationHandler.END
+
     # Schedule for Today
-    scheduler.schedule_task_notifications(
-        context.job_queue, user_id, name, time_obj, date_str
+    await scheduler.schedule_task_notifications(
+        user_id, task_id, name, time_obj, date_str
     )
     
-    await query.edit_message_text(
+    await render.edit_message(
+        query,
         f"✅ Added: *{name}* at {time_str} ({prio})\nTo: {category}",
         parse_mode='Markdown'
     )
@@ -686,35 +748,27 @@ async def receive_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query:
         await update.callback_query.answer()
-        await update.callback_query.edit_message_text("❌ Action cancelled.")
+        await render.edit_message(update.callback_query, "❌ Action cancelled.")
         await update.callback_query.message.reply_text("🏠 Main Menu", reply_markup=keyboards.main_menu_keyboard())
     else:
         await update.message.reply_text("❌ Action cancelled.", reply_markup=keyboards.main_menu_keyboard())
     return ConversationHandler.END
 
 # --- Main Setup ---
-def main():
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(database.init_db())
+async def on_startup(application):
+    """Start the outbound message queue once the bot is initialised"""
+    outbox.start(application.bot)
 
-    # Set timezone for all operations - Use fixed UTC+5 timezone
-    # TIMEZONE is now a timezone object (FixedOffset UTC+5)
-    defaults = Defaults(tzinfo=config.TIMEZONE)
-    application = ApplicationBuilder().token(config.BOT_TOKEN).defaults(defaults).build()
-    
-    # Explicitly configure scheduler timezone
-    application.job_queue.scheduler.configure(timezone=config.TIMEZONE)
-    
-    # Verify timezone is set correctly
-    from datetime import datetime
-    test_utc = datetime.now(pytz.utc)
-    test_local = test_utc.astimezone(config.TIMEZONE)
-    print(f"✅ Timezone configured: {config.TIMEZONE} (UTC+5)")
-    print(f"✅ Current UTC time: {test_utc.strftime('%H:%M:%S')}")
-    print(f"✅ Current local time: {test_local.strftime('%H:%M:%S')}")
-    print(f"✅ UTC offset: {test_local.utcoffset()}")
+async def on_shutdown(application):
+    """Release shared resources once the application has stopped"""
+    await outbox.stop()
+    await database.close_db()
 
+# The only update types the handlers use; Telegram does not send (and we do not parse) the rest
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+def add_handlers(application):
+    """Register the bot's command, conversation and menu handlers (also used by webhook_loadtest.py)"""
     # Conversation Handler
     add_task_conv = ConversationHandler(
         entry_points=[CallbackQueryHandler(start_add_task, pattern='^add_task$')],
@@ -743,15 +797,81 @@ def main():
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("sync", scheduler.regenerate_today))
     application.add_handler(CommandHandler("time", show_time))
+    application.add_handler(CommandHandler("perf", perf))
     application.add_handler(add_task_conv)
     application.add_handler(CallbackQueryHandler(menu_callback))
 
-    # Run Daily Maintenance at 04:00 AM Astana time
-    # timezone is automatically used from scheduler configuration and bot defaults
-    application.job_queue.run_daily(scheduler.daily_maintenance, time=time(4, 0))
+def main():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(database.init_db())
+
+    # Set timezone for all operations - Use fixed UTC+5 timezone
+    # TIMEZONE is now a timezone object (FixedOffset UTC+5)
+    defaults = Defaults(tzinfo=config.TIMEZONE)
+    application = (
+        ApplicationBuilder()
+        .token(config.BOT_TOKEN)
+        .defaults(defaults)
+        # Different users' updates run concurrently, one user's updates stay in order
+        .concurrent_updates(PerUserUpdateProcessor(config.UPDATE_CONCURRENCY))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    
+    # Explicitly configure scheduler timezone
+    application.job_queue.scheduler.configure(timezone=config.TIMEZONE)
+    
+    # Verify timezone is set correctly
+    from datetime import datetime
+    test_utc = datetime.now(pytz.utc)
+    test_local = test_utc.astimezone(config.TIMEZONE)
+    print(f"✅ Timezone configured: {config.TIMEZONE} (UTC+5)")
+    print(f"✅ Current UTC time: {test_utc.strftime('%H:%M:%S')}")
+    print(f"✅ Current local time: {test_local.strftime('%H:%M:%S')}")
+    print(f"✅ UTC offset: {test_local.utcoffset()}")
+
+    add_handlers(application)
+
+    # Count runs APScheduler skips because the event loop was too busy to start them in time
+    application.job_queue.scheduler.add_listener(scheduler.count_missed_job, EVENT_JOB_MISSED)
+
+    # Run Daily Maintenance at 04:00 AM in each user's timezone: every 15 minutes the
+    # timezone buckets that have just reached 04:00 get their tasks generated
+    now_utc = datetime.now(pytz.utc)
+    next_quarter = now_utc.replace(second=0, microsecond=0) + timedelta(minutes=15 - now_utc.minute % 15)
+    application.job_queue.run_repeating(
+        scheduler.daily_maintenance, interval=scheduler.MAINTENANCE_TICK, first=next_quarter
+    )
+    # Finish a morning run that a crash or restart cut short
+    application.job_queue.run_once(scheduler.resume_maintenance, when=5)
+    if config.ARCHIVE_AFTER_DAYS > 0:
+        # Move old tasks to the archive database before the morning rush
+        application.job_queue.run_daily(scheduler.archive_old_tasks, time=time(3, 30))
+
+    # One job sends all reminders due each minute, straight from the reminders table
+    next_minute = (datetime.now(pytz.utc) + timedelta(minutes=1)).replace(second=0, microsecond=0)
+    application.job_queue.run_repeating(scheduler.dispatch_reminders, interval=60, first=next_minute)
+    # Keeps the next REMINDER_HORIZON_HOURS of reminders in the reminders table
+    application.job_queue.run_repeating(
+        scheduler.top_up_reminders, interval=config.REMINDER_TOPUP_MINUTES * 60, first=10
+    )
 
     print(f"🤖 Bot is running in {config.TIMEZONE}...")
-    application.run_polling()
+    if config.WEBHOOK_URL:
+        # Telegram pushes updates; TLS is terminated by the reverse proxy in front of us
+        application.run_webhook(
+            listen=config.WEBHOOK_LISTEN,
+            port=config.WEBHOOK_PORT,
+            url_path=config.WEBHOOK_PATH,
+            webhook_url=config.WEBHOOK_URL,
+            secret_token=config.WEBHOOK_SECRET_TOKEN,
+            max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,101 @@
+"""In-process cache of per-user data: day timelines and notification profiles"""
+import sys
+import time
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+from config import TIMELINE_CACHE_TTL, TIMELINE_CACHE_MAX_KB
+import metrics
+
+# Entry kinds: "timeline" keyed by (user_id, date), "profile" keyed by user_id
+
+# (kind, key) -> (expires_at, size_bytes, records), least recently used first
+_entries = OrderedDict()
+_bytes = 0
+# Bumped by every invalidation, loads that raced with a write are not stored
+_generation = 0
+
+class _Record(tuple):
+    """Immutable row, readable by column name like sqlite Row"""
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        return list(self._fields)
+
+@lru_cache(maxsize=None)
+def _record_type(columns):
+    return type("Record", (_Record, namedtuple("Record", columns)), {"__slots__": ()})
+
+def freeze(rows):
+    """Turn fetched rows into a tuple of compact immutable records"""
+    if not rows:
+        return ()
+    record = _record_type(tuple(rows[0].keys()))
+    return tuple(record._make(row) for row in rows)
+
+def _size_of(records):
+    size = sys.getsizeof(records)
+    for record in records:
+        size += sys.getsizeof(record) + sum(sys.getsizeof(value) for value in record)
+    return size
+
+def generation():
+    """Current generation, pass it back to put() after loading from the database"""
+    return _generation
+
+def get(kind, key):
+    """Cached records, or None"""
+    entry = _entries.get((kind, key))
+    if entry is None or entry[0] < time.monotonic():
+        if entry is not None:
+            _evict((kind, key))
+        metrics.inc(f"{kind}_cache.misses")
+        return None
+    _entries.move_to_end((kind, key))
+    metrics.inc(f"{kind}_cache.hits")
+    return entry[2]
+
+def put(kind, key, records, loaded_generation):
+    """Store records unless a write invalidated the cache while they were loading"""
+    global _bytes
+    if loaded_generation != _generation:
+        return
+    if (kind, key) in _entries:
+        _evict((kind, key))
+    size = _size_of(records)
+    _entries[(kind, key)] = (time.monotonic() + TIMELINE_CACHE_TTL, size, records)
+    _bytes += size
+    while _bytes > TIMELINE_CACHE_MAX_KB * 1024 and _entries:
+        _evict(next(iter(_entries)))
+        metrics.inc("cache.evictions")
+    _update_gauges()
+
+def invalidate(kind, key):
+    """Drop an entry, call after the write has committed"""
+    global _generation
+    _generation += 1
+    if (kind, key) in _entries:
+        _evict((kind, key))
+        _update_gauges()
+
+def clear():
+    global _generation, _bytes
+    _generation += 1
+    _entries.clear()
+    _bytes = 0
+    _update_gauges()
+
+def _evict(entry_key):
+    global _bytes
+    _bytes -= _entries.pop(entry_key)[1]
+
+def _update_gauges():
+    metrics.set_gauge("cache.entries", len(_entries))
+    metrics.set_gauge("cache.bytes", _bytes)
@@ -5,11 +5,51 @@ import pytz
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Webhook mode: set WEBHOOK_URL to the public HTTPS URL Telegram should post updates to
+# (TLS terminated by a reverse proxy that forwards to WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH).
+# Without it the bot long-polls getUpdates.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")  # checked on every request
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
 DB_NAME = os.getenv("DB_NAME", "study_bot.db")
+# SQLite connection pool: one writer plus DB_READERS reader connections
+DB_READERS = int(os.getenv("DB_READERS", "3"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))  # page cache per connection
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))  # bytes
+# Group commit: small writes arriving within DB_WRITE_BATCH_MS share one transaction
+DB_WRITE_BATCH_MS = int(os.getenv("DB_WRITE_BATCH_MS", "5"))
+DB_WRITE_BATCH_MAX = int(os.getenv("DB_WRITE_BATCH_MAX", "100"))
+# In-process cache of users' daily task lists
+TIMELINE_CACHE_TTL = int(os.getenv("TIMELINE_CACHE_TTL", "300"))  # seconds
+TIMELINE_CACHE_MAX_KB = int(os.getenv("TIMELINE_CACHE_MAX_KB", "8192"))
+# Tasks older than ARCHIVE_AFTER_DAYS move to the archive database (0 keeps everything hot)
+ARCHIVE_DB_NAME = os.getenv("ARCHIVE_DB_NAME", os.path.splitext(DB_NAME)[0] + "_archive.db")
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+# Outbound message queue, kept under Telegram's ~30 msg/s and 1 msg/s per chat limits
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))  # messages per second
+OUTBOX_CHAT_INTERVAL = float(os.getenv("OUTBOX_CHAT_INTERVAL", "1"))  # seconds between messages to one chat
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", "3"))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8"))  # requests in flight
+# Updates handled at once; each user's updates are still handled one at a time, in order
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))
+# Users processed in parallel by the morning maintenance run
+MAINTENANCE_CONCURRENCY = int(os.getenv("MAINTENANCE_CONCURRENCY", "20"))
+# Only reminders firing within the next REMINDER_HORIZON_HOURS are kept in the reminders
+# table; a job tops it up every REMINDER_TOPUP_MINUTES (must be well under the horizon)
+REMINDER_HORIZON_HOURS = int(os.getenv("REMINDER_HORIZON_HOURS", "6"))
+REMINDER_TOPUP_MINUTES = int(os.getenv("REMINDER_TOPUP_MINUTES", "30"))
+# Telegram user ids allowed to use admin commands such as /perf, comma separated
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
 # Force timezone to UTC+5 (fixed offset to avoid timezone database issues)
 # Asia/Almaty sometimes shows UTC+6 in pytz, so we use fixed UTC+5 instead
 TIMEZONE_OFFSET = 5  # UTC+5 hours
 TIMEZONE = pytz.FixedOffset(TIMEZONE_OFFSET * 60)  # Fixed UTC+5 timezone object
+# users.timezone value every user gets by default; it maps to TIMEZONE above
+DEFAULT_TIMEZONE_NAME = "Asia/Almaty"
 
 # Conversation States
 TASK_NAME, TASK_TIME, TASK_PRIORITY, TASK_CATEGORY = range(4)
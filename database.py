@@ -1,113 +1,304 @@
 import aiosqlite
+import asyncio
+import bisect
+import functools
+import json
 import logging
-from config import DB_NAME
-from datetime import datetime
+from contextlib import asynccontextmanager
+from config import (
+    DB_NAME, DB_READERS, DB_CACHE_SIZE_KB, DB_MMAP_SIZE, DB_WRITE_BATCH_MS, DB_WRITE_BATCH_MAX,
+    ARCHIVE_DB_NAME, ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE
+)
+from datetime import datetime, timedelta
+import cache
+import metrics
+import utils
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                timezone TEXT DEFAULT 'Asia/Almaty',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                notification_enabled BOOLEAN DEFAULT 1
-            )
-        """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS tasks (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                task_name TEXT,
-                scheduled_time TEXT,
-                priority TEXT,
-                category TEXT,
-                status TEXT DEFAULT 'pending',
-                date TEXT,
-                FOREIGN KEY(user_id) REFERENCES users(user_id)
-            )
-        """)
-        
-        # New table for recurring templates
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS recurring_tasks (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                day_of_week TEXT,
-                task_name TEXT,
-                scheduled_time TEXT,
-                priority TEXT,
-                category TEXT
-            )
-        """)
-        await db.commit()
-        
-        # Run migrations to add new columns and tables
-        await migrate_database(db)
+# Shared connection pool: one writer plus a few readers, created by init_db()
+_write_conn = None
+_write_lock = None
+_read_pool = None
+_read_conns = []
 
-async def migrate_database(db):
-    """Migrate database schema to support new features"""
-    # Check and add columns to tasks table
-    try:
-        await db.execute("ALTER TABLE tasks ADD COLUMN duration INTEGER DEFAULT 0")
-    except Exception:
-        pass  # Column already exists
-    
-    try:
-        await db.execute("ALTER TABLE tasks ADD COLUMN notes TEXT DEFAULT ''")
-    except Exception:
-        pass
-    
-    try:
-        await db.execute("ALTER TABLE tasks ADD COLUMN tags TEXT DEFAULT ''")
-    except Exception:
-        pass
-    
+# Group commit: small writes are queued and committed together by one writer task
+_write_queue = None
+_write_worker = None
+
+# Cache entries (kind, key) changed by the running write transaction
+_touched_cache_keys = set()
+
+async def _open_connection():
+    """Open a pooled connection with WAL and cache tuning applied"""
+    db = await aiosqlite.connect(DB_NAME, isolation_level=None)
+    db.row_factory = aiosqlite.Row
+    for pragma in (
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = NORMAL",
+        f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}",
+        f"PRAGMA mmap_size = {DB_MMAP_SIZE}",
+        "PRAGMA temp_store = MEMORY",
+        "PRAGMA busy_timeout = 5000",
+    ):
+        async with db.execute(pragma):
+            pass
+    # Old tasks live in a separate file, see ARCHIVE DATABASE below
+    await db.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_NAME,))
+    for pragma in ("PRAGMA archive.journal_mode = WAL", "PRAGMA archive.synchronous = NORMAL"):
+        async with db.execute(pragma):
+            pass
+    for view in ARCHIVE_VIEWS:
+        await db.execute(view)
+    # Lets stats queries skip non-tasks (commute, lunch...) inside SQL
+    await db.create_function("is_real_task", 1, utils.is_real_task, deterministic=True)
+    return db
+
+@asynccontextmanager
+async def _read_connection():
+    """Borrow a reader connection from the pool"""
+    if _read_pool is None:
+        raise RuntimeError("Database pool is not initialised, call init_db() first")
+    db = await _read_pool.get()
     try:
-        await db.execute("ALTER TABLE tasks ADD COLUMN archived BOOLEAN DEFAULT 0")
-    except Exception:
-        pass
+        yield db
+    finally:
+        _read_pool.put_nowait(db)
+
+@asynccontextmanager
+async def _write_transaction():
+    """Run a block on the writer connection inside one transaction"""
+    if _write_conn is None:
+        raise RuntimeError("Database pool is not initialised, call init_db() first")
+    async with _write_lock:
+        await _write_conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield _write_conn
+        except BaseException:
+            await _write_conn.rollback()
+            raise
+        else:
+            await _write_conn.commit()
+        finally:
+            # Only now can readers see the write, so drop cached entries here
+            for kind, key in _touched_cache_keys:
+                cache.invalidate(kind, key)
+            _touched_cache_keys.clear()
+
+def _touch_timeline(user_id, date_str):
+    """Mark a user's cached timeline for a date stale once the transaction ends"""
+    _touched_cache_keys.add(("timeline", (user_id, date_str)))
+
+def _touch_profile(user_id):
+    """Mark a user's cached notification profile stale once the transaction ends"""
+    _touched_cache_keys.add(("profile", user_id))
+
+def _queued_write(func):
+    """Run a small write through the group-commit queue.
     
+    The decorated coroutine receives the writer connection as its first argument
+    (callers leave it out) and runs inside a savepoint of a shared transaction, so
+    its own error only rolls back its own changes. The caller gets its result or
+    exception once the batch has been committed.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if _write_queue is None:
+            raise RuntimeError("Database pool is not initialised, call init_db() first")
+        future = asyncio.get_running_loop().create_future()
+        op = lambda db: func(db, *args, **kwargs)
+        _write_queue.put_nowait((op, future))
+        metrics.set_gauge("db.write_queue_depth", _write_queue.qsize())
+        return await future
+    return wrapper
+
+async def _group_commit_worker():
+    """Drain the write queue, committing each batch of operations in one transaction"""
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        item = await _write_queue.get()
+        if item is None:
+            break
+        batch = [item]
+        # Give concurrent writers a few milliseconds to join this batch
+        deadline = loop.time() + DB_WRITE_BATCH_MS / 1000
+        while len(batch) < DB_WRITE_BATCH_MAX:
+            if not _write_queue.empty():
+                item = _write_queue.get_nowait()
+            else:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(_write_queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+        await _commit_batch(batch)
+        metrics.set_gauge("db.write_queue_depth", _write_queue.qsize())
+
+async def _commit_batch(batch):
+    outcomes = []
     try:
-        await db.execute("ALTER TABLE tasks ADD COLUMN created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
-    except Exception:
-        pass
+        async with _write_transaction() as db:
+            for op, future in batch:
+                await db.execute("SAVEPOINT queued_write")
+                try:
+                    result = await op(db)
+                except Exception as e:
+                    await db.execute("ROLLBACK TO queued_write")
+                    await db.execute("RELEASE queued_write")
+                    outcomes.append((future, None, e))
+                else:
+                    await db.execute("RELEASE queued_write")
+                    outcomes.append((future, result, None))
+    except Exception as e:
+        # The commit itself failed, nothing in this batch was written
+        logger.error(f"Group commit of {len(batch)} writes failed: {e}", exc_info=True)
+        outcomes = [(future, None, e) for _, future in batch]
     
-    try:
-        await db.execute("ALTER TABLE tasks ADD COLUMN updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
-    except Exception:
-        pass
+    metrics.inc("db.write_batches")
+    metrics.inc("db.queued_writes", len(batch))
+    metrics.observe("db.write_batch_size", len(batch))
+    for future, result, error in outcomes:
+        if future.done():
+            continue  # Caller gave up waiting
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+async def close_db():
+    """Flush queued writes and close every pooled connection (called on bot shutdown)"""
+    global _write_conn, _write_lock, _read_pool, _read_conns, _write_queue, _write_worker
+    if _write_conn is None:
+        return
+    if _write_worker is not None:
+        _write_queue.put_nowait(None)
+        await _write_worker
+        _write_worker = None
+        _write_queue = None
+    async with _write_lock:
+        for db in _read_conns:
+            await db.close()
+        # Fold the WAL back into the main file so the next start is clean
+        async with _write_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)"):
+            pass
+        await _write_conn.close()
+    _write_conn = None
+    _write_lock = None
+    _read_pool = None
+    _read_conns = []
+    cache.clear()
+    logger.info("Database connections closed")
+
+async def init_db(migrate=True):
+    """Create the connection pool and bring the schema up to date"""
+    global _write_conn, _write_lock, _read_pool, _read_conns, _write_queue, _write_worker
+    if _write_conn is not None:
+        return
+    _write_conn = await _open_connection()
+    _write_lock = asyncio.Lock()
+
+    if migrate:
+        await apply_migrations()
+
+    _read_conns = [await _open_connection() for _ in range(max(DB_READERS, 1))]
+    _read_pool = asyncio.Queue()
+    for db in _read_conns:
+        _read_pool.put_nowait(db)
     
-    # Check and add columns to users table
-    try:
-        await db.execute("ALTER TABLE users ADD COLUMN quiet_hours_start TEXT DEFAULT NULL")
-    except Exception:
-        pass
+    _write_queue = asyncio.Queue()
+    _write_worker = asyncio.create_task(_group_commit_worker())
+
+# ===== SCHEMA MIGRATIONS =====
+#
+# Each step runs once, in order, and PRAGMA user_version records the last one
+# applied. Databases created before versioning report version 0 and may already
+# contain part of any step, so steps check for what exists instead of relying
+# on errors.
+
+async def _get_user_version(db, schema="main"):
+    async with db.execute(f"PRAGMA {schema}.user_version") as cursor:
+        return (await cursor.fetchone())[0]
+
+async def _has_column(db, table, column):
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        return any(row['name'] == column for row in await cursor.fetchall())
+
+async def _add_column(db, table, column, definition):
+    """Add a column unless it is already there, returns True if it was added"""
+    if await _has_column(db, table, column):
+        return False
+    await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+async def _migrate_base_tables(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            timezone TEXT DEFAULT 'Asia/Almaty',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            notification_enabled BOOLEAN DEFAULT 1
+        )
+    """)
     
-    try:
-        await db.execute("ALTER TABLE users ADD COLUMN quiet_hours_end TEXT DEFAULT NULL")
-    except Exception:
-        pass
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            task_name TEXT,
+            scheduled_time TEXT,
+            priority TEXT,
+            category TEXT,
+            status TEXT DEFAULT 'pending',
+            date TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+    """)
     
-    try:
-        await db.execute("ALTER TABLE users ADD COLUMN notification_1h BOOLEAN DEFAULT 1")
-    except Exception:
-        pass
+    # New table for recurring templates
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS recurring_tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            day_of_week TEXT,
+            task_name TEXT,
+            scheduled_time TEXT,
+            priority TEXT,
+            category TEXT
+        )
+    """)
+
+async def _migrate_feature_columns(db):
+    await _add_column(db, "tasks", "duration", "INTEGER DEFAULT 0")
+    await _add_column(db, "tasks", "notes", "TEXT DEFAULT ''")
+    await _add_column(db, "tasks", "tags", "TEXT DEFAULT ''")
+    await _add_column(db, "tasks", "archived", "BOOLEAN DEFAULT 0")
     
-    try:
-        await db.execute("ALTER TABLE users ADD COLUMN notification_30m BOOLEAN DEFAULT 1")
-    except Exception:
-        pass
+    # SQLite refuses a CURRENT_TIMESTAMP default on a non-empty table, which the old
+    # unversioned migration silently ignored; fall back to a backfilled plain column.
+    # Without the default, every INSERT INTO tasks sets both columns itself.
+    async with db.execute("SELECT EXISTS(SELECT 1 FROM tasks)") as cursor:
+        has_tasks = (await cursor.fetchone())[0]
+    for column in ("created_at", "updated_at"):
+        if has_tasks:
+            if await _add_column(db, "tasks", column, "TIMESTAMP"):
+                await db.execute(f"UPDATE tasks SET {column} = CURRENT_TIMESTAMP")
+        else:
+            await _add_column(db, "tasks", column, "TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
     
-    try:
-        await db.execute("ALTER TABLE users ADD COLUMN notification_start BOOLEAN DEFAULT 1")
-    except Exception:
-        pass
+    await _add_column(db, "users", "quiet_hours_start", "TEXT DEFAULT NULL")
+    await _add_column(db, "users", "quiet_hours_end", "TEXT DEFAULT NULL")
+    await _add_column(db, "users", "notification_1h", "BOOLEAN DEFAULT 1")
+    await _add_column(db, "users", "notification_30m", "BOOLEAN DEFAULT 1")
+    await _add_column(db, "users", "notification_start", "BOOLEAN DEFAULT 1")
     
-    # Create new tables
     await db.execute("""
         CREATE TABLE IF NOT EXISTS goals (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -167,362 +358,835 @@ async def migrate_database(db):
             FOREIGN KEY(task_id) REFERENCES tasks(id)
         )
     """)
-    
-    await db.commit()
 
-async def add_user(user_id, timezone="Asia/Almaty"):
-    async with aiosqlite.connect(DB_NAME) as db:
+async def _migrate_is_real(db):
+    # Real task flag (not commute, lunch...), computed when a row is written
+    for table in ("tasks", "recurring_tasks"):
+        if await _add_column(db, table, "is_real", "BOOLEAN DEFAULT NULL"):
+            # Classify existing rows once
+            await db.execute(f"UPDATE {table} SET is_real = is_real_task(task_name)")
+
+# Composite indexes for the hot query paths, see HOT_QUERIES below
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_tasks_user_date_time ON tasks(user_id, date, scheduled_time)",
+    "CREATE INDEX IF NOT EXISTS idx_tasks_user_date_status ON tasks(user_id, date, status, scheduled_time)",
+    "CREATE INDEX IF NOT EXISTS idx_tasks_user_status_date ON tasks(user_id, status, date)",
+    "CREATE INDEX IF NOT EXISTS idx_tasks_user_date_real ON tasks(user_id, date, is_real, status, scheduled_time)",
+    "CREATE INDEX IF NOT EXISTS idx_tasks_user_archived ON tasks(user_id, archived, date, scheduled_time)",
+    "CREATE INDEX IF NOT EXISTS idx_recurring_user_day ON recurring_tasks(user_id, day_of_week, scheduled_time)",
+    "CREATE INDEX IF NOT EXISTS idx_task_tags_tag ON task_tags(tag_name, task_id)",
+    "CREATE INDEX IF NOT EXISTS idx_task_tags_task ON task_tags(task_id, tag_name)",
+    "CREATE INDEX IF NOT EXISTS idx_goals_user_target ON goals(user_id, target_date)",
+]
+
+async def _migrate_indexes(db):
+    """Create the hot-path indexes, including the unique daily task name index"""
+    async with db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'ux_tasks_user_date_name'"
+    ) as cursor:
+        has_unique = await cursor.fetchone()
+    
+    if not has_unique:
+        # Older versions could generate the same recurring task twice for a day;
+        # keep one copy so the unique index can be built: the completed one if any,
+        # else the most recent, and move the tags of the others onto it
         await db.execute(
-            "INSERT OR IGNORE INTO users (user_id, timezone) VALUES (?, ?)",
-            (user_id, timezone)
+            """CREATE TEMP TABLE task_duplicates AS
+               SELECT id, keep_id FROM (
+                   SELECT id, FIRST_VALUE(id) OVER (
+                       PARTITION BY user_id, date, task_name
+                       ORDER BY status = 'done' DESC, id DESC
+                   ) AS keep_id
+                   FROM tasks
+               ) WHERE id != keep_id"""
         )
-        await db.commit()
-
-async def add_task(user_id, task_name, scheduled_time, priority, category, date_str):
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute(
-            """INSERT INTO tasks 
-               (user_id, task_name, scheduled_time, priority, category, date) 
-               VALUES (?, ?, ?, ?, ?, ?) RETURNING id""",
-            (user_id, task_name, scheduled_time, priority, category, date_str)
+        await db.execute(
+            """INSERT INTO task_tags (task_id, tag_name)
+               SELECT DISTINCT d.keep_id, tt.tag_name
+               FROM task_tags tt JOIN temp.task_duplicates d ON tt.task_id = d.id
+               WHERE NOT EXISTS (
+                   SELECT 1 FROM task_tags kept WHERE kept.task_id = d.keep_id AND kept.tag_name = tt.tag_name
+               )"""
+        )
+        await db.execute("DELETE FROM task_tags WHERE task_id IN (SELECT id FROM temp.task_duplicates)")
+        async with db.execute(
+            "DELETE FROM tasks WHERE id IN (SELECT id FROM temp.task_duplicates) RETURNING id"
+        ) as cursor:
+            removed = await cursor.fetchall()
+        await db.execute("DROP TABLE temp.task_duplicates")
+        if removed:
+            logger.warning(f"Removed {len(removed)} duplicate tasks before adding unique index")
+        await db.execute(
+            "CREATE UNIQUE INDEX ux_tasks_user_date_name ON tasks(user_id, date, task_name)"
         )
-        task_id = (await cursor.fetchone())[0]
-        await db.commit()
-        return task_id
+    
+    for statement in INDEXES:
+        await db.execute(statement)
 
-async def get_tasks(user_id, date_str):
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            "SELECT * FROM tasks WHERE user_id = ? AND date = ? ORDER BY scheduled_time",
-            (user_id, date_str)
+async def _migrate_daily_rollup(db):
+    """Create the daily_rollup table and backfill it from tasks"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS daily_rollup (
+            user_id INTEGER,
+            date TEXT,
+            category TEXT,
+            total INTEGER DEFAULT 0,
+            done INTEGER DEFAULT 0,
+            real_total INTEGER DEFAULT 0,
+            real_done INTEGER DEFAULT 0,
+            PRIMARY KEY(user_id, date, category)
         )
-        return await cursor.fetchall()
+    """)
+    await _rebuild_rollup(db)
 
-async def update_task_status(task_id, status):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("UPDATE tasks SET status = ? WHERE id = ?", (status, task_id))
-        await db.commit()
+async def _migrate_reminders(db):
+    # Pending 1h/30m/start reminders; the minute dispatcher takes the due ones.
+    # fire_at is a UTC epoch timestamp, so each tick is one range scan on its index.
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS reminders (
+            task_id INTEGER,
+            reminder_type TEXT,
+            chat_id INTEGER,
+            task_name TEXT,
+            fire_at INTEGER,
+            PRIMARY KEY (task_id, reminder_type)
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_reminders_fire_at ON reminders(fire_at)")
 
-async def add_recurring_template(user_id, day, name, time, priority, category):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            """INSERT INTO recurring_tasks 
-               (user_id, day_of_week, task_name, scheduled_time, priority, category) 
-               VALUES (?, ?, ?, ?, ?, ?)""",
-            (user_id, day, name, time, priority, category)
+async def _migrate_maintenance_progress(db):
+    # Users still waiting for their morning run, so a restart resumes instead of starting over
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS maintenance_progress (
+            run_date TEXT,
+            user_id INTEGER,
+            created INTEGER,
+            done BOOLEAN DEFAULT 0,
+            PRIMARY KEY (run_date, user_id)
         )
-        await db.commit()
+    """)
+
+async def _migrate_reminders_chat_index(db):
+    # Settings changes cancel a user's reminders by chat
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_reminders_chat ON reminders(chat_id, reminder_type)")
+
+async def _migrate_tasks_date_index(db):
+    # The reminder top-up scans upcoming tasks of every user by date and time
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_date_time ON tasks(date, scheduled_time)")
+
+async def _migrate_users_timezone_index(db):
+    # Maintenance buckets users by timezone
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_timezone ON users(timezone)")
+
+async def _migrate_drop_unused_task_indexes(db):
+    # No hot query reads these since statistics come from daily_rollup, and every
+    # status change had to update them; idx_tasks_user_date_time covers the rollup refresh
+    for name in ("idx_tasks_user_date_status", "idx_tasks_user_status_date", "idx_tasks_user_date_real"):
+        await db.execute(f"DROP INDEX IF EXISTS {name}")
+
+# (version, description, step) - append new steps, never reorder or edit old ones
+MIGRATIONS = [
+    (1, "users, tasks and recurring_tasks tables", _migrate_base_tables),
+    (2, "task details, notification settings, goals, journal, categories and tags", _migrate_feature_columns),
+    (3, "is_real flag on tasks and recurring_tasks", _migrate_is_real),
+    (4, "hot-path indexes and unique daily task names", _migrate_indexes),
+    (5, "daily_rollup statistics table", _migrate_daily_rollup),
+    (6, "persistent reminders table", _migrate_reminders),
+    (7, "daily maintenance progress table", _migrate_maintenance_progress),
+    (8, "reminders index by chat", _migrate_reminders_chat_index),
+    (9, "tasks index by date for the reminder horizon", _migrate_tasks_date_index),
+    (10, "users index by timezone", _migrate_users_timezone_index),
+    (11, "drop task indexes no query uses", _migrate_drop_unused_task_indexes),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+async def get_pending_migrations():
+    """Return (current_version, [(version, description), ...]) still to apply.
+    
+    Pending archive steps come first, their versions prefixed with "archive.".
+    """
+    if _write_conn is None:
+        raise RuntimeError("Database pool is not initialised, call init_db() first")
+    version = await _get_user_version(_write_conn)
+    archive_version = await _get_user_version(_write_conn, "archive")
+    pending = [(f"archive.{v}", description) for v, description, _ in ARCHIVE_MIGRATIONS if v > archive_version]
+    pending += [(v, description) for v, description, _ in MIGRATIONS if v > version]
+    return version, pending
+
+async def apply_migrations():
+    """Apply every pending migration in one transaction, returns the versions applied"""
+    version, pending = await get_pending_migrations()
+    if version > SCHEMA_VERSION:
+        logger.warning(f"Database schema v{version} is newer than this code (v{SCHEMA_VERSION})")
+    if not pending:
+        return []
+    
+    async with _write_transaction() as db:
+        # Re-read under the write lock in case another process migrated meanwhile
+        applied = []
+        archive_version = await _get_user_version(db, "archive")
+        for step_version, description, step in ARCHIVE_MIGRATIONS:
+            if step_version <= archive_version:
+                continue
+            logger.info(f"Applying archive migration {step_version}: {description}")
+            await step(db)
+            applied.append(f"archive.{step_version}")
+        await db.execute(f"PRAGMA archive.user_version = {ARCHIVE_SCHEMA_VERSION}")
+        
+        version = await _get_user_version(db)
+        for step_version, description, step in MIGRATIONS:
+            if step_version <= version:
+                continue
+            logger.info(f"Applying migration {step_version}: {description}")
+            await step(db)
+            applied.append(step_version)
+        await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    return applied
+
+# ===== ARCHIVE DATABASE =====
+#
+# Tasks older than ARCHIVE_AFTER_DAYS are moved to a separate SQLite file attached
+# as "archive" on every connection, keeping the hot tasks table and its indexes
+# small. The daily_rollup stays in the hot database, so statistics and streaks
+# never read the archive. Readers that need history use the all_tasks view.
+# The archive copies the tasks columns explicitly: a migration that adds a tasks
+# column must add it to TASK_COLUMNS and the archive table as well.
+
+TASK_COLUMNS = (
+    "id, user_id, task_name, scheduled_time, priority, category, status, date, "
+    "duration, notes, tags, archived, created_at, updated_at, is_real"
+)
+
+ARCHIVE_TABLES = [
+    """CREATE TABLE IF NOT EXISTS archive.tasks (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        task_name TEXT,
+        scheduled_time TEXT,
+        priority TEXT,
+        category TEXT,
+        status TEXT,
+        date TEXT,
+        duration INTEGER,
+        notes TEXT,
+        tags TEXT,
+        archived BOOLEAN,
+        created_at TIMESTAMP,
+        updated_at TIMESTAMP,
+        is_real BOOLEAN
+    )""",
+    """CREATE TABLE IF NOT EXISTS archive.task_tags (
+        id INTEGER PRIMARY KEY,
+        task_id INTEGER,
+        tag_name TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS archive.idx_tasks_user_date_time ON tasks(user_id, date, scheduled_time)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_tasks_user_archived ON tasks(user_id, archived, date, scheduled_time)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_task_tags_tag ON task_tags(tag_name, task_id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_task_tags_task ON task_tags(task_id, tag_name)",
+]
+
+# Per-connection views over hot and archived rows
+ARCHIVE_VIEWS = [
+    f"""CREATE TEMP VIEW IF NOT EXISTS all_tasks AS
+        SELECT {TASK_COLUMNS} FROM main.tasks
+        UNION ALL
+        SELECT {TASK_COLUMNS} FROM archive.tasks""",
+    """CREATE TEMP VIEW IF NOT EXISTS all_task_tags AS
+        SELECT id, task_id, tag_name FROM main.task_tags
+        UNION ALL
+        SELECT id, task_id, tag_name FROM archive.task_tags""",
+]
+
+async def _migrate_archive_tables(db):
+    for statement in ARCHIVE_TABLES:
+        await db.execute(statement)
+
+# The archive is a file of its own that can be moved away or start out empty next to
+# an up-to-date database, so its steps are tracked by PRAGMA archive.user_version.
+# They run before MIGRATIONS, whose rollup steps read the all_tasks view.
+ARCHIVE_MIGRATIONS = [
+    (1, "archived tasks and task_tags tables", _migrate_archive_tables),
+]
+ARCHIVE_SCHEMA_VERSION = ARCHIVE_MIGRATIONS[-1][0]
+
+# Oldest tasks first, straight from the date index; moved rows are deleted, so
+# every batch starts again from the front
+SELECT_ARCHIVE_BATCH = "SELECT id FROM main.tasks WHERE date < ? ORDER BY date, scheduled_time LIMIT ?"
+
+async def move_tasks_to_archive(before_date, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move tasks dated before before_date into the archive, returns how many were moved.
+    
+    Each batch is its own short transaction so queued writes get the writer in
+    between. Rows are copied before they are deleted; WAL commits are not atomic
+    across attached files, so a crash in between leaves a copy that the next run
+    skips (INSERT OR IGNORE) before finishing the delete.
+    """
+    moved = 0
+    while True:
+        async with _write_transaction() as db:
+            async with db.execute(SELECT_ARCHIVE_BATCH, (before_date, batch_size)) as cursor:
+                ids = [row['id'] for row in await cursor.fetchall()]
+            if not ids:
+                break
+            ids_json = json.dumps(ids)
+            await db.execute(
+                f"""INSERT OR IGNORE INTO archive.tasks ({TASK_COLUMNS})
+                    SELECT {TASK_COLUMNS} FROM main.tasks WHERE id IN (SELECT value FROM json_each(?))""",
+                (ids_json,)
+            )
+            await db.execute(
+                """INSERT OR IGNORE INTO archive.task_tags (id, task_id, tag_name)
+                   SELECT id, task_id, tag_name FROM main.task_tags
+                   WHERE task_id IN (SELECT value FROM json_each(?))""",
+                (ids_json,)
+            )
+            await db.execute(
+                "DELETE FROM main.task_tags WHERE task_id IN (SELECT value FROM json_each(?))",
+                (ids_json,)
+            )
+            async with db.execute(
+                "DELETE FROM main.tasks WHERE id IN (SELECT value FROM json_each(?)) RETURNING user_id, date",
+                (ids_json,)
+            ) as cursor:
+                for row in await cursor.fetchall():
+                    _touch_timeline(row['user_id'], row['date'])
+        moved += len(ids)
+        metrics.inc("db.archived_tasks", len(ids))
+    if moved:
+        logger.info(f"Moved {moved} tasks dated before {before_date} to the archive")
+    return moved
+
+# ===== DAILY ROLLUP =====
+
+# Per user/day/category counters so statistics never re-aggregate raw task history.
+# NULL categories are stored as '' because they are part of the primary key.
+# Reading all_tasks keeps archived days in a refresh, rebuild or verify.
+ROLLUP_SELECT = """
+    SELECT user_id, date, COALESCE(category, '') AS category,
+           COUNT(*) AS total,
+           SUM(status = 'done') AS done,
+           SUM(COALESCE(is_real, is_real_task(task_name))) AS real_total,
+           SUM(COALESCE(is_real, is_real_task(task_name)) AND status = 'done') AS real_done
+    FROM all_tasks
+"""
+
+DELETE_ROLLUP_DAY = "DELETE FROM daily_rollup WHERE user_id = ? AND date = ?"
+INSERT_ROLLUP_DAY = f"""INSERT INTO daily_rollup (user_id, date, category, total, done, real_total, real_done)
+            {ROLLUP_SELECT}
+            WHERE user_id = ? AND date = ?
+            GROUP BY COALESCE(category, '')"""
+
+async def _refresh_rollup(db, user_id, date_str):
+    """Recompute one user's rollup rows for a date, inside the caller's transaction"""
+    await db.execute(DELETE_ROLLUP_DAY, (user_id, date_str))
+    await db.execute(INSERT_ROLLUP_DAY, (user_id, date_str))
+
+async def _refresh_rollup_users(db, user_ids, date_str):
+    """Set-based _refresh_rollup for many users on the same date.
+    
+    Only used for freshly generated days, which are never archived; an IN list
+    is not pushed down into the all_tasks view, so this reads the hot table.
+    """
+    user_ids_json = json.dumps(list(user_ids))
+    await db.execute(
+        "DELETE FROM daily_rollup WHERE date = ? AND user_id IN (SELECT value FROM json_each(?))",
+        (date_str, user_ids_json)
+    )
+    await db.execute(
+        f"""INSERT INTO daily_rollup (user_id, date, category, total, done, real_total, real_done)
+            {ROLLUP_SELECT.replace("FROM all_tasks", "FROM main.tasks")}
+            WHERE date = ? AND user_id IN (SELECT value FROM json_each(?))
+            GROUP BY user_id, COALESCE(category, '')""",
+        (date_str, user_ids_json)
+    )
+
+async def _rebuild_rollup(db):
+    await db.execute("DELETE FROM daily_rollup")
+    await db.execute(
+        f"""INSERT INTO daily_rollup (user_id, date, category, total, done, real_total, real_done)
+            {ROLLUP_SELECT}
+            GROUP BY user_id, date, COALESCE(category, '')"""
+    )
+
+async def rebuild_rollup():
+    """Recompute the whole rollup from raw tasks"""
+    async with _write_transaction() as db:
+        await _rebuild_rollup(db)
+
+async def verify_rollup():
+    """Compare the rollup with raw tasks, returns the rows that drifted"""
+    async with _read_connection() as db:
+        async with db.execute(
+            f"""WITH expected AS ({ROLLUP_SELECT} GROUP BY user_id, date, COALESCE(category, '')),
+                     stored AS (
+                         SELECT user_id, date, category, total, done, real_total, real_done
+                         FROM daily_rollup
+                     )
+                SELECT 'tasks' AS source, * FROM (SELECT * FROM expected EXCEPT SELECT * FROM stored)
+                UNION ALL
+                SELECT 'rollup' AS source, * FROM (SELECT * FROM stored EXCEPT SELECT * FROM expected)
+                ORDER BY user_id, date, category, source"""
+        ) as cursor:
+            return [dict(row) for row in await cursor.fetchall()]
+
+@_queued_write
+async def add_user(db, user_id, timezone="Asia/Almaty"):
+    await db.execute(
+        "INSERT OR IGNORE INTO users (user_id, timezone) VALUES (?, ?)",
+        (user_id, timezone)
+    )
+    _touch_profile(user_id)
+
+@_queued_write
+async def add_task(db, user_id, task_name, scheduled_time, priority, category, date_str):
+    """Add a task for a date, returns None if a task with this name already exists that day"""
+    async with db.execute(
+        """INSERT INTO tasks 
+           (user_id, task_name, scheduled_time, priority, category, date, is_real, created_at, updated_at) 
+           VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+           ON CONFLICT(user_id, date, task_name) DO NOTHING
+           RETURNING id""",
+        (user_id, task_name, scheduled_time, priority, category, date_str, utils.is_real_task(task_name))
+    ) as cursor:
+        row = await cursor.fetchone()
+    if row:
+        await _refresh_rollup(db, user_id, date_str)
+        _touch_timeline(user_id, date_str)
+    return row[0] if row else None
+
+SELECT_TIMELINE = "SELECT * FROM tasks WHERE user_id = ? AND date = ? ORDER BY scheduled_time"
+
+async def _get_timeline(user_id, date_str):
+    """All of a user's tasks for a date sorted by time, served from the timeline cache"""
+    timeline = cache.get("timeline", (user_id, date_str))
+    if timeline is None:
+        generation = cache.generation()
+        async with _read_connection() as db:
+            async with db.execute(SELECT_TIMELINE, (user_id, date_str)) as cursor:
+                timeline = cache.freeze(await cursor.fetchall())
+        cache.put("timeline", (user_id, date_str), timeline, generation)
+    return timeline
+
+async def get_tasks(user_id, date_str, real_only=False):
+    """Get a user's tasks for a date; real_only skips non-tasks (commute, lunch...)"""
+    timeline = await _get_timeline(user_id, date_str)
+    if real_only:
+        return [t for t in timeline if utils.task_is_real(t)]
+    return list(timeline)
+
+@_queued_write
+async def update_task_status(db, task_id, status):
+    async with db.execute(
+        "UPDATE tasks SET status = ? WHERE id = ? RETURNING user_id, date",
+        (status, task_id)
+    ) as cursor:
+        row = await cursor.fetchone()
+    if row:
+        await _refresh_rollup(db, row['user_id'], row['date'])
+        _touch_timeline(row['user_id'], row['date'])
+        if status == 'done':
+            await _cancel_reminders(db, task_id)
+
+@_queued_write
+async def add_recurring_template(db, user_id, day, name, time, priority, category):
+    await db.execute(
+        """INSERT INTO recurring_tasks 
+           (user_id, day_of_week, task_name, scheduled_time, priority, category, is_real) 
+           VALUES (?, ?, ?, ?, ?, ?, ?)""",
+        (user_id, day, name, time, priority, category, utils.is_real_task(name))
+    )
 
 async def generate_daily_tasks_from_recurring(user_id, target_date_obj):
+    created = await generate_daily_tasks_bulk(target_date_obj, [user_id])
+    return created.get(user_id, 0)
+
+# Copy a day's templates; the unique (user_id, date, task_name) index skips existing tasks
+INSERT_DAILY_TASKS = """INSERT INTO tasks 
+                   (user_id, task_name, scheduled_time, priority, category, date, status, is_real,
+                    created_at, updated_at) 
+                   SELECT user_id, task_name, scheduled_time, priority, category, ?, 'pending',
+                          COALESCE(is_real, is_real_task(task_name)), CURRENT_TIMESTAMP, CURRENT_TIMESTAMP
+                   FROM recurring_tasks
+                   WHERE day_of_week = ? AND {user_filter}
+                   ORDER BY id
+                   ON CONFLICT(user_id, date, task_name) DO NOTHING
+                   RETURNING user_id"""
+# Which users INSERT_DAILY_TASKS covers: timezones (json list, NULL wanted), everyone, or ids (json list)
+DAILY_TASKS_BY_TIMEZONE = """user_id IN (SELECT user_id FROM users
+                                         WHERE timezone IN (SELECT value FROM json_each(?))
+                                            OR (timezone IS NULL AND ?))"""
+DAILY_TASKS_ALL_USERS = "user_id IN (SELECT user_id FROM users)"
+DAILY_TASKS_BY_ID = "user_id IN (SELECT value FROM json_each(?))"
+
+async def generate_daily_tasks_bulk(target_date_obj, user_ids=None, batch_size=500, track_progress=False,
+                                    timezones=None):
+    """Generate a date's tasks from recurring templates for many users at once.
+    
+    Without user_ids every registered user (or every user whose users.timezone is in
+    timezones, '' standing for NULL) is handled in one statement, otherwise users are
+    processed batch_size at a time, one transaction per batch.
+    With track_progress the users that got tasks are recorded in maintenance_progress
+    in the same transaction, see get_pending_maintenance.
+    Returns {user_id: created_count} for the users that got new tasks.
+    """
     day_name = target_date_obj.strftime("%A").upper() # MONDAY, TUESDAY...
     date_str = target_date_obj.strftime("%Y-%m-%d")
     
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        # Get templates for this day of week for this user
-        async with db.execute("SELECT * FROM recurring_tasks WHERE user_id = ? AND day_of_week = ?", (user_id, day_name)) as cursor:
-            templates = await cursor.fetchall()
+    if user_ids is None:
+        batches = [None]
+    else:
+        user_ids = list(user_ids)
+        batches = [user_ids[i:i + batch_size] for i in range(0, len(user_ids), batch_size)]
+    
+    created = {}
+    for batch in batches:
+        if batch is None and timezones is not None:
+            user_filter = DAILY_TASKS_BY_TIMEZONE
+            params = (date_str, day_name, json.dumps(list(timezones)), '' in timezones)
+        elif batch is None:
+            user_filter = DAILY_TASKS_ALL_USERS
+            params = (date_str, day_name)
+        else:
+            user_filter = DAILY_TASKS_BY_ID
+            params = (date_str, day_name, json.dumps(batch))
+        
+        async with _write_transaction() as db:
+            async with db.execute(INSERT_DAILY_TASKS.format(user_filter=user_filter), params) as cursor:
+                rows = await cursor.fetchall()
             
-            created_count = 0
-            for t in templates:
-                # Check if already exists to prevent duplicates
-                check = await db.execute(
-                    "SELECT id FROM tasks WHERE user_id = ? AND date = ? AND task_name = ?",
-                    (user_id, date_str, t['task_name'])
-                )
-                if not await check.fetchone():
-                    await db.execute(
-                        """INSERT INTO tasks 
-                           (user_id, task_name, scheduled_time, priority, category, date, status) 
-                           VALUES (?, ?, ?, ?, ?, ?, 'pending')""",
-                        (user_id, t['task_name'], t['scheduled_time'], t['priority'], t['category'], date_str)
+            batch_created = {}
+            for row in rows:
+                batch_created[row['user_id']] = batch_created.get(row['user_id'], 0) + 1
+            if batch_created:
+                await _refresh_rollup_users(db, batch_created, date_str)
+                for user_id in batch_created:
+                    _touch_timeline(user_id, date_str)
+                if track_progress:
+                    await db.executemany(
+                        """INSERT OR IGNORE INTO maintenance_progress (run_date, user_id, created)
+                           VALUES (?, ?, ?)""",
+                        [(date_str, user_id, count) for user_id, count in batch_created.items()]
                     )
-                    created_count += 1
-            
-            await db.commit()
-            return created_count
+        created.update(batch_created)
+    return created
+
+SELECT_PENDING_MAINTENANCE = "SELECT user_id, created FROM maintenance_progress WHERE run_date = ? AND done = 0"
+
+async def get_pending_maintenance(date_str):
+    """Users whose morning run for a date has not finished, as (user_id, created) rows"""
+    async with _read_connection() as db:
+        async with db.execute(SELECT_PENDING_MAINTENANCE, (date_str,)) as cursor:
+            return await cursor.fetchall()
+
+@_queued_write
+async def mark_maintenance_done(db, date_str, user_id):
+    await db.execute(
+        "UPDATE maintenance_progress SET done = 1 WHERE run_date = ? AND user_id = ?",
+        (date_str, user_id)
+    )
+
+@_queued_write
+async def prune_maintenance_progress(db, before_date):
+    """Forget progress of runs before a date"""
+    await db.execute("DELETE FROM maintenance_progress WHERE run_date < ?", (before_date,))
+
+SELECT_USER_TIMEZONES = "SELECT DISTINCT timezone FROM users"
+
+async def get_user_timezones():
+    """Distinct users.timezone values, '' for users without one"""
+    async with _read_connection() as db:
+        async with db.execute(SELECT_USER_TIMEZONES) as cursor:
+            return [row['timezone'] or '' for row in await cursor.fetchall()]
 
 async def get_all_users():
     """Fetch all user IDs to schedule daily maintenance for everyone"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+    async with _read_connection() as db:
         async with db.execute("SELECT user_id FROM users") as cursor:
             rows = await cursor.fetchall()
             return [row['user_id'] for row in rows]
 
+SELECT_TASK_BY_ID = "SELECT * FROM tasks WHERE id = ?"
+
 async def get_task_by_id(task_id):
     """Get a task by its ID"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT * FROM tasks WHERE id = ?", (task_id,))
+    async with _read_connection() as db:
+        cursor = await db.execute(SELECT_TASK_BY_ID, (task_id,))
         return await cursor.fetchone()
 
 async def get_pending_tasks(user_id, date_str):
     """Get all pending tasks for a user on a specific date"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            "SELECT * FROM tasks WHERE user_id = ? AND date = ? AND status = 'pending' ORDER BY scheduled_time",
-            (user_id, date_str)
-        )
-        return await cursor.fetchall()
+    timeline = await _get_timeline(user_id, date_str)
+    return [t for t in timeline if t['status'] == 'pending']
 
-async def get_incomplete_tasks(user_id, date_str, current_time_str):
+async def get_incomplete_tasks(user_id, date_str, current_time_str, real_only=False):
     """Get tasks that have passed their scheduled time but are still pending"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            """SELECT * FROM tasks 
-               WHERE user_id = ? AND date = ? AND status = 'pending' 
-               AND scheduled_time < ? 
-               ORDER BY scheduled_time""",
-            (user_id, date_str, current_time_str)
-        )
-        return await cursor.fetchall()
+    timeline = await _get_timeline(user_id, date_str)
+    return [
+        t for t in timeline
+        if t['status'] == 'pending' and t['scheduled_time'] < current_time_str
+        and (not real_only or utils.task_is_real(t))
+    ]
+
+# Today's real tasks and total real tasks completed (all time)
+SELECT_STATS_TOTALS = """SELECT SUM(CASE WHEN date = ? THEN real_total ELSE 0 END) AS today_total,
+                      SUM(CASE WHEN date = ? THEN real_done ELSE 0 END) AS today_done,
+                      SUM(real_done) AS total_completed
+               FROM daily_rollup WHERE user_id = ?"""
+
+# Streak: fully completed days (counting only days with real tasks, up to today)
+# after the most recent incomplete one. An unfinished today is left out.
+SELECT_STATS_STREAK = """WITH days AS (
+                   SELECT date, SUM(real_total) AS total, SUM(real_done) AS done
+                   FROM daily_rollup
+                   WHERE user_id = ? AND date <= ? AND date <= ?
+                   GROUP BY date
+                   HAVING SUM(real_total) > 0
+               ),
+               counted AS (
+                   SELECT date, total, done FROM days WHERE NOT (date = ? AND done < total)
+               )
+               SELECT COUNT(*) FROM counted
+               WHERE date > COALESCE((SELECT MAX(date) FROM counted WHERE done < total), '')"""
 
 async def get_user_stats(user_id, date_str):
     """Get statistics for a user: today's completion, current streak, total tasks completed"""
-    import utils
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+    today = utils.get_today_str(await get_user_timezone(user_id))
+    async with _read_connection() as db:
+        async with db.execute(SELECT_STATS_TOTALS, (date_str, date_str, user_id)) as cursor:
+            totals = await cursor.fetchone()
         
-        # Get all today's tasks and filter out non-tasks
-        cursor = await db.execute(
-            "SELECT * FROM tasks WHERE user_id = ? AND date = ?",
-            (user_id, date_str)
-        )
-        all_today_tasks = await cursor.fetchall()
-        today_tasks = utils.filter_real_tasks(all_today_tasks)
-        today_total = len(today_tasks)
-        today_done = sum(1 for t in today_tasks if t['status'] == 'done')
-        
-        # Total tasks completed (all time) - filter out non-tasks
-        cursor = await db.execute(
-            "SELECT * FROM tasks WHERE user_id = ? AND status = 'done'",
-            (user_id,)
-        )
-        all_completed = await cursor.fetchall()
-        completed_tasks = utils.filter_real_tasks(all_completed)
-        total_completed = len(completed_tasks)
-        
-        # Calculate streak (consecutive days with 100% completion)
-        # Get all dates with tasks, ordered by date descending
-        cursor = await db.execute(
-            """SELECT date, 
-                      COUNT(*) as total,
-                      SUM(CASE WHEN status = 'done' THEN 1 ELSE 0 END) as done
-               FROM tasks 
-               WHERE user_id = ? AND date <= ?
-               GROUP BY date 
-               ORDER BY date DESC""",
-            (user_id, date_str)
-        )
-        all_days = await cursor.fetchall()
-        
-        streak = 0
-        from datetime import datetime, timedelta
-        import pytz
-        from config import TIMEZONE
-        # TIMEZONE is now a timezone object, not a string
-        tz = TIMEZONE
-        # Get UTC time first, then convert to target timezone to avoid system timezone issues
-        today = datetime.now(pytz.utc).astimezone(tz).date()
-        
-        # For streak calculation, we need to check each day's real tasks
-        for day in all_days:
-            day_date = datetime.strptime(day['date'], "%Y-%m-%d").date()
-            # Only count today and past days, not future
-            if day_date > today:
-                continue
-            
-            # Get tasks for this day and filter
-            cursor = await db.execute(
-                "SELECT * FROM tasks WHERE user_id = ? AND date = ?",
-                (user_id, day['date'])
-            )
-            day_tasks = await cursor.fetchall()
-            real_tasks = utils.filter_real_tasks(day_tasks)
-            
-            if not real_tasks:
-                continue  # Skip days with no real tasks
-            
-            real_done = sum(1 for t in real_tasks if t['status'] == 'done')
-            real_total = len(real_tasks)
-            
-            # Skip today for streak calculation if it's not 100% complete
-            if day_date == today and real_done < real_total:
-                continue
-            # If this day is 100% complete, increment streak
-            if real_done == real_total and real_total > 0:
-                streak += 1
-            else:
-                break
+        async with db.execute(SELECT_STATS_STREAK, (user_id, date_str, today, today)) as cursor:
+            streak = (await cursor.fetchone())[0]
         
         return {
-            'today_total': today_total,
-            'today_done': today_done,
-            'total_completed': total_completed,
+            'today_total': totals['today_total'] or 0,
+            'today_done': totals['today_done'] or 0,
+            'total_completed': totals['total_completed'] or 0,
             'streak': streak
         }
 
+SELECT_NOTIFICATION_PROFILE = """SELECT notification_enabled, notification_1h, notification_30m, notification_start,
+                          quiet_hours_start, quiet_hours_end, timezone
+                   FROM users WHERE user_id = ?"""
+
+async def get_notification_profile(user_id):
+    """A user's notification switches, quiet hours and timezone (cached), None for unknown users"""
+    profile = cache.get("profile", user_id)
+    if profile is None:
+        generation = cache.generation()
+        async with _read_connection() as db:
+            async with db.execute(SELECT_NOTIFICATION_PROFILE, (user_id,)) as cursor:
+                profile = cache.freeze(await cursor.fetchall())
+        cache.put("profile", user_id, profile, generation)
+    return profile[0] if profile else None
+
+async def get_user_timezone(user_id):
+    """A user's users.timezone from the cached profile, None for the default"""
+    profile = await get_notification_profile(user_id)
+    return profile['timezone'] if profile else None
+
+SELECT_USER_SETTINGS = "SELECT * FROM users WHERE user_id = ?"
+
 async def get_user_settings(user_id):
     """Get user settings"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+    async with _read_connection() as db:
+        cursor = await db.execute(SELECT_USER_SETTINGS, (user_id,))
         return await cursor.fetchone()
 
-async def toggle_notifications(user_id):
+DELETE_CHAT_REMINDERS = "DELETE FROM reminders WHERE chat_id = ?"
+
+@_queued_write
+async def toggle_notifications(db, user_id):
     """Toggle notification setting for a user"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        # Get current setting
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT notification_enabled FROM users WHERE user_id = ?", (user_id,))
-        row = await cursor.fetchone()
-        if row:
-            new_value = 1 if not row['notification_enabled'] else 0
-            await db.execute(
-                "UPDATE users SET notification_enabled = ? WHERE user_id = ?",
-                (new_value, user_id)
-            )
-            await db.commit()
-            return new_value == 1
-        return None
+    # Get current setting
+    cursor = await db.execute("SELECT notification_enabled FROM users WHERE user_id = ?", (user_id,))
+    row = await cursor.fetchone()
+    if row:
+        new_value = 1 if not row['notification_enabled'] else 0
+        await db.execute(
+            "UPDATE users SET notification_enabled = ? WHERE user_id = ?",
+            (new_value, user_id)
+        )
+        _touch_profile(user_id)
+        if not new_value:
+            # Turning notifications on again needs scheduler.reschedule_user_reminders
+            await db.execute(DELETE_CHAT_REMINDERS, (user_id,))
+        return new_value == 1
+    return None
+
+# Rows written by code that predates the is_real column are classified by name
+REAL_RECURRING_FILTER = "AND COALESCE(is_real, is_real_task(task_name))"
+SELECT_RECURRING_FOR_DAY = """SELECT * FROM recurring_tasks WHERE user_id = ? AND day_of_week = ? {real_filter}
+               ORDER BY scheduled_time"""
 
-async def get_recurring_tasks_for_day(user_id, day_of_week):
+async def get_recurring_tasks_for_day(user_id, day_of_week, real_only=False):
     """Get all recurring tasks for a specific day of week for a user"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+    real_filter = REAL_RECURRING_FILTER if real_only else ""
+    async with _read_connection() as db:
         cursor = await db.execute(
-            "SELECT * FROM recurring_tasks WHERE user_id = ? AND day_of_week = ? ORDER BY scheduled_time",
-            (user_id, day_of_week)
+            SELECT_RECURRING_FOR_DAY.format(real_filter=real_filter), (user_id, day_of_week)
         )
         return await cursor.fetchall()
 
 async def get_current_task(user_id, date_str, current_time_str):
     """Get the task that should be happening now (started within last 2 hours)"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        from datetime import datetime, timedelta
-        current_dt = datetime.strptime(f"{date_str} {current_time_str}", "%Y-%m-%d %H:%M")
-        # Look for tasks that started within the last 2 hours and haven't passed yet
-        window_start = (current_dt - timedelta(hours=2)).strftime("%H:%M")
-        
-        # Get tasks that started before or at current time, but not future tasks
-        # Also filter out non-tasks (commutes, lunch, etc.) - we want real tasks
-        cursor = await db.execute(
-            """SELECT * FROM tasks 
-               WHERE user_id = ? AND date = ? 
-               AND scheduled_time >= ? 
-               AND scheduled_time <= ? 
-               AND status != 'done'
-               ORDER BY scheduled_time DESC
-               LIMIT 1""",
-            (user_id, date_str, window_start, current_time_str)
-        )
-        result = await cursor.fetchone()
-        
-        # Double-check: make sure the task has actually started (not a future task)
-        if result:
-            task_time_str = result['scheduled_time']
-            # If task time is after current time, it hasn't started yet - return None
-            if task_time_str > current_time_str:
-                return None
-        return result
+    from datetime import datetime, timedelta
+    current_dt = datetime.strptime(f"{date_str} {current_time_str}", "%Y-%m-%d %H:%M")
+    # Look for tasks that started within the last 2 hours and haven't passed yet
+    window_start = (current_dt - timedelta(hours=2)).strftime("%H:%M")
+    
+    # Latest task that started in the window and isn't done (future tasks never match)
+    timeline = await _get_timeline(user_id, date_str)
+    for task in reversed(timeline):
+        if window_start <= task['scheduled_time'] <= current_time_str and task['status'] != 'done':
+            return task
+    return None
 
 async def get_next_task(user_id, date_str, current_time_str):
     """Get the next upcoming task"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            """SELECT * FROM tasks 
-               WHERE user_id = ? AND date = ? 
-               AND scheduled_time > ? 
-               AND status != 'done'
-               ORDER BY scheduled_time ASC
-               LIMIT 1""",
-            (user_id, date_str, current_time_str)
-        )
-        return await cursor.fetchone()
+    timeline = await _get_timeline(user_id, date_str)
+    for task in timeline:
+        if task['scheduled_time'] > current_time_str and task['status'] != 'done':
+            return task
+    return None
+
+async def get_day_snapshot(user_id, date_str, current_time_str):
+    """Everything the "What now?" screens need from one timeline read.
+    
+    Returns a dict with the day's tasks sorted by time and indices into that list:
+    current (latest unfinished task started within the last 2 hours, like
+    get_current_task), next (first unfinished real task after now), missed (real
+    tasks still pending from earlier, like get_incomplete_tasks). needs_generation
+    is True while the day has no tasks, i.e. recurring templates were not applied yet.
+    """
+    tasks = await _get_timeline(user_id, date_str)
+    times = [task['scheduled_time'] for task in tasks]
+    # Tasks at or before now are [0, started), the rest are still ahead
+    started = bisect.bisect_right(times, current_time_str)
+    
+    current_dt = datetime.strptime(f"{date_str} {current_time_str}", "%Y-%m-%d %H:%M")
+    window_start = current_dt - timedelta(hours=2)
+    if window_start.date() < current_dt.date():
+        # Just after midnight the window covers the whole day so far
+        window_first = 0
+    else:
+        window_first = bisect.bisect_left(times, window_start.strftime("%H:%M"))
+    current = next(
+        (i for i in range(started - 1, window_first - 1, -1) if tasks[i]['status'] != 'done'), None
+    )
+    next_index = next(
+        (i for i in range(started, len(tasks)) if tasks[i]['status'] != 'done' and utils.task_is_real(tasks[i])),
+        None
+    )
+    before_now = bisect.bisect_left(times, current_time_str)
+    missed = [
+        i for i in range(before_now) if tasks[i]['status'] == 'pending' and utils.task_is_real(tasks[i])
+    ]
+    return {
+        'tasks': tasks,
+        'current': current,
+        'next': next_index,
+        'missed': missed,
+        'needs_generation': not tasks,
+    }
 
 # ===== NEW FEATURES DATABASE FUNCTIONS =====
 
 # Edit/Delete Tasks
-async def update_task(task_id, task_name=None, scheduled_time=None, priority=None, category=None, duration=None, notes=None):
+@_queued_write
+async def update_task(db, task_id, task_name=None, scheduled_time=None, priority=None, category=None, duration=None, notes=None):
     """Update task fields"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        updates = []
-        params = []
-        if task_name:
-            updates.append("task_name = ?")
-            params.append(task_name)
-        if scheduled_time:
-            updates.append("scheduled_time = ?")
-            params.append(scheduled_time)
-        if priority:
-            updates.append("priority = ?")
-            params.append(priority)
-        if category:
-            updates.append("category = ?")
-            params.append(category)
-        if duration is not None:
-            updates.append("duration = ?")
-            params.append(duration)
-        if notes is not None:
-            updates.append("notes = ?")
-            params.append(notes)
-        updates.append("updated_at = CURRENT_TIMESTAMP")
-        params.append(task_id)
-        
-        if updates:
-            query = f"UPDATE tasks SET {', '.join(updates)} WHERE id = ?"
-            await db.execute(query, params)
-            await db.commit()
+    updates = []
+    params = []
+    if task_name:
+        updates.append("task_name = ?")
+        params.append(task_name)
+        updates.append("is_real = ?")
+        params.append(utils.is_real_task(task_name))
+    if scheduled_time:
+        updates.append("scheduled_time = ?")
+        params.append(scheduled_time)
+    if priority:
+        updates.append("priority = ?")
+        params.append(priority)
+    if category:
+        updates.append("category = ?")
+        params.append(category)
+    if duration is not None:
+        updates.append("duration = ?")
+        params.append(duration)
+    if notes is not None:
+        updates.append("notes = ?")
+        params.append(notes)
+    updates.append("updated_at = CURRENT_TIMESTAMP")
+    params.append(task_id)
+    
+    if updates:
+        query = f"UPDATE tasks SET {', '.join(updates)} WHERE id = ? RETURNING user_id, date"
+        async with db.execute(query, params) as cursor:
+            row = await cursor.fetchone()
+        if row:
+            _touch_timeline(row['user_id'], row['date'])
+            if scheduled_time:
+                # Reminders for the old time are obsolete, the caller schedules new ones
+                await _cancel_reminders(db, task_id)
+            elif task_name:
+                await db.execute(
+                    "UPDATE reminders SET task_name = ? WHERE task_id = ?", (task_name, task_id)
+                )
+        # Only the name (real task or not) and category feed the rollup
+        if row and (task_name or category):
+            await _refresh_rollup(db, row['user_id'], row['date'])
 
-async def delete_task(task_id):
+@_queued_write
+async def delete_task(db, task_id):
     """Delete a task"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
-        await db.commit()
+    async with db.execute(
+        "DELETE FROM tasks WHERE id = ? RETURNING user_id, date", (task_id,)
+    ) as cursor:
+        row = await cursor.fetchone()
+    if row:
+        await _refresh_rollup(db, row['user_id'], row['date'])
+        _touch_timeline(row['user_id'], row['date'])
+        await _cancel_reminders(db, task_id)
 
 # Weekly View
+SELECT_TASKS_FOR_WEEK = "SELECT * FROM tasks WHERE user_id = ? AND date >= ? AND date <= ? ORDER BY date, scheduled_time"
+
 async def get_tasks_for_week(user_id, start_date_str):
     """Get tasks for a week starting from start_date"""
     from datetime import datetime, timedelta
     end_date = datetime.strptime(start_date_str, "%Y-%m-%d") + timedelta(days=6)
     end_date_str = end_date.strftime("%Y-%m-%d")
     
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            "SELECT * FROM tasks WHERE user_id = ? AND date >= ? AND date <= ? ORDER BY date, scheduled_time",
-            (user_id, start_date_str, end_date_str)
-        )
+    async with _read_connection() as db:
+        cursor = await db.execute(SELECT_TASKS_FOR_WEEK, (user_id, start_date_str, end_date_str))
         return await cursor.fetchall()
 
 # Enhanced Statistics
+SELECT_WEEKLY_TOTALS = """SELECT SUM(total) as total, SUM(done) as done 
+               FROM daily_rollup WHERE user_id = ? AND date >= ? AND date <= ?"""
+SELECT_WEEKLY_BY_CATEGORY = """SELECT NULLIF(category, '') as category, SUM(total) as total, SUM(done) as done
+               FROM daily_rollup WHERE user_id = ? AND date >= ? AND date <= ?
+               GROUP BY category ORDER BY category"""
+SELECT_MONTHLY_TOTALS = """SELECT SUM(total) as total, SUM(done) as done 
+               FROM daily_rollup WHERE user_id = ? AND date >= ? AND date < ?"""
+SELECT_MONTHLY_BY_DAY = """SELECT date, SUM(total) as total, SUM(done) as done
+               FROM daily_rollup WHERE user_id = ? AND date >= ? AND date < ?
+               GROUP BY date ORDER BY date"""
+
 async def get_weekly_stats(user_id, start_date_str):
     """Get weekly statistics"""
     from datetime import datetime, timedelta
     end_date = datetime.strptime(start_date_str, "%Y-%m-%d") + timedelta(days=6)
     end_date_str = end_date.strftime("%Y-%m-%d")
     
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            """SELECT COUNT(*) as total, SUM(CASE WHEN status = 'done' THEN 1 ELSE 0 END) as done 
-               FROM tasks WHERE user_id = ? AND date >= ? AND date <= ?""",
-            (user_id, start_date_str, end_date_str)
-        )
+    async with _read_connection() as db:
+        cursor = await db.execute(SELECT_WEEKLY_TOTALS, (user_id, start_date_str, end_date_str))
         stats = await cursor.fetchone()
         
-        cursor = await db.execute(
-            """SELECT category, COUNT(*) as total, SUM(CASE WHEN status = 'done' THEN 1 ELSE 0 END) as done
-               FROM tasks WHERE user_id = ? AND date >= ? AND date <= ?
-               GROUP BY category""",
-            (user_id, start_date_str, end_date_str)
-        )
+        cursor = await db.execute(SELECT_WEEKLY_BY_CATEGORY, (user_id, start_date_str, end_date_str))
         by_category = await cursor.fetchall()
         
         return {
@@ -539,21 +1203,11 @@ async def get_monthly_stats(user_id, year, month):
     else:
         end_date = f"{year}-{month+1:02d}-01"
     
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            """SELECT COUNT(*) as total, SUM(CASE WHEN status = 'done' THEN 1 ELSE 0 END) as done 
-               FROM tasks WHERE user_id = ? AND date >= ? AND date < ?""",
-            (user_id, start_date, end_date)
-        )
+    async with _read_connection() as db:
+        cursor = await db.execute(SELECT_MONTHLY_TOTALS, (user_id, start_date, end_date))
         stats = await cursor.fetchone()
         
-        cursor = await db.execute(
-            """SELECT date, COUNT(*) as total, SUM(CASE WHEN status = 'done' THEN 1 ELSE 0 END) as done
-               FROM tasks WHERE user_id = ? AND date >= ? AND date < ?
-               GROUP BY date ORDER BY date""",
-            (user_id, start_date, end_date)
-        )
+        cursor = await db.execute(SELECT_MONTHLY_BY_DAY, (user_id, start_date, end_date))
         daily = await cursor.fetchall()
         
         return {
@@ -563,101 +1217,95 @@ async def get_monthly_stats(user_id, year, month):
         }
 
 # Tags
-async def add_tag_to_task(task_id, tag_name):
+@_queued_write
+async def add_tag_to_task(db, task_id, tag_name):
     """Add a tag to a task"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "INSERT OR IGNORE INTO task_tags (task_id, tag_name) VALUES (?, ?)",
-            (task_id, tag_name)
-        )
-        await db.commit()
+    await db.execute(
+        "INSERT OR IGNORE INTO task_tags (task_id, tag_name) VALUES (?, ?)",
+        (task_id, tag_name)
+    )
 
-async def remove_tag_from_task(task_id, tag_name):
+DELETE_TASK_TAG = "DELETE FROM task_tags WHERE task_id = ? AND tag_name = ?"
+SELECT_TASK_TAGS = "SELECT tag_name FROM all_task_tags WHERE task_id = ?"
+
+@_queued_write
+async def remove_tag_from_task(db, task_id, tag_name):
     """Remove a tag from a task"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "DELETE FROM task_tags WHERE task_id = ? AND tag_name = ?",
-            (task_id, tag_name)
-        )
-        await db.commit()
+    await db.execute(DELETE_TASK_TAG, (task_id, tag_name))
 
 async def get_task_tags(task_id):
     """Get all tags for a task"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            "SELECT tag_name FROM task_tags WHERE task_id = ?",
-            (task_id,)
-        )
+    async with _read_connection() as db:
+        cursor = await db.execute(SELECT_TASK_TAGS, (task_id,))
         rows = await cursor.fetchall()
         return [row['tag_name'] for row in rows]
 
+def _tasks_by_tag_sql(with_date):
+    """get_tasks_by_tag's statement; tags move to the archive together with their
+    task, so each side is joined separately"""
+    columns = ", ".join(f"t.{column}" for column in TASK_COLUMNS.split(", "))
+    date_filter = "AND t.date = ?" if with_date else ""
+    tagged = [
+        f"""SELECT {columns} FROM {schema}.tasks t 
+            JOIN {schema}.task_tags tt ON t.id = tt.task_id 
+            WHERE t.user_id = ? AND tt.tag_name = ? {date_filter}"""
+        for schema in ("main", "archive")
+    ]
+    return f"{tagged[0]} UNION ALL {tagged[1]} ORDER BY date, scheduled_time"
+
 async def get_tasks_by_tag(user_id, tag_name, date_str=None):
-    """Get tasks by tag"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        if date_str:
-            cursor = await db.execute(
-                """SELECT t.* FROM tasks t 
-                   JOIN task_tags tt ON t.id = tt.task_id 
-                   WHERE t.user_id = ? AND tt.tag_name = ? AND t.date = ?
-                   ORDER BY t.scheduled_time""",
-                (user_id, tag_name, date_str)
-            )
-        else:
-            cursor = await db.execute(
-                """SELECT t.* FROM tasks t 
-                   JOIN task_tags tt ON t.id = tt.task_id 
-                   WHERE t.user_id = ? AND tt.tag_name = ?
-                   ORDER BY t.date, t.scheduled_time""",
-                (user_id, tag_name)
-            )
+    """Get tasks by tag, including archived history"""
+    params = (user_id, tag_name, date_str) if date_str else (user_id, tag_name)
+    async with _read_connection() as db:
+        cursor = await db.execute(_tasks_by_tag_sql(date_str is not None), params * 2)
         return await cursor.fetchall()
 
 # Notes/Journal
-async def add_task_notes(task_id, notes):
+@_queued_write
+async def add_task_notes(db, task_id, notes):
     """Add notes to a task"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("UPDATE tasks SET notes = ? WHERE id = ?", (notes, task_id))
-        await db.commit()
+    async with db.execute(
+        "UPDATE tasks SET notes = ? WHERE id = ? RETURNING user_id, date", (notes, task_id)
+    ) as cursor:
+        row = await cursor.fetchone()
+    if row:
+        _touch_timeline(row['user_id'], row['date'])
 
-async def add_journal_entry(user_id, date_str, entry_text, mood=None):
+@_queued_write
+async def add_journal_entry(db, user_id, date_str, entry_text, mood=None):
     """Add or update daily journal entry"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            """INSERT OR REPLACE INTO daily_journal (user_id, date, entry_text, mood) 
-               VALUES (?, ?, ?, ?)""",
-            (user_id, date_str, entry_text, mood)
-        )
-        await db.commit()
+    await db.execute(
+        """INSERT OR REPLACE INTO daily_journal (user_id, date, entry_text, mood) 
+           VALUES (?, ?, ?, ?)""",
+        (user_id, date_str, entry_text, mood)
+    )
+
+SELECT_JOURNAL_ENTRY = "SELECT * FROM daily_journal WHERE user_id = ? AND date = ?"
 
 async def get_journal_entry(user_id, date_str):
     """Get journal entry for a date"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            "SELECT * FROM daily_journal WHERE user_id = ? AND date = ?",
-            (user_id, date_str)
-        )
+    async with _read_connection() as db:
+        cursor = await db.execute(SELECT_JOURNAL_ENTRY, (user_id, date_str))
         return await cursor.fetchone()
 
 # Goals and Milestones
-async def add_goal(user_id, title, description, target_date, goal_type, target_value=100):
+@_queued_write
+async def add_goal(db, user_id, title, description, target_date, goal_type, target_value=100):
     """Add a goal"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute(
-            """INSERT INTO goals (user_id, title, description, target_date, goal_type, target_value)
-               VALUES (?, ?, ?, ?, ?, ?) RETURNING id""",
-            (user_id, title, description, target_date, goal_type, target_value)
-        )
-        goal_id = (await cursor.fetchone())[0]
-        await db.commit()
-        return goal_id
+    cursor = await db.execute(
+        """INSERT INTO goals (user_id, title, description, target_date, goal_type, target_value)
+           VALUES (?, ?, ?, ?, ?, ?) RETURNING id""",
+        (user_id, title, description, target_date, goal_type, target_value)
+    )
+    goal_id = (await cursor.fetchone())[0]
+    return goal_id
+
+SELECT_ACTIVE_GOALS = "SELECT * FROM goals WHERE user_id = ? AND (target_date >= ? OR target_date IS NULL) ORDER BY target_date"
+SELECT_GOALS = "SELECT * FROM goals WHERE user_id = ? ORDER BY target_date"
 
 async def get_goals(user_id, active_only=True):
     """Get goals for a user"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+    async with _read_connection() as db:
         if active_only:
             from datetime import datetime
             import pytz
@@ -665,115 +1313,338 @@ async def get_goals(user_id, active_only=True):
             tz = pytz.timezone(TIMEZONE)
             # Get UTC time first, then convert to target timezone to avoid system timezone issues
             today = datetime.now(pytz.utc).astimezone(tz).strftime("%Y-%m-%d")
-            cursor = await db.execute(
-                "SELECT * FROM goals WHERE user_id = ? AND (target_date >= ? OR target_date IS NULL) ORDER BY target_date",
-                (user_id, today)
-            )
+            cursor = await db.execute(SELECT_ACTIVE_GOALS, (user_id, today))
         else:
-            cursor = await db.execute(
-                "SELECT * FROM goals WHERE user_id = ? ORDER BY target_date",
-                (user_id,)
-            )
+            cursor = await db.execute(SELECT_GOALS, (user_id,))
         return await cursor.fetchall()
 
-async def update_goal_progress(goal_id, progress):
+@_queued_write
+async def update_goal_progress(db, goal_id, progress):
     """Update goal progress"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("UPDATE goals SET progress = ? WHERE id = ?", (progress, goal_id))
-        await db.commit()
+    await db.execute("UPDATE goals SET progress = ? WHERE id = ?", (progress, goal_id))
 
-async def add_milestone(goal_id, title):
+@_queued_write
+async def add_milestone(db, goal_id, title):
     """Add a milestone to a goal"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute(
-            "INSERT INTO milestones (goal_id, title) VALUES (?, ?) RETURNING id",
-            (goal_id, title)
-        )
-        milestone_id = (await cursor.fetchone())[0]
-        await db.commit()
-        return milestone_id
+    cursor = await db.execute(
+        "INSERT INTO milestones (goal_id, title) VALUES (?, ?) RETURNING id",
+        (goal_id, title)
+    )
+    milestone_id = (await cursor.fetchone())[0]
+    return milestone_id
 
-async def mark_milestone_achieved(milestone_id):
+@_queued_write
+async def mark_milestone_achieved(db, milestone_id):
     """Mark a milestone as achieved"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "UPDATE milestones SET achieved = 1, achieved_at = CURRENT_TIMESTAMP WHERE id = ?",
-            (milestone_id,)
-        )
-        await db.commit()
+    await db.execute(
+        "UPDATE milestones SET achieved = 1, achieved_at = CURRENT_TIMESTAMP WHERE id = ?",
+        (milestone_id,)
+    )
 
 # Archive
-async def archive_task(task_id):
+@_queued_write
+async def archive_task(db, task_id):
     """Archive a task"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("UPDATE tasks SET archived = 1 WHERE id = ?", (task_id,))
-        await db.commit()
+    async with db.execute(
+        "UPDATE tasks SET archived = 1 WHERE id = ? RETURNING user_id, date", (task_id,)
+    ) as cursor:
+        row = await cursor.fetchone()
+    if row:
+        _touch_timeline(row['user_id'], row['date'])
+        await _cancel_reminders(db, task_id)
 
-async def unarchive_task(task_id):
+@_queued_write
+async def unarchive_task(db, task_id):
     """Unarchive a task"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("UPDATE tasks SET archived = 0 WHERE id = ?", (task_id,))
-        await db.commit()
+    async with db.execute(
+        "UPDATE tasks SET archived = 0 WHERE id = ? RETURNING user_id, date", (task_id,)
+    ) as cursor:
+        row = await cursor.fetchone()
+    if row:
+        _touch_timeline(row['user_id'], row['date'])
+
+SELECT_ARCHIVED_TASKS = "SELECT * FROM all_tasks WHERE user_id = ? AND archived = 1 ORDER BY date DESC, scheduled_time DESC LIMIT ?"
 
 async def get_archived_tasks(user_id, limit=50):
     """Get archived tasks"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            "SELECT * FROM tasks WHERE user_id = ? AND archived = 1 ORDER BY date DESC, scheduled_time DESC LIMIT ?",
-            (user_id, limit)
-        )
+    async with _read_connection() as db:
+        cursor = await db.execute(SELECT_ARCHIVED_TASKS, (user_id, limit))
         return await cursor.fetchall()
 
 # Custom Categories
-async def add_custom_category(user_id, category_name, emoji='🔹'):
+@_queued_write
+async def add_custom_category(db, user_id, category_name, emoji='🔹'):
     """Add a custom category"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "INSERT OR IGNORE INTO custom_categories (user_id, category_name, emoji) VALUES (?, ?, ?)",
-            (user_id, category_name, emoji)
-        )
-        await db.commit()
+    await db.execute(
+        "INSERT OR IGNORE INTO custom_categories (user_id, category_name, emoji) VALUES (?, ?, ?)",
+        (user_id, category_name, emoji)
+    )
+
+SELECT_CUSTOM_CATEGORIES = "SELECT * FROM custom_categories WHERE user_id = ? ORDER BY category_name"
 
 async def get_custom_categories(user_id):
     """Get custom categories for a user"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            "SELECT * FROM custom_categories WHERE user_id = ? ORDER BY category_name",
-            (user_id,)
-        )
+    async with _read_connection() as db:
+        cursor = await db.execute(SELECT_CUSTOM_CATEGORIES, (user_id,))
         return await cursor.fetchall()
 
 # Settings
-async def update_quiet_hours(user_id, start_time, end_time):
-    """Update quiet hours"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "UPDATE users SET quiet_hours_start = ?, quiet_hours_end = ? WHERE user_id = ?",
-            (start_time, end_time, user_id)
-        )
-        await db.commit()
+@_queued_write
+async def update_quiet_hours(db, user_id, start_time, end_time):
+    """Update quiet hours, follow with scheduler.reschedule_user_reminders"""
+    await db.execute(
+        "UPDATE users SET quiet_hours_start = ?, quiet_hours_end = ? WHERE user_id = ?",
+        (start_time, end_time, user_id)
+    )
+    _touch_profile(user_id)
 
-async def update_notification_settings(user_id, notification_1h, notification_30m, notification_start):
-    """Update notification settings"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            """UPDATE users SET notification_1h = ?, notification_30m = ?, notification_start = ? 
-               WHERE user_id = ?""",
-            (notification_1h, notification_30m, notification_start, user_id)
-        )
-        await db.commit()
+DELETE_CHAT_REMINDER_TYPES = """DELETE FROM reminders
+               WHERE chat_id = ? AND reminder_type IN (SELECT value FROM json_each(?))"""
+
+@_queued_write
+async def update_notification_settings(db, user_id, notification_1h, notification_30m, notification_start):
+    """Update notification settings; reminders of disabled types are cancelled.
+    
+    Enabling a type needs scheduler.reschedule_user_reminders to add its reminders.
+    """
+    await db.execute(
+        """UPDATE users SET notification_1h = ?, notification_30m = ?, notification_start = ? 
+           WHERE user_id = ?""",
+        (notification_1h, notification_30m, notification_start, user_id)
+    )
+    _touch_profile(user_id)
+    disabled = [
+        reminder_type for reminder_type, enabled in
+        (('1h', notification_1h), ('30m', notification_30m), ('start', notification_start))
+        if not enabled
+    ]
+    if disabled:
+        await db.execute(DELETE_CHAT_REMINDER_TYPES, (user_id, json.dumps(disabled)))
 
 # Future dates scheduling
-async def add_task_future(user_id, task_name, scheduled_time, priority, category, date_str, duration=0):
-    """Add a task for a future date"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute(
-            """INSERT INTO tasks (user_id, task_name, scheduled_time, priority, category, date, duration, status)
-               VALUES (?, ?, ?, ?, ?, ?, ?, 'pending') RETURNING id""",
-            (user_id, task_name, scheduled_time, priority, category, date_str, duration)
-        )
-        task_id = (await cursor.fetchone())[0]
-        await db.commit()
-        return task_id
+@_queued_write
+async def add_task_future(db, user_id, task_name, scheduled_time, priority, category, date_str, duration=0):
+    """Add a task for a future date, returns None if the name is already taken that day"""
+    async with db.execute(
+        """INSERT INTO tasks (user_id, task_name, scheduled_time, priority, category, date, duration, status, is_real,
+                              created_at, updated_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+           ON CONFLICT(user_id, date, task_name) DO NOTHING
+           RETURNING id""",
+        (user_id, task_name, scheduled_time, priority, category, date_str, duration,
+         utils.is_real_task(task_name))
+    ) as cursor:
+        row = await cursor.fetchone()
+    if row:
+        await _refresh_rollup(db, user_id, date_str)
+        _touch_timeline(user_id, date_str)
+    return row[0] if row else None
+
+# Reminders
+#
+# A reminder is keyed by (task_id, reminder_type), so a task never has more than
+# one 1h/30m/start reminder however often it is scheduled. Writes that make a
+# reminder obsolete (done, deleted, archived, time changed) cancel it in the same
+# transaction.
+
+# Rescheduling an unchanged reminder is a no-op, and tasks that are done,
+# archived or deleted get none. Reminders are built before their write is queued;
+# one that has come due meanwhile may already have been taken by the dispatcher,
+# so it is not stored again
+UPSERT_REMINDER = """INSERT INTO reminders (task_id, reminder_type, chat_id, task_name, fire_at)
+           SELECT :task_id, :reminder_type, :chat_id, :task_name, :fire_at
+           WHERE :fire_at > CAST(strftime('%s', 'now') AS INTEGER) AND EXISTS (
+               SELECT 1 FROM tasks
+               WHERE id = :task_id AND status IS NOT 'done' AND COALESCE(archived, 0) = 0
+           )
+           ON CONFLICT(task_id, reminder_type) DO UPDATE SET
+               chat_id = excluded.chat_id, task_name = excluded.task_name, fire_at = excluded.fire_at
+           WHERE fire_at != excluded.fire_at OR task_name != excluded.task_name
+                 OR chat_id != excluded.chat_id"""
+
+@_queued_write
+async def save_reminders(db, reminders):
+    """Upsert reminder dicts (task_id, reminder_type, chat_id, task_name, fire_at)"""
+    await db.executemany(UPSERT_REMINDER, reminders)
+
+@_queued_write
+async def replace_chat_reminders(db, chat_id, reminders):
+    """Make reminders the complete set of pending reminders of a chat, in one write"""
+    await db.execute(DELETE_CHAT_REMINDERS, (chat_id,))
+    await db.executemany(UPSERT_REMINDER, reminders)
+
+SELECT_UPCOMING_TASKS = """SELECT t.id, t.user_id, t.task_name, t.scheduled_time, t.date,
+                      u.notification_enabled, u.notification_1h, u.notification_30m, u.notification_start,
+                      u.quiet_hours_start, u.quiet_hours_end, u.timezone
+               FROM tasks t LEFT JOIN users u ON u.user_id = t.user_id
+               WHERE t.date BETWEEN ? AND ?
+                 AND t.date || ' ' || t.scheduled_time > ? AND t.date || ' ' || t.scheduled_time <= ?
+                 AND t.status IS NOT 'done' AND COALESCE(t.archived, 0) = 0
+                 AND COALESCE(u.timezone, '') IN (SELECT value FROM json_each(?))
+               ORDER BY t.date, t.scheduled_time"""
+
+async def get_upcoming_tasks(start_dt, end_dt, timezones):
+    """Open tasks scheduled in (start_dt, end_dt], local naive datetimes, of users in timezones.
+    
+    Rows carry the owner's notification profile columns, NULL for unknown users;
+    '' in timezones stands for users without a timezone and unknown users.
+    """
+    start, end = start_dt.strftime("%Y-%m-%d %H:%M"), end_dt.strftime("%Y-%m-%d %H:%M")
+    async with _read_connection() as db:
+        async with db.execute(
+            SELECT_UPCOMING_TASKS, (start[:10], end[:10], start, end, json.dumps(list(timezones)))
+        ) as cursor:
+            return await cursor.fetchall()
+
+DELETE_TASK_REMINDERS = "DELETE FROM reminders WHERE task_id = ?"
+TAKE_DUE_REMINDERS = """DELETE FROM reminders WHERE fire_at <= ?
+           RETURNING task_id, reminder_type, chat_id, task_name, fire_at"""
+
+SELECT_USER_UPCOMING_TASKS = """SELECT id, user_id, task_name, scheduled_time, date FROM tasks
+               WHERE user_id = ? AND date BETWEEN ? AND ?
+                 AND date || ' ' || scheduled_time > ? AND date || ' ' || scheduled_time <= ?
+                 AND status IS NOT 'done' AND COALESCE(archived, 0) = 0
+               ORDER BY date, scheduled_time"""
+
+async def get_user_upcoming_tasks(user_id, start_dt, end_dt):
+    """One user's open tasks scheduled in (start_dt, end_dt], local naive datetimes"""
+    start, end = start_dt.strftime("%Y-%m-%d %H:%M"), end_dt.strftime("%Y-%m-%d %H:%M")
+    async with _read_connection() as db:
+        async with db.execute(
+            SELECT_USER_UPCOMING_TASKS, (user_id, start[:10], end[:10], start, end)
+        ) as cursor:
+            return await cursor.fetchall()
+
+async def _cancel_reminders(db, task_id):
+    """Drop a task's pending reminders, inside the caller's transaction"""
+    await db.execute(DELETE_TASK_REMINDERS, (task_id,))
+
+@_queued_write
+async def take_due_reminders(db, timestamp):
+    """Remove and return the reminders due at or before a UTC timestamp, oldest first"""
+    async with db.execute(TAKE_DUE_REMINDERS, (timestamp,)) as cursor:
+        due = await cursor.fetchall()
+    return sorted(due, key=lambda r: r['fire_at'])
+
+# ===== QUERY PLAN CHECK =====
+
+# Statements the hot paths run, checked to be answered from an index (the first word
+# is the function using it). Templates are listed with each variant their function uses.
+HOT_QUERIES = [
+    ("_get_timeline", SELECT_TIMELINE),
+    ("get_tasks_for_week", SELECT_TASKS_FOR_WEEK),
+    ("get_task_by_id", SELECT_TASK_BY_ID),
+    ("get_user_stats totals", SELECT_STATS_TOTALS),
+    ("get_user_stats streak", SELECT_STATS_STREAK),
+    ("get_weekly_stats totals", SELECT_WEEKLY_TOTALS),
+    ("get_weekly_stats categories", SELECT_WEEKLY_BY_CATEGORY),
+    ("get_monthly_stats totals", SELECT_MONTHLY_TOTALS),
+    ("get_monthly_stats days", SELECT_MONTHLY_BY_DAY),
+    ("_refresh_rollup delete", DELETE_ROLLUP_DAY),
+    ("_refresh_rollup insert", INSERT_ROLLUP_DAY),
+    ("get_archived_tasks", SELECT_ARCHIVED_TASKS),
+    ("move_tasks_to_archive", SELECT_ARCHIVE_BATCH),
+    ("get_recurring_tasks_for_day", SELECT_RECURRING_FOR_DAY.format(real_filter="")),
+    ("get_recurring_tasks_for_day real", SELECT_RECURRING_FOR_DAY.format(real_filter=REAL_RECURRING_FILTER)),
+    ("generate_daily_tasks_bulk", INSERT_DAILY_TASKS.format(user_filter=DAILY_TASKS_ALL_USERS)),
+    ("generate_daily_tasks_bulk by id", INSERT_DAILY_TASKS.format(user_filter=DAILY_TASKS_BY_ID)),
+    ("generate_daily_tasks_bulk by timezone", INSERT_DAILY_TASKS.format(user_filter=DAILY_TASKS_BY_TIMEZONE)),
+    ("get_task_tags", SELECT_TASK_TAGS),
+    ("remove_tag_from_task", DELETE_TASK_TAG),
+    ("get_tasks_by_tag", _tasks_by_tag_sql(False)),
+    ("get_tasks_by_tag date", _tasks_by_tag_sql(True)),
+    ("get_journal_entry", SELECT_JOURNAL_ENTRY),
+    ("get_goals", SELECT_GOALS),
+    ("get_goals active", SELECT_ACTIVE_GOALS),
+    ("get_custom_categories", SELECT_CUSTOM_CATEGORIES),
+    ("get_user_settings", SELECT_USER_SETTINGS),
+    ("get_notification_profile", SELECT_NOTIFICATION_PROFILE),
+    ("take_due_reminders", TAKE_DUE_REMINDERS),
+    ("toggle_notifications", DELETE_CHAT_REMINDERS),
+    ("update_notification_settings", DELETE_CHAT_REMINDER_TYPES),
+    ("replace_chat_reminders", DELETE_CHAT_REMINDERS),
+    ("get_upcoming_tasks", SELECT_UPCOMING_TASKS),
+    ("get_user_upcoming_tasks", SELECT_USER_UPCOMING_TASKS),
+    ("get_user_timezones", SELECT_USER_TIMEZONES),
+    ("get_pending_maintenance", SELECT_PENDING_MAINTENANCE),
+    ("_cancel_reminders", DELETE_TASK_REMINDERS),
+]
+
+async def check_query_plans():
+    """Run EXPLAIN QUERY PLAN over HOT_QUERIES, returns (name, plan) for full table scans"""
+    offenders = []
+    async with _read_connection() as db:
+        for name, sql in HOT_QUERIES:
+            params = (1,) * sql.count("?")
+            async with db.execute(f"EXPLAIN QUERY PLAN {sql}", params) as cursor:
+                plan = [row[3] for row in await cursor.fetchall()]
+            # Views like all_tasks run as co-routines and CTEs may be materialized; scanning
+            # their (already filtered) output is fine
+            subqueries = {
+                detail.split()[1] for detail in plan if detail.startswith(("CO-ROUTINE ", "MATERIALIZE "))
+            }
+            for detail in plan:
+                # "SCAN tasks" is a full scan, "SCAN tasks USING INDEX ..." is an ordered index walk;
+                # json_each lists of ids are virtual tables and always scanned
+                if detail.startswith("SCAN ") and "USING" not in detail and "VIRTUAL TABLE" not in detail \
+                        and detail.split()[1] not in subqueries:
+                    offenders.append((name, detail))
+    return offenders
+
+async def _main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Study bot database maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = commands.add_parser("migrate", help="apply pending schema migrations")
+    migrate_parser.add_argument("--status", action="store_true", help="only show pending migrations")
+    commands.add_parser("explain", help="fail if a hot query falls back to a full table scan")
+    commands.add_parser("verify-rollup", help="report drift between daily_rollup and raw tasks")
+    commands.add_parser("rebuild-rollup", help="recompute daily_rollup from raw tasks")
+    archive_parser = commands.add_parser("archive", help="move old tasks to the archive database")
+    archive_parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS,
+                                help="keep this many days of tasks in the hot database")
+    args = parser.parse_args(argv)
+    
+    await init_db(migrate=args.command != "migrate")
+    try:
+        if args.command == "migrate":
+            version, pending = await get_pending_migrations()
+            print(f"📦 Schema version {version} (latest {SCHEMA_VERSION})")
+            for step_version, description in pending:
+                print(f"   pending {step_version}: {description}")
+            if not args.status and pending:
+                applied = await apply_migrations()
+                print(f"✅ Applied {len(applied)} migration(s)")
+            elif not pending:
+                print("✅ Up to date")
+        elif args.command == "explain":
+            offenders = await check_query_plans()
+            for name, detail in offenders:
+                print(f"❌ {name}: {detail}")
+            if offenders:
+                return 1
+            print(f"✅ All {len(HOT_QUERIES)} hot queries use an index")
+        elif args.command == "verify-rollup":
+            drift = await verify_rollup()
+            for row in drift:
+                print(f"❌ {row['source']}: user {row['user_id']} {row['date']} [{row['category']}] "
+                      f"total={row['total']} done={row['done']} "
+                      f"real_total={row['real_total']} real_done={row['real_done']}")
+            if drift:
+                return 1
+            print("✅ daily_rollup matches tasks")
+        elif args.command == "rebuild-rollup":
+            await rebuild_rollup()
+            print("✅ daily_rollup rebuilt from tasks")
+        elif args.command == "archive":
+            from datetime import timedelta
+            before_date = (utils.get_user_now() - timedelta(days=args.days)).strftime("%Y-%m-%d")
+            moved = await move_tasks_to_archive(before_date)
+            print(f"✅ Moved {moved} tasks dated before {before_date} to {ARCHIVE_DB_NAME}")
+        return 0
+    finally:
+        await close_db()
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
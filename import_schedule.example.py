@@ -34,6 +34,7 @@ async def run_import():
         await database.add_recurring_template(USER_ID, day, name, time, prio, cat)
         print(f"   Added {day} {time}: {name}")
 
+    await database.close_db()
     print("✅ Done! Data imported. Now restart your bot and run /sync.")
 
 if __name__ == "__main__":
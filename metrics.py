@@ -0,0 +1,60 @@
+"""In-process counters, gauges and histograms for performance tracking"""
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# Histograms keep a rolling window of recent samples for percentiles
+MAX_SAMPLES = 2048
+
+_counters = defaultdict(int)
+_gauges = {}
+_samples = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+_observed = defaultdict(int)
+
+def inc(name, value=1):
+    """Increase a counter"""
+    _counters[name] += value
+
+def set_gauge(name, value):
+    """Record the current value of something (queue depth, in-flight requests...)"""
+    _gauges[name] = value
+
+def observe(name, value):
+    """Add a sample to a histogram"""
+    _samples[name].append(value)
+    _observed[name] += 1
+
+@contextmanager
+def timer(name):
+    """Observe the duration of a block in milliseconds"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, (time.perf_counter() - start) * 1000)
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def summary(name):
+    """Count and p50/p90/p99/max for a histogram"""
+    values = sorted(_samples.get(name, ()))
+    return {
+        'count': _observed.get(name, 0),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': values[-1] if values else None,
+    }
+
+def snapshot():
+    """All metrics as plain dicts"""
+    return {
+        'counters': dict(_counters),
+        'gauges': dict(_gauges),
+        'histograms': {name: summary(name) for name in _samples},
+    }
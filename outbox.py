@@ -0,0 +1,212 @@
+"""Rate-limited queue for messages the bot sends on its own (reminders, summaries)"""
+import asyncio
+import heapq
+import itertools
+import logging
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from config import OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_INTERVAL, OUTBOX_MAX_RETRIES, OUTBOX_CONCURRENCY
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, lower is sent first
+PRIORITY_START = 0     # "time to start" reminders
+PRIORITY_REMINDER = 1  # 1h / 30m reminders
+PRIORITY_SUMMARY = 2   # morning summaries
+
+_bot = None
+_worker = None
+_stopping = False
+_heap = []  # (priority, seq, message)
+_seq = itertools.count()
+_wakeup = None
+_slots = None
+_in_flight = set()
+# chat_id -> loop time the chat may get its next message
+_chat_ready_at = {}
+# Set by a RetryAfter: flood control applies to the whole bot
+_paused_until = 0.0
+# Global token bucket; holding at most one token paces sends evenly, with no burst
+# on top of the rate in the first second
+_tokens = 0.0
+_tokens_at = 0.0
+
+def start(bot):
+    """Start delivering queued messages through bot (anything with an async send_message)"""
+    global _bot, _worker, _stopping, _wakeup, _slots, _tokens, _tokens_at
+    if _worker is not None:
+        return
+    loop = asyncio.get_running_loop()
+    _bot = bot
+    _stopping = False
+    _wakeup = asyncio.Event()
+    _slots = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+    _tokens, _tokens_at = 1.0, loop.time()
+    _worker = asyncio.create_task(_run())
+
+async def stop(timeout=10):
+    """Send what is queued (waiting at most timeout seconds), then stop"""
+    global _worker, _bot, _stopping
+    if _worker is None:
+        return
+    _stopping = True
+    _wakeup.set()
+    try:
+        await asyncio.wait_for(asyncio.shield(_worker), timeout)
+    except asyncio.TimeoutError:
+        _worker.cancel()
+        logger.warning(f"Outbox stopped with {len(_heap)} messages still queued")
+    if _in_flight:
+        await asyncio.wait(list(_in_flight), timeout=timeout)
+    while _heap:
+        _drop(heapq.heappop(_heap)[2], "shutdown", log=False)
+    _worker = None
+    _bot = None
+    _update_depth()
+
+def send(chat_id, text, priority=PRIORITY_REMINDER, **kwargs):
+    """Queue a message, returns a future that resolves to True once sent or False if dropped"""
+    if _worker is None:
+        raise RuntimeError("Outbox is not running, call outbox.start() first")
+    loop = asyncio.get_running_loop()
+    message = {
+        'chat_id': chat_id,
+        'text': text,
+        'kwargs': kwargs,
+        'priority': priority,
+        'attempt': 0,
+        'queued_at': loop.time(),
+        'future': loop.create_future(),
+    }
+    _push(message)
+    return message['future']
+
+def _push(message):
+    if _worker is None:
+        _drop(message, "outbox stopped")
+        return
+    heapq.heappush(_heap, (message['priority'], next(_seq), message))
+    _update_depth()
+    _wakeup.set()
+
+def _update_depth():
+    metrics.set_gauge("outbox.depth", len(_heap))
+
+def _pop_ready(now):
+    """Highest priority (priority, seq, message) whose chat may receive now, plus how long
+    until the next one could"""
+    waiting = []
+    ready = None
+    while _heap:
+        item = heapq.heappop(_heap)
+        ready_at = _chat_ready_at.get(item[2]['chat_id'], 0)
+        if ready_at <= now:
+            ready = item
+            break
+        waiting.append((item, ready_at))
+    for item, _ in waiting:
+        heapq.heappush(_heap, item)
+    wait = min((ready_at for _, ready_at in waiting), default=now) - now
+    return ready, wait
+
+async def _wait_for_message(delay):
+    """Sleep for delay, returning early when a new message is queued"""
+    _wakeup.clear()
+    try:
+        await asyncio.wait_for(_wakeup.wait(), delay)
+    except asyncio.TimeoutError:
+        pass
+
+async def _take_token(loop):
+    global _tokens, _tokens_at
+    while True:
+        now = loop.time()
+        _tokens = min(1.0, _tokens + (now - _tokens_at) * OUTBOX_GLOBAL_RATE)
+        _tokens_at = now
+        if _tokens >= 1:
+            _tokens -= 1
+            return
+        await asyncio.sleep((1 - _tokens) / OUTBOX_GLOBAL_RATE)
+
+async def _run():
+    loop = asyncio.get_running_loop()
+    while True:
+        if not _heap:
+            if _stopping:
+                break
+            await _wait_for_message(None)
+            continue
+        now = loop.time()
+        if now < _paused_until:
+            await asyncio.sleep(_paused_until - now)
+            continue
+        item, wait = _pop_ready(now)
+        if item is None:
+            await _wait_for_message(wait)
+            continue
+        _update_depth()
+        await _take_token(loop)
+        await _slots.acquire()
+        if loop.time() < _paused_until:
+            # A send in flight hit flood control meanwhile; keep the message's place
+            _slots.release()
+            heapq.heappush(_heap, item)
+            _update_depth()
+            continue
+        message = item[2]
+        _chat_ready_at[message['chat_id']] = loop.time() + OUTBOX_CHAT_INTERVAL
+        task = asyncio.create_task(_deliver(message))
+        _in_flight.add(task)
+        task.add_done_callback(_in_flight.discard)
+        _forget_idle_chats(loop.time())
+
+def _forget_idle_chats(now):
+    # Keep the per-chat table from growing with every chat ever messaged
+    if len(_chat_ready_at) > 10000:
+        for chat_id in [c for c, ready_at in _chat_ready_at.items() if ready_at <= now]:
+            del _chat_ready_at[chat_id]
+
+async def _deliver(message):
+    global _paused_until
+    loop = asyncio.get_running_loop()
+    try:
+        await _bot.send_message(chat_id=message['chat_id'], text=message['text'], **message['kwargs'])
+    except RetryAfter as e:
+        metrics.inc("outbox.rate_limited")
+        logger.warning(f"Flood control: pausing outbound messages for {e.retry_after}s")
+        _paused_until = max(_paused_until, loop.time() + e.retry_after)
+        _retry(message, 0)
+    except (Forbidden, BadRequest) as e:
+        # Bot blocked, chat not found, bad markup... a retry won't help
+        _drop(message, e)
+    except TelegramError as e:
+        # Network errors and timeouts: back off 1s, 2s, 4s...
+        _retry(message, 2 ** message['attempt'], e)
+    except Exception as e:
+        logger.error(f"Unexpected error sending to {message['chat_id']}: {e}", exc_info=True)
+        _drop(message, e)
+    else:
+        metrics.inc("outbox.sent")
+        metrics.observe("outbox.send_latency_ms", (loop.time() - message['queued_at']) * 1000)
+        if not message['future'].done():
+            message['future'].set_result(True)
+    finally:
+        _slots.release()
+
+def _retry(message, delay, error=None):
+    message['attempt'] += 1
+    if message['attempt'] > OUTBOX_MAX_RETRIES:
+        _drop(message, error or "retry budget exhausted")
+        return
+    metrics.inc("outbox.retries")
+    if delay:
+        asyncio.get_running_loop().call_later(delay, _push, message)
+    else:
+        _push(message)
+
+def _drop(message, reason, log=True):
+    metrics.inc("outbox.dropped")
+    if log:
+        logger.warning(f"Dropped message to {message['chat_id']} after {message['attempt']} retries: {reason}")
+    if not message['future'].done():
+        message['future'].set_result(False)
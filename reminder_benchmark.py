@@ -0,0 +1,121 @@
+"""Measure what N pending reminders cost the bot, on a scratch database.
+
+jobs: the reminders are saved, read back in one ORDER BY fire_at query (the startup
+reload) and registered as one APScheduler run_once job each, then the scheduler is
+started. Reports the reload query, registration and start times and memory growth.
+
+dispatcher: what the bot does instead. The reminders are saved to the reminders
+table and a few minute ticks of the dispatcher take the due ones. Reports the save
+time, the time per tick and memory growth.
+
+    python reminder_benchmark.py jobs 100000
+    python reminder_benchmark.py dispatcher 100000
+"""
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import tempfile
+import time
+from telegram.ext import ApplicationBuilder
+import config
+import database
+
+def _rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+def _reminders(count, start):
+    """count reminders for up to 50k chats, spread over the next 24 hours"""
+    types = ('1h', '30m', 'start')
+    return [
+        {
+            'task_id': i // 3,
+            'reminder_type': types[i % 3],
+            'chat_id': 1000 + i % 50000,
+            'task_name': f"Task {i}",
+            'fire_at': start + (i * 60) % 86400,
+        }
+        for i in range(count)
+    ]
+
+async def _save(reminders):
+    # Reminders are only kept for open tasks
+    tasks = {r['task_id']: (r['task_id'], r['chat_id'], f"Task {r['task_id']}") for r in reminders}
+    async with database._write_transaction() as db:
+        await db.executemany(
+            "INSERT INTO tasks (id, user_id, task_name, scheduled_time, date) VALUES (?, ?, ?, '09:00', '2030-01-01')",
+            tasks.values()
+        )
+    for i in range(0, len(reminders), 50000):
+        await database.save_reminders(reminders[i:i + 50000])
+
+async def _noop(context):
+    pass
+
+async def bench_jobs(count):
+    start = int(time.time()) + 120
+    await _save(_reminders(count, start))
+    base = _rss_mb()
+
+    began = time.perf_counter()
+    async with database._read_connection() as db:
+        async with db.execute(
+            "SELECT * FROM reminders WHERE fire_at > ? ORDER BY fire_at", (start - 60,)
+        ) as cursor:
+            rows = await cursor.fetchall()
+    reloaded = time.perf_counter()
+
+    app = ApplicationBuilder().token("123:benchmark").build()
+    for row in rows:
+        app.job_queue.run_once(
+            _noop, datetime.datetime.fromtimestamp(row['fire_at'], config.TIMEZONE),
+            data={'chat_id': row['chat_id'], 'task_name': row['task_name'], 'type': row['reminder_type']}
+        )
+    registered = time.perf_counter()
+    app.job_queue.scheduler.start()
+    started = time.perf_counter()
+    del rows
+    print(f"jobs N={count}: reload query {reloaded - began:.2f}s, register {registered - reloaded:.1f}s, "
+          f"scheduler start {started - registered:.1f}s, RSS {_rss_mb() - base:+.0f} MB")
+    app.job_queue.scheduler.shutdown(wait=False)
+
+async def bench_dispatcher(count):
+    start = int(time.time()) + 120
+    reminders = _reminders(count, start)
+    base = _rss_mb()
+
+    began = time.perf_counter()
+    await _save(reminders)
+    saved = time.perf_counter()
+    del reminders
+    ticks = []
+    for minute in range(5):
+        tick_began = time.perf_counter()
+        due = await database.take_due_reminders(start + minute * 60)
+        ticks.append(time.perf_counter() - tick_began)
+    print(f"dispatcher N={count}: save {saved - began:.1f}s, "
+          f"tick {sum(ticks) / len(ticks) * 1000:.1f} ms for ~{len(due)} due, RSS {_rss_mb() - base:+.0f} MB")
+
+async def run(mode, count):
+    # Never touch the bot's own database
+    scratch = tempfile.mkdtemp(prefix="reminder_benchmark_")
+    database.DB_NAME = os.path.join(scratch, "bench.db")
+    database.ARCHIVE_DB_NAME = os.path.join(scratch, "bench_archive.db")
+    await database.init_db()
+    try:
+        await (bench_jobs if mode == "jobs" else bench_dispatcher)(count)
+    finally:
+        await database.close_db()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pending reminders on a scratch database")
+    parser.add_argument("mode", choices=["jobs", "dispatcher"])
+    parser.add_argument("count", type=int, help="pending reminders")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, force=True)
+    asyncio.run(run(args.mode, args.count))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Message edits that skip the Telegram call when the message would not change"""
+import hashlib
+import logging
+from collections import OrderedDict
+from telegram.error import BadRequest
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Digests of the last render of this many recently edited messages
+MAX_TRACKED_MESSAGES = 10000
+
+# (chat_id, message_id) or inline_message_id -> digest of the last text and markup sent
+_digests = OrderedDict()
+
+def _message_key(query):
+    if query.message is not None:
+        return (query.message.chat_id, query.message.message_id)
+    return query.inline_message_id
+
+def _digest(text, parse_mode, reply_markup, kwargs):
+    markup = reply_markup.to_json() if reply_markup is not None else None
+    rendered = repr((text, parse_mode, markup, sorted(kwargs.items())))
+    return hashlib.blake2b(rendered.encode(), digest_size=16).digest()
+
+def _remember(key, digest):
+    _digests[key] = digest
+    _digests.move_to_end(key)
+    if len(_digests) > MAX_TRACKED_MESSAGES:
+        _digests.popitem(last=False)
+
+async def edit_message(query, text, parse_mode=None, reply_markup=None, **kwargs):
+    """query.edit_message_text, skipped when the message already shows this text and markup.
+
+    Every edit of a callback's message should go through here, otherwise the
+    remembered digest no longer matches what the user sees.
+    """
+    key = _message_key(query)
+    digest = _digest(text, parse_mode, reply_markup, kwargs)
+    if key is not None and _digests.get(key) == digest:
+        # The callback itself was already answered, so the button stops spinning
+        metrics.inc("render.edits_skipped")
+        _digests.move_to_end(key)
+        return None
+    try:
+        result = await query.edit_message_text(text, parse_mode=parse_mode, reply_markup=reply_markup, **kwargs)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            _digests.pop(key, None)
+            raise
+        # Rendered from an older digest (e.g. after a restart), the message is already right
+        metrics.inc("render.not_modified")
+        result = None
+    metrics.inc("render.edits")
+    if key is not None:
+        _remember(key, digest)
+    return result
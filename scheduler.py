@@ -1,14 +1,30 @@
 from telegram.ext import ContextTypes
+import asyncio
 import database
 import config
+import logging
+import metrics
+import outbox
+import utils
 from datetime import datetime, timedelta
 import pytz
+import time
 
-async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
-    job_data = context.job.data
-    task_name = job_data['task_name']
-    chat_id = job_data['chat_id']
-    msg_type = job_data.get('type', 'start')
+logger = logging.getLogger(__name__)
+
+# Reminders found more than this late (e.g. the bot was down) are dropped, not sent
+REMINDER_GRACE = timedelta(minutes=5)
+# Each timezone's morning run starts at this local time; daily_maintenance runs every
+# MAINTENANCE_TICK and picks up the zones whose start falls in the current tick
+MAINTENANCE_START = timedelta(hours=4)
+MAINTENANCE_TICK = timedelta(minutes=15)
+# The startup resume and a bucket's run can cover the same date; one at a time, so
+# each reads the progress the other left and no user is greeted twice
+_maintenance_lock = asyncio.Lock()
+
+def reminder_text(reminder):
+    task_name = reminder['task_name']
+    msg_type = reminder['reminder_type']
     
     # Check if it's a commute task
     is_commute = 'Commute' in task_name or '🚶' in task_name or '🚕' in task_name or '🚌' in task_name
@@ -28,83 +44,254 @@ async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
             text = f"🚀 Time to start: {task_name}"
         else:
             text = f"🚀 Time to start: {task_name}"
-    
-    await context.bot.send_message(chat_id=chat_id, text=text)
+    return text
+
+def send_reminder(reminder):
+    return send_reminders([reminder])
+
+def send_reminders(reminders):
+    """Send reminders for one chat as a single message, one line per reminder"""
+    # Start reminders first, then in firing order
+    reminders = sorted(reminders, key=lambda r: (r['reminder_type'] != 'start', r['fire_at']))
+    text = "\n".join(reminder_text(r) for r in reminders)
+    priority = outbox.PRIORITY_START if reminders[0]['reminder_type'] == 'start' else outbox.PRIORITY_REMINDER
+    return outbox.send(reminders[0]['chat_id'], text, priority)
+
+# Reminder type -> how long before the task it fires
+REMINDER_OFFSETS = [
+    ('1h', timedelta(hours=1)),
+    ('30m', timedelta(minutes=30)),
+    ('start', timedelta(0)),
+]
+
+def _in_quiet_hours(profile, local_dt):
+    start, end = profile['quiet_hours_start'], profile['quiet_hours_end']
+    if not start or not end:
+        return False
+    now_str = local_dt.strftime("%H:%M")
+    if start <= end:
+        return start <= now_str < end
+    # Window wraps past midnight, e.g. 22:00-07:00
+    return now_str >= start or now_str < end
 
-def schedule_task_notifications(job_queue, chat_id, task_name, task_time_obj, task_date_str):
-    """Schedules 1h, 30m, and start time notifications"""
-    # Combine date and time
-    # TIMEZONE is now a timezone object, not a string
-    tz = config.TIMEZONE
+def _reminder_allowed(profile, reminder_type, local_dt):
+    """Whether the user's settings let this reminder be sent; no profile means defaults (all on)"""
+    if profile is None:
+        return True
+    if profile['notification_enabled'] == 0 or profile[f'notification_{reminder_type}'] == 0:
+        return False
+    return not _in_quiet_hours(profile, local_dt)
+
+def _horizon():
+    return timedelta(hours=config.REMINDER_HORIZON_HOURS)
+
+def _lookahead():
+    """How far ahead tasks can have a reminder within the horizon: the earliest fires an hour before"""
+    return _horizon() + max(offset for _, offset in REMINDER_OFFSETS)
+
+def build_reminders(chat_id, task_id, task_name, task_time_obj, task_date_str, profile=None):
+    """1h, 30m and start reminders of a task within the horizon and allowed by profile"""
+    tz = utils.get_timezone(profile['timezone'] if profile else None)
     
     task_datetime_str = f"{task_date_str} {task_time_obj.strftime('%H:%M')}"
-    # Parse as naive datetime - APScheduler will interpret it in the configured timezone
     task_dt_naive = datetime.strptime(task_datetime_str, "%Y-%m-%d %H:%M")
-    
-    # For comparisons, use timezone-aware datetime - use UTC method for consistency
-    task_dt_aware = pytz.utc.localize(task_dt_naive.replace(tzinfo=None)).astimezone(tz)
+    # The task time is wall-clock time in the user's timezone
+    task_dt_aware = tz.localize(task_dt_naive)
     # Get UTC time first, then convert to target timezone to avoid system timezone issues
     now = datetime.now(pytz.utc).astimezone(tz)
+    # Later reminders are added by top_up_reminders once they come within the horizon
+    horizon_end = now + _horizon()
     
-    # Schedule Start Time - pass naive datetime to APScheduler
-    if task_dt_aware > now:
-        job_queue.run_once(
-            send_reminder, 
-            task_dt_naive, 
-            data={'chat_id': chat_id, 'task_name': task_name, 'type': 'start'}
-        )
-        
-    # Schedule 1h before
-    remind_1h_aware = task_dt_aware - timedelta(hours=1)
-    if remind_1h_aware > now:
-        remind_1h_naive = remind_1h_aware.replace(tzinfo=None)
-        job_queue.run_once(
-            send_reminder, 
-            remind_1h_naive, 
-            data={'chat_id': chat_id, 'task_name': task_name, 'type': '1h'}
-        )
-    
-    # Schedule 30m before (for all tasks including commutes)
-    remind_30m_aware = task_dt_aware - timedelta(minutes=30)
-    if remind_30m_aware > now:
-        remind_30m_naive = remind_30m_aware.replace(tzinfo=None)
-        job_queue.run_once(
-            send_reminder, 
-            remind_30m_naive, 
-            data={'chat_id': chat_id, 'task_name': task_name, 'type': '30m'}
-        )
+    reminders = []
+    for reminder_type, offset in REMINDER_OFFSETS:
+        fire_at = task_dt_aware - offset
+        if now < fire_at <= horizon_end and _reminder_allowed(profile, reminder_type, tz.normalize(fire_at)):
+            reminders.append({
+                'task_id': task_id,
+                'reminder_type': reminder_type,
+                'chat_id': chat_id,
+                'task_name': task_name,
+                'fire_at': int(fire_at.timestamp()),
+            })
+    return reminders
+
+async def schedule_task_notifications(chat_id, task_id, task_name, task_time_obj, task_date_str):
+    """Schedules 1h, 30m, and start time notifications; dispatch_reminders sends them when due"""
+    profile = await database.get_notification_profile(chat_id)
+    reminders = build_reminders(chat_id, task_id, task_name, task_time_obj, task_date_str, profile)
+    if reminders:
+        await database.save_reminders(reminders)
+    return reminders
+
+async def reschedule_user_reminders(user_id):
+    """Rebuild a user's pending reminders after their notification settings changed"""
+    profile = await database.get_notification_profile(user_id)
+    now = utils.get_user_now(profile['timezone'] if profile else None).replace(tzinfo=None)
+    # Every task that can have a reminder within the horizon, whatever its date
+    tasks = await database.get_user_upcoming_tasks(user_id, now, now + _lookahead())
+    reminders = []
+    for t in tasks:
+        t_time = datetime.strptime(t['scheduled_time'], "%H:%M").time()
+        reminders += build_reminders(user_id, t['id'], t['task_name'], t_time, t['date'], profile)
+    # One write replaces the whole set: disabled types go, re-enabled ones come back
+    await database.replace_chat_reminders(user_id, reminders)
+    return reminders
+
+async def top_up_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Runs every REMINDER_TOPUP_MINUTES: materializes reminders that have come within the horizon"""
+    now_utc = datetime.now(pytz.utc)
+    lookahead = _lookahead()
+    # '' covers tasks of users without a timezone
+    timezones = set(await database.get_user_timezones()) | {''}
+    reminders = []
+    for tz, names in _timezone_buckets(timezones, now_utc):
+        # Task times are local, so each bucket gets its own window
+        now = now_utc.astimezone(tz).replace(tzinfo=None)
+        for t in await database.get_upcoming_tasks(now, now + lookahead, names):
+            t_time = datetime.strptime(t['scheduled_time'], "%H:%M").time()
+            # The row carries the owner's notification profile
+            reminders += build_reminders(t['user_id'], t['id'], t['task_name'], t_time, t['date'], t)
+    if reminders:
+        # Reminders that are already stored and unchanged are left alone by the upsert
+        await database.save_reminders(reminders)
+    metrics.observe("reminders.topup_size", len(reminders))
+
+def _track_delivery(future, reminders):
+    """Observe fire time -> Telegram acknowledgement per reminder type once a message is sent"""
+    def done(future):
+        if future.cancelled() or not future.result():
+            return
+        acked_at = time.time()
+        for reminder in reminders:
+            metrics.observe(f"reminders.delivery_ms.{reminder['reminder_type']}",
+                            (acked_at - reminder['fire_at']) * 1000)
+    future.add_done_callback(done)
+
+def count_missed_job(event):
+    """APScheduler EVENT_JOB_MISSED listener: a run was skipped, e.g. after an event loop stall"""
+    metrics.inc("jobs.missed")
+    logger.warning(f"Job {event.job_id} missed its run at {event.scheduled_run_time}")
+
+async def dispatch_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Runs every minute: queues every reminder that has come due on the outbox"""
+    ran_at = time.time()
+    now_ts = int(ran_at)
+    due = await database.take_due_reminders(now_ts)
+    metrics.observe("reminders.due_per_tick", len(due))
+    # Everything due for a chat in the same minute goes out as one message
+    batches = {}
+    profiles = {}
+    for reminder in due:
+        if now_ts - reminder['fire_at'] > REMINDER_GRACE.total_seconds():
+            metrics.inc("reminders.expired")
+            continue
+        # Settings may have changed after the reminder was stored (e.g. while a top-up
+        # was running), so check them again with the cached profile
+        chat_id = reminder['chat_id']
+        if chat_id not in profiles:
+            profiles[chat_id] = await database.get_notification_profile(chat_id)
+        profile = profiles[chat_id]
+        tz = utils.get_timezone(profile['timezone'] if profile else None)
+        fire_dt = datetime.fromtimestamp(reminder['fire_at'], tz)
+        if not _reminder_allowed(profile, reminder['reminder_type'], fire_dt):
+            metrics.inc("reminders.suppressed")
+            continue
+        batches.setdefault((reminder['chat_id'], reminder['fire_at'] // 60), []).append(reminder)
+        metrics.inc("reminders.queued")
+        # Intended fire time -> the moment this job ran
+        metrics.observe(f"reminders.fire_lag_ms.{reminder['reminder_type']}",
+                        (ran_at - reminder['fire_at']) * 1000)
+    for reminders in batches.values():
+        _track_delivery(send_reminders(reminders), reminders)
+        metrics.inc("reminders.messages")
+        metrics.inc("reminders.coalesced", len(reminders) - 1)
+
+def _timezone_buckets(timezone_names, now_utc):
+    """Group users.timezone values by their current UTC offset, as [(tz, [names])]"""
+    buckets = {}
+    for name in timezone_names:
+        tz = utils.get_timezone(name)
+        buckets.setdefault(now_utc.astimezone(tz).utcoffset(), (tz, []))[1].append(name)
+    return list(buckets.values())
 
 async def daily_maintenance(context: ContextTypes.DEFAULT_TYPE):
-    """Runs every morning to generate tasks from recurring templates"""
-    users = await database.get_all_users()
-    # TIMEZONE is now a timezone object, not a string
-    tz = config.TIMEZONE
-    # Get UTC time first, then convert to target timezone to avoid system timezone issues
-    today = datetime.now(pytz.utc).astimezone(tz)
+    """Runs every MAINTENANCE_TICK: generates tasks from recurring templates in every
+    timezone bucket where it has just turned MAINTENANCE_START local time"""
+    now_utc = datetime.now(pytz.utc)
+    for tz, names in _timezone_buckets(await database.get_user_timezones(), now_utc):
+        today = now_utc.astimezone(tz)
+        since_midnight = timedelta(hours=today.hour, minutes=today.minute, seconds=today.second)
+        if MAINTENANCE_START <= since_midnight < MAINTENANCE_START + MAINTENANCE_TICK:
+            await _run_maintenance_bucket(today, names)
+
+async def _run_maintenance_bucket(today, timezone_names):
+    date_str = today.strftime("%Y-%m-%d")
+    async with _maintenance_lock:
+        with metrics.timer("maintenance.run_ms"):
+            # Runs of other buckets may still be in progress for yesterday's date
+            await database.prune_maintenance_progress((today - timedelta(days=2)).strftime("%Y-%m-%d"))
+            # One bulk INSERT ... SELECT for the bucket's users instead of a round trip per template;
+            # the users that got tasks are recorded so an interrupted run can resume
+            await database.generate_daily_tasks_bulk(today, track_progress=True, timezones=timezone_names)
+            await _finish_maintenance(date_str)
+
+async def resume_maintenance(context: ContextTypes.DEFAULT_TYPE):
+    """Runs at startup: finishes morning runs that a crash or restart interrupted"""
+    now_utc = datetime.now(pytz.utc)
+    async with _maintenance_lock:
+        with metrics.timer("maintenance.run_ms"):
+            # Every timezone's local date is within a day of the UTC date
+            for days in (-1, 0, 1):
+                await _finish_maintenance((now_utc + timedelta(days=days)).strftime("%Y-%m-%d"))
+
+async def _finish_maintenance(date_str):
+    """Greet and schedule reminders for every user still pending in today's run"""
+    pending = await database.get_pending_maintenance(date_str)
+    if not pending:
+        return
+    logger.info(f"Daily maintenance for {date_str}: {len(pending)} users to process")
     
-    for user_id in users:
-        count = await database.generate_daily_tasks_from_recurring(user_id, today)
-        if count > 0:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"☀️ Good morning! I've added {count} tasks from your recurring schedule."
-            )
-            # Re-fetch tasks to schedule notifications for them
-            tasks = await database.get_tasks(user_id, today.strftime("%Y-%m-%d"))
-            for t in tasks:
-                 # Re-parse time string to object
-                 t_time = datetime.strptime(t['scheduled_time'], "%H:%M").time()
-                 schedule_task_notifications(
-                     context.job_queue, user_id, t['task_name'], t_time, t['date']
-                 )
+    users = iter(pending)
+    async def worker():
+        # Workers share one iterator, so each user is handled exactly once
+        for row in users:
+            try:
+                await _maintain_user(row['user_id'], row['created'], date_str)
+                await database.mark_maintenance_done(date_str, row['user_id'])
+                metrics.inc("maintenance.users")
+            except Exception as e:
+                # One user's failure must not hold up everyone else; it is retried on resume
+                metrics.inc("maintenance.failures")
+                logger.error(f"Daily maintenance failed for user {row['user_id']}: {e}", exc_info=True)
+    
+    await asyncio.gather(*(worker() for _ in range(max(config.MAINTENANCE_CONCURRENCY, 1))))
+
+async def _maintain_user(user_id, count, date_str):
+    outbox.send(
+        user_id,
+        f"☀️ Good morning! I've added {count} tasks from your recurring schedule.",
+        outbox.PRIORITY_SUMMARY
+    )
+    # Re-fetch tasks to schedule notifications for them, saved in one write
+    profile = await database.get_notification_profile(user_id)
+    reminders = []
+    for t in await database.get_tasks(user_id, date_str):
+        # Re-parse time string to object
+        t_time = datetime.strptime(t['scheduled_time'], "%H:%M").time()
+        reminders += build_reminders(user_id, t['id'], t['task_name'], t_time, t['date'], profile)
+    if reminders:
+        await database.save_reminders(reminders)
+
+async def archive_old_tasks(context: ContextTypes.DEFAULT_TYPE):
+    """Runs nightly to move tasks older than ARCHIVE_AFTER_DAYS to the archive database"""
+    before = datetime.now(pytz.utc).astimezone(config.TIMEZONE) - timedelta(days=config.ARCHIVE_AFTER_DAYS)
+    await database.move_tasks_to_archive(before.strftime("%Y-%m-%d"))
 
 async def regenerate_today(update, context):
     """Manual trigger via /sync command"""
     user_id = update.effective_user.id
-    # TIMEZONE is now a timezone object, not a string
-    tz = config.TIMEZONE
-    # Get UTC time first, then convert to target timezone to avoid system timezone issues
-    now = datetime.now(pytz.utc).astimezone(tz)
+    profile = await database.get_notification_profile(user_id)
+    now = utils.get_user_now(profile['timezone'] if profile else None)
     
     count = await database.generate_daily_tasks_from_recurring(user_id, now)
     
@@ -113,8 +300,8 @@ async def regenerate_today(update, context):
         tasks = await database.get_tasks(user_id, now.strftime("%Y-%m-%d"))
         for t in tasks:
                 t_time = datetime.strptime(t['scheduled_time'], "%H:%M").time()
-                schedule_task_notifications(
-                    context.job_queue, user_id, t['task_name'], t_time, t['date']
+                await schedule_task_notifications(
+                    user_id, t['id'], t['task_name'], t_time, t['date']
                 )
 
     await update.message.reply_text(f"🔄 Synced: Generated {count} tasks from your schedule.")
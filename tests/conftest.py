@@ -0,0 +1,30 @@
+"""Shared fixtures: each test runs against its own database files"""
+import asyncio
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """Point the database and its archive at files in a temporary directory"""
+    path = tmp_path / "study_bot.db"
+    monkeypatch.setattr(database, "DB_NAME", str(path))
+    monkeypatch.setattr(database, "ARCHIVE_DB_NAME", str(tmp_path / "study_bot_archive.db"))
+    return path
+
+@pytest.fixture
+def run_db(db_path):
+    """Run a coroutine function with the connection pool open, returns its result"""
+    def run(func):
+        async def main():
+            await database.init_db()
+            try:
+                return await func()
+            finally:
+                await database.close_db()
+        return asyncio.run(main())
+    return run
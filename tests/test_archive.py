@@ -0,0 +1,45 @@
+import os
+import database
+
+async def _add_history():
+    await database.add_user(1)
+    old = await database.add_task(1, 'Math', '09:00', 'High', 'SAT', '2026-01-05')
+    await database.add_task(1, 'Essay', '15:00', 'Medium', 'IELTS', '2026-01-06')
+    await database.add_task(1, 'Read', '10:00', 'Low', None, '2026-10-12')
+    await database.add_tag_to_task(old, 'exam')
+    return old
+
+def test_old_tasks_move_to_the_archive_in_batches(run_db):
+    async def archive():
+        old = await _add_history()
+        moved = await database.move_tasks_to_archive('2026-10-01', batch_size=1)
+        async with database._read_connection() as db:
+            async with db.execute("SELECT id FROM archive.tasks ORDER BY id") as cursor:
+                archived = [row['id'] for row in await cursor.fetchall()]
+        return {
+            'old': old,
+            'moved': moved,
+            'archived': archived,
+            'hot': [t['task_name'] for t in await database.get_tasks_for_week(1, '2026-01-05')],
+            'tags': await database.get_task_tags(old),
+            'by_tag': [t['task_name'] for t in await database.get_tasks_by_tag(1, 'exam')],
+            'stats': await database.get_monthly_stats(1, 2026, 1),
+            'drift': await database.verify_rollup(),
+        }
+
+    result = run_db(archive)
+    assert result['moved'] == 2
+    assert result['archived'][0] == result['old'] and len(result['archived']) == 2
+    assert result['hot'] == []
+    assert result['tags'] == ['exam'] and result['by_tag'] == ['Math']
+    assert result['stats']['total'] == 2
+    assert result['drift'] == []
+
+def test_missing_archive_file_is_recreated(db_path, run_db):
+    run_db(_add_history)
+    os.remove(database.ARCHIVE_DB_NAME)
+
+    async def reopen():
+        return [t['task_name'] for t in await database.get_archived_tasks(1)], await database.verify_rollup()
+
+    assert run_db(reopen) == ([], [])
@@ -0,0 +1,32 @@
+import asyncio
+import config
+import database
+import scheduler
+import utils
+
+def test_resume_and_bucket_run_greet_each_user_once(run_db, monkeypatch):
+    greeted = []
+
+    async def maintain_user(user_id, count, date_str):
+        greeted.append(user_id)
+        # Long enough for the other run to read the progress table meanwhile
+        await asyncio.sleep(0.05)
+
+    monkeypatch.setattr(scheduler, "_maintain_user", maintain_user)
+
+    async def overlap():
+        today = utils.get_user_now()
+        for user_id in (1, 2):
+            await database.add_user(user_id)
+            await database.add_recurring_template(user_id, today.strftime("%A").upper(), 'Math', '09:00', 'High', 'SAT')
+        # A run cut short after generating: both users still pending
+        await database.generate_daily_tasks_bulk(today, track_progress=True)
+        await asyncio.gather(
+            scheduler.resume_maintenance(None),
+            scheduler._run_maintenance_bucket(today, [config.DEFAULT_TIMEZONE_NAME]),
+        )
+        return await database.get_pending_maintenance(today.strftime("%Y-%m-%d"))
+
+    pending = run_db(overlap)
+    assert sorted(greeted) == [1, 2]
+    assert pending == []
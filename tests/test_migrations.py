@@ -0,0 +1,199 @@
+import sqlite3
+from datetime import datetime
+import database
+
+# Schema and data as the bot left them before migrations were versioned (user_version 0)
+BASELINE_SCHEMA = """
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        timezone TEXT DEFAULT 'Asia/Almaty',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        notification_enabled BOOLEAN DEFAULT 1,
+        quiet_hours_start TEXT DEFAULT NULL,
+        quiet_hours_end TEXT DEFAULT NULL,
+        notification_1h BOOLEAN DEFAULT 1,
+        notification_30m BOOLEAN DEFAULT 1,
+        notification_start BOOLEAN DEFAULT 1
+    );
+    CREATE TABLE tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        task_name TEXT,
+        scheduled_time TEXT,
+        priority TEXT,
+        category TEXT,
+        status TEXT DEFAULT 'pending',
+        date TEXT,
+        duration INTEGER DEFAULT 0,
+        notes TEXT DEFAULT '',
+        tags TEXT DEFAULT '',
+        archived BOOLEAN DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(user_id)
+    );
+    CREATE TABLE recurring_tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        day_of_week TEXT,
+        task_name TEXT,
+        scheduled_time TEXT,
+        priority TEXT,
+        category TEXT
+    );
+    CREATE TABLE goals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        title TEXT,
+        description TEXT,
+        target_date TEXT,
+        goal_type TEXT,
+        progress INTEGER DEFAULT 0,
+        target_value INTEGER DEFAULT 100,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE milestones (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        goal_id INTEGER,
+        title TEXT,
+        achieved BOOLEAN DEFAULT 0,
+        achieved_at TIMESTAMP
+    );
+    CREATE TABLE daily_journal (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        date TEXT,
+        entry_text TEXT,
+        mood TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(user_id, date)
+    );
+    CREATE TABLE custom_categories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        category_name TEXT,
+        emoji TEXT DEFAULT '🔹',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(user_id, category_name)
+    );
+    CREATE TABLE task_tags (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task_id INTEGER,
+        tag_name TEXT
+    );
+
+    INSERT INTO users (user_id, quiet_hours_start, quiet_hours_end) VALUES (1, '22:00', '07:00');
+    INSERT INTO users (user_id, timezone) VALUES (2, NULL);
+    INSERT INTO tasks (user_id, task_name, scheduled_time, priority, category, status, date) VALUES
+        (1, 'Math', '09:00', 'High', 'SAT', 'pending', '2026-10-12'),
+        (1, 'Math', '09:00', 'High', 'SAT', 'done', '2026-10-12'),
+        (1, '🍽️ Lunch', '12:00', 'Low', 'Other', 'done', '2026-10-12'),
+        (1, 'Essay', '15:00', 'Medium', 'IELTS', 'done', '2026-10-12'),
+        (2, 'Read', '10:00', 'Low', NULL, 'pending', '2026-10-13');
+    INSERT INTO task_tags (task_id, tag_name) VALUES (1, 'exam'), (4, 'writing');
+    INSERT INTO recurring_tasks (user_id, day_of_week, task_name, scheduled_time, priority, category) VALUES
+        (1, 'MONDAY', 'Math', '09:00', 'High', 'SAT'),
+        (1, 'MONDAY', '🚌 Road Home', '14:00', 'Low', 'Other');
+    INSERT INTO goals (user_id, title, target_date, goal_type) VALUES (1, 'SAT 1500', '2026-12-01', 'score');
+    INSERT INTO daily_journal (user_id, date, entry_text, mood) VALUES (1, '2026-10-12', 'Good day', '🙂');
+"""
+
+# The first schema the bot ever created: three tables, tasks without the feature columns
+ORIGINAL_SCHEMA = """
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        timezone TEXT DEFAULT 'Asia/Almaty',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        notification_enabled BOOLEAN DEFAULT 1
+    );
+    CREATE TABLE tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        task_name TEXT,
+        scheduled_time TEXT,
+        priority TEXT,
+        category TEXT,
+        status TEXT DEFAULT 'pending',
+        date TEXT,
+        FOREIGN KEY(user_id) REFERENCES users(user_id)
+    );
+    CREATE TABLE recurring_tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        day_of_week TEXT,
+        task_name TEXT,
+        scheduled_time TEXT,
+        priority TEXT,
+        category TEXT
+    );
+
+    INSERT INTO users (user_id) VALUES (1);
+    INSERT INTO tasks (user_id, task_name, scheduled_time, priority, category, status, date) VALUES
+        (1, 'Math', '09:00', 'High', 'SAT', 'done', '2026-10-12');
+    INSERT INTO recurring_tasks (user_id, day_of_week, task_name, scheduled_time, priority, category) VALUES
+        (1, 'TUESDAY', 'Essay', '15:00', 'Medium', 'IELTS');
+"""
+
+def _create_baseline(path, schema=BASELINE_SCHEMA):
+    conn = sqlite3.connect(path)
+    conn.executescript(schema)
+    conn.close()
+
+def test_baseline_database_upgrades_to_latest_version(db_path, run_db):
+    _create_baseline(db_path)
+
+    async def upgraded():
+        async with database._read_connection() as db:
+            async with db.execute("PRAGMA user_version") as cursor:
+                version = (await cursor.fetchone())[0]
+        return {
+            'version': version,
+            'tasks': [dict(t) for t in await database.get_tasks(1, '2026-10-12')],
+            'other_user': [dict(t) for t in await database.get_tasks(2, '2026-10-13')],
+            'settings': dict(await database.get_user_settings(1)),
+            'recurring': await database.get_recurring_tasks_for_day(1, 'MONDAY', real_only=True),
+            'tags': [t['task_name'] for t in await database.get_tasks_by_tag(1, 'exam')],
+            'journal': dict(await database.get_journal_entry(1, '2026-10-12')),
+            'goals': await database.get_goals(1, active_only=False),
+            'stats': await database.get_user_stats(1, '2026-10-12'),
+            'drift': await database.verify_rollup(),
+            'pending': (await database.get_pending_migrations())[1],
+        }
+
+    result = run_db(upgraded)
+    assert result['version'] == database.SCHEMA_VERSION
+    assert result['pending'] == []
+    # The duplicate Math keeps its completed copy and the tag of the removed one
+    assert [(t['task_name'], t['status'], t['is_real']) for t in result['tasks']] == [
+        ("Math", "done", 1), ("🍽️ Lunch", "done", 0), ("Essay", "done", 1)
+    ]
+    assert result['tags'] == ["Math"]
+    assert [t['task_name'] for t in result['other_user']] == ["Read"]
+    assert (result['settings']['quiet_hours_start'], result['settings']['quiet_hours_end']) == ("22:00", "07:00")
+    assert [t['task_name'] for t in result['recurring']] == ["Math"]
+    assert result['journal']['entry_text'] == "Good day"
+    assert [g['title'] for g in result['goals']] == ["SAT 1500"]
+    assert result['stats']['today_total'] == 2 and result['stats']['today_done'] == 2
+    assert result['drift'] == []
+
+def test_original_database_keeps_task_timestamps(db_path, run_db):
+    _create_baseline(db_path, ORIGINAL_SCHEMA)
+
+    async def inserted():
+        await database.add_task(1, 'Physics', '10:00', 'High', 'SAT', '2026-10-12')
+        await database.add_task_future(1, 'Chemistry', '11:00', 'Low', 'SAT', '2026-10-14')
+        # 2026-10-13 is a Tuesday
+        await database.generate_daily_tasks_from_recurring(1, datetime(2026, 10, 13))
+        async with database._read_connection() as db:
+            async with db.execute("SELECT task_name, created_at, updated_at FROM tasks ORDER BY id") as cursor:
+                return [tuple(row) for row in await cursor.fetchall()]
+
+    tasks = run_db(inserted)
+    assert [name for name, _, _ in tasks] == ["Math", "Physics", "Chemistry", "Essay"]
+    assert all(created and updated for _, created, updated in tasks)
+
+def test_migrations_run_once(run_db):
+    async def reapply():
+        return await database.apply_migrations()
+
+    assert run_db(reapply) == []
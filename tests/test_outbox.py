@@ -0,0 +1,92 @@
+import asyncio
+import pytest
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+import outbox
+
+class StubBot:
+    """Stands in for the Bot API: records each send_message, raising the errors given per text first"""
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.calls = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append((asyncio.get_running_loop().time(), chat_id, text))
+        errors = self.errors.get(text)
+        if errors:
+            raise errors.pop(0)
+
+@pytest.fixture(autouse=True)
+def fresh_outbox(monkeypatch):
+    """Fast limits and empty module state for every test"""
+    monkeypatch.setattr(outbox, "OUTBOX_GLOBAL_RATE", 1000.0)
+    monkeypatch.setattr(outbox, "OUTBOX_CHAT_INTERVAL", 0.0)
+    monkeypatch.setattr(outbox, "OUTBOX_MAX_RETRIES", 3)
+    monkeypatch.setattr(outbox, "OUTBOX_CONCURRENCY", 8)
+    monkeypatch.setattr(outbox, "_heap", [])
+    monkeypatch.setattr(outbox, "_chat_ready_at", {})
+    monkeypatch.setattr(outbox, "_paused_until", 0.0)
+
+def _deliver(bot, messages):
+    """Queue (chat_id, text, priority) messages at once, returns each send's result"""
+    async def run():
+        outbox.start(bot)
+        try:
+            futures = [outbox.send(chat_id, text, priority) for chat_id, text, priority in messages]
+            return await asyncio.gather(*futures)
+        finally:
+            await outbox.stop()
+    return asyncio.run(run())
+
+def test_global_rate(monkeypatch):
+    monkeypatch.setattr(outbox, "OUTBOX_GLOBAL_RATE", 50.0)
+    bot = StubBot()
+    _deliver(bot, [(chat_id, "hi", outbox.PRIORITY_REMINDER) for chat_id in range(11)])
+    times = [at for at, _, _ in bot.calls]
+    # Evenly paced, no burst: 10 intervals of 20 ms
+    assert times[-1] - times[0] >= 0.19
+    assert min(b - a for a, b in zip(times, times[1:])) >= 0.015
+
+def test_per_chat_interval(monkeypatch):
+    monkeypatch.setattr(outbox, "OUTBOX_CHAT_INTERVAL", 0.2)
+    bot = StubBot()
+    _deliver(bot, [(1, "a1", 1), (1, "a2", 1), (1, "a3", 1), (2, "b1", 1)])
+    chat_1 = [at for at, chat_id, _ in bot.calls if chat_id == 1]
+    assert all(b - a >= 0.19 for a, b in zip(chat_1, chat_1[1:]))
+    # The other chat does not wait behind chat 1
+    assert [text for _, _, text in bot.calls][:2] == ["a1", "b1"]
+
+def test_priority_order(monkeypatch):
+    monkeypatch.setattr(outbox, "OUTBOX_CONCURRENCY", 1)
+    bot = StubBot()
+    _deliver(bot, [
+        (1, "summary", outbox.PRIORITY_SUMMARY),
+        (2, "1h", outbox.PRIORITY_REMINDER),
+        (3, "start", outbox.PRIORITY_START),
+        (4, "30m", outbox.PRIORITY_REMINDER),
+    ])
+    assert [text for _, _, text in bot.calls] == ["start", "1h", "30m", "summary"]
+
+def test_retry_after_pauses_every_chat(monkeypatch):
+    monkeypatch.setattr(outbox, "OUTBOX_CONCURRENCY", 1)
+    bot = StubBot({"a": [RetryAfter(0.3)]})
+    results = _deliver(bot, [(1, "a", 1), (2, "b", 1)])
+    assert results == [True, True]
+    first_try, *rest = bot.calls
+    # b was already picked when a hit flood control, and still waits out the pause
+    assert sorted(text for _, _, text in rest) == ["a", "b"]
+    assert all(at - first_try[0] >= 0.29 for at, _, _ in rest)
+
+@pytest.mark.parametrize("error", [Forbidden("bot was blocked by the user"), BadRequest("Chat not found")])
+def test_permanent_errors_drop_without_retry(error):
+    bot = StubBot({"a": [error]})
+    assert _deliver(bot, [(1, "a", 1), (2, "b", 1)]) == [False, True]
+    assert [text for _, _, text in bot.calls].count("a") == 1
+
+def test_retry_budget(monkeypatch):
+    monkeypatch.setattr(outbox, "OUTBOX_MAX_RETRIES", 1)
+    bot = StubBot({"a": [NetworkError("timed out")] * 5, "b": [NetworkError("timed out")]})
+    # Backs off 1s before the retry; a gets one retry and is dropped, b succeeds on it
+    assert _deliver(bot, [(1, "a", 1), (2, "b", 1)]) == [False, True]
+    texts = [text for _, _, text in bot.calls]
+    assert texts.count("a") == 2 and texts.count("b") == 2
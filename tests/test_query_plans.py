@@ -0,0 +1,25 @@
+import database
+
+def test_hot_queries_use_an_index(run_db):
+    offenders = run_db(database.check_query_plans)
+    assert offenders == []
+
+def test_hot_queries_name_real_functions():
+    for name, _ in database.HOT_QUERIES:
+        assert callable(getattr(database, name.split()[0], None)), name
+
+def test_every_index_serves_a_hot_query(run_db):
+    # Unique indexes enforce constraints; any other index only costs writes unless a query reads it
+    async def unused():
+        async with database._read_connection() as db:
+            async with db.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE%'"
+            ) as cursor:
+                names = {row['name'] for row in await cursor.fetchall()}
+            for _, sql in database.HOT_QUERIES:
+                async with db.execute(f"EXPLAIN QUERY PLAN {sql}", (1,) * sql.count("?")) as cursor:
+                    plan = " ".join(row[3] for row in await cursor.fetchall())
+                names = {name for name in names if f" {name} " not in f" {plan} "}
+        return names
+
+    assert run_db(unused) == set()
@@ -0,0 +1,32 @@
+import database
+
+async def _add_legacy_rows():
+    # Rows written before the is_real column existed keep it NULL
+    await database.add_user(1)
+    async with database._write_transaction() as db:
+        await db.executemany(
+            "INSERT INTO tasks (user_id, task_name, scheduled_time, status, date) VALUES (1, ?, ?, 'pending', '2026-10-12')",
+            [("Math", "09:00"), ("🍽️ Lunch", "12:00"), ("Essay", "15:00")]
+        )
+        await db.executemany(
+            "INSERT INTO recurring_tasks (user_id, day_of_week, task_name, scheduled_time) VALUES (1, 'MONDAY', ?, ?)",
+            [("Math", "09:00"), ("🚌 Road Home", "14:00")]
+        )
+        database._touch_timeline(1, '2026-10-12')
+
+def test_null_is_real_falls_back_to_the_task_name(run_db):
+    async def check():
+        await _add_legacy_rows()
+        real = await database.get_tasks(1, '2026-10-12', real_only=True)
+        missed = await database.get_incomplete_tasks(1, '2026-10-12', '13:00', real_only=True)
+        snapshot = await database.get_day_snapshot(1, '2026-10-12', '10:00')
+        recurring = await database.get_recurring_tasks_for_day(1, 'MONDAY', real_only=True)
+        return real, missed, snapshot, recurring
+
+    real, missed, snapshot, recurring = run_db(check)
+    assert [t['task_name'] for t in real] == ["Math", "Essay"]
+    assert [t['task_name'] for t in missed] == ["Math"]
+    tasks = snapshot['tasks']
+    assert tasks[snapshot['next']]['task_name'] == "Essay"
+    assert [tasks[i]['task_name'] for i in snapshot['missed']] == ["Math"]
+    assert [t['task_name'] for t in recurring] == ["Math"]
@@ -0,0 +1,79 @@
+import time
+from datetime import datetime, timedelta
+import config
+import database
+import metrics
+import scheduler
+import utils
+
+def _tomorrow():
+    return (utils.get_user_now() + timedelta(days=1)).strftime("%Y-%m-%d")
+
+def test_reschedule_covers_tasks_after_today(run_db, monkeypatch):
+    monkeypatch.setattr(config, "REMINDER_HORIZON_HOURS", 48)
+
+    async def reschedule():
+        await database.add_user(1)
+        await database.add_task_future(1, 'Math', '10:00', 'High', 'SAT', _tomorrow())
+        before = await scheduler.reschedule_user_reminders(1)
+        await database.update_quiet_hours(1, '08:00', '11:00')
+        after = await scheduler.reschedule_user_reminders(1)
+        async with database._read_connection() as db:
+            async with db.execute("SELECT reminder_type FROM reminders WHERE chat_id = 1") as cursor:
+                stored = [row['reminder_type'] for row in await cursor.fetchall()]
+        return before, after, stored
+
+    before, after, stored = run_db(reschedule)
+    assert sorted(r['reminder_type'] for r in before) == ['1h', '30m', 'start']
+    # 09:00, 09:30 and 10:00 tomorrow all fall in the new quiet hours
+    assert after == [] and stored == []
+
+def test_dispatch_checks_current_settings(run_db, monkeypatch):
+    sent = []
+    monkeypatch.setattr(scheduler, "send_reminders", lambda reminders: sent.append(reminders))
+
+    async def dispatch():
+        await database.add_user(1)
+        task_id = await database.add_task(1, 'Math', '10:00', 'High', 'SAT', utils.get_today_str())
+        # Stored earlier, now due
+        fire_at = int(time.time()) - 10
+        async with database._write_transaction() as db:
+            await db.execute(
+                "INSERT INTO reminders (task_id, reminder_type, chat_id, task_name, fire_at) VALUES (?, 'start', 1, 'Math', ?)",
+                (task_id, fire_at)
+            )
+        # Changed without rescheduling, e.g. while a top-up had already read the old settings
+        fire_dt = datetime.fromtimestamp(fire_at, config.TIMEZONE)
+        await database.update_quiet_hours(
+            1, (fire_dt - timedelta(minutes=5)).strftime("%H:%M"), (fire_dt + timedelta(minutes=5)).strftime("%H:%M")
+        )
+        suppressed = metrics.snapshot()['counters'].get('reminders.suppressed', 0)
+        await scheduler.dispatch_reminders(None)
+        return metrics.snapshot()['counters'].get('reminders.suppressed', 0) - suppressed
+
+    assert run_db(dispatch) == 1
+    assert sent == []
+
+def test_reminder_taken_by_the_dispatcher_is_not_saved_again(run_db):
+    async def take_then_save():
+        await database.add_user(1)
+        task_id = await database.add_task(1, 'Math', '10:00', 'High', 'SAT', utils.get_today_str())
+        now = int(time.time())
+        due = {'task_id': task_id, 'reminder_type': 'start', 'chat_id': 1, 'task_name': 'Math', 'fire_at': now - 5}
+        async with database._write_transaction() as db:
+            await db.execute(
+                "INSERT INTO reminders (task_id, reminder_type, chat_id, task_name, fire_at) "
+                "VALUES (:task_id, :reminder_type, :chat_id, :task_name, :fire_at)", due
+            )
+        first = await database.take_due_reminders(now)
+        # A top-up built before the tick, whose queued write lands after it
+        await database.save_reminders([due, dict(due, reminder_type='1h', fire_at=now + 3600)])
+        second = await database.take_due_reminders(now)
+        async with database._read_connection() as db:
+            async with db.execute("SELECT reminder_type FROM reminders") as cursor:
+                stored = [row['reminder_type'] for row in await cursor.fetchall()]
+        return first, second, stored
+
+    first, second, stored = run_db(take_then_save)
+    assert [r['reminder_type'] for r in first] == ['start']
+    assert second == [] and stored == ['1h']
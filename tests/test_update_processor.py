@@ -0,0 +1,49 @@
+import asyncio
+import time
+from telegram import CallbackQuery, Update, User
+from update_processor import PerUserUpdateProcessor
+
+def _update(update_id, user_id):
+    return Update(update_id, callback_query=CallbackQuery(str(update_id), User(user_id, "u", False), "ci", data="x"))
+
+async def _process_all(processor, updates):
+    """Feed updates to the processor like Application does: one task each, in arrival order"""
+    log = []
+    started_at = time.perf_counter()
+
+    async def handle(update_id, user_id, seconds):
+        log.append(("start", user_id, update_id, time.perf_counter() - started_at))
+        await asyncio.sleep(seconds)
+        log.append(("end", user_id, update_id, time.perf_counter() - started_at))
+
+    async with processor:
+        tasks = [
+            asyncio.create_task(processor.process_update(_update(i, user_id), handle(i, user_id, seconds)))
+            for i, (user_id, seconds) in enumerate(updates)
+        ]
+        await asyncio.gather(*tasks)
+    return log
+
+def test_one_users_backlog_does_not_delay_others():
+    # 16 slow updates of user 1 arrive before user 2's, with 4 handler slots
+    updates = [(1, 0.2)] * 16 + [(2, 0.01)]
+    log = asyncio.run(_process_all(PerUserUpdateProcessor(4), updates))
+    user_2_start = next(at for event, user_id, _, at in log if event == "start" and user_id == 2)
+    assert user_2_start < 0.1
+
+def test_each_users_updates_run_one_at_a_time_in_order():
+    updates = [(1, 0.03), (2, 0.01), (1, 0.01), (2, 0.02), (1, 0.01)]
+    log = asyncio.run(_process_all(PerUserUpdateProcessor(4), updates))
+    for user_id in (1, 2):
+        events = [(event, update_id) for event, uid, update_id, _ in log if uid == user_id]
+        ids = [update_id for update_id, (uid, _) in enumerate(updates) if uid == user_id]
+        assert events == [(event, i) for i in ids for event in ("start", "end")]
+
+def test_handlers_never_exceed_the_concurrency():
+    updates = [(user_id, 0.02) for user_id in range(10)]
+    log = asyncio.run(_process_all(PerUserUpdateProcessor(3), updates))
+    running = peak = 0
+    for event, *_ in sorted(log, key=lambda entry: (entry[3], entry[0] == "start")):
+        running += 1 if event == "start" else -1
+        peak = max(peak, running)
+    assert peak == 3
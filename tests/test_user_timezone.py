@@ -0,0 +1,28 @@
+from datetime import datetime, timedelta
+import pytz
+import config
+import database
+import utils
+
+def test_stats_count_today_in_the_users_timezone(run_db, monkeypatch):
+    # UTC-11 by default and UTC+14 for the user: their dates always differ by one day
+    monkeypatch.setattr(config, "TIMEZONE", pytz.FixedOffset(-11 * 60))
+    # get_timezone caches the default zone
+    utils.get_timezone.cache_clear()
+    local_today = utils.get_today_str("Pacific/Kiritimati")
+    local_yesterday = (datetime.strptime(local_today, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
+    assert utils.get_today_str() == local_yesterday
+
+    async def stats():
+        await database.add_user(1, timezone="Pacific/Kiritimati")
+        await database.add_task_future(1, 'Math', '09:00', 'High', 'SAT', local_yesterday)
+        task_id = await database.add_task_future(1, 'Essay', '10:00', 'High', 'SAT', local_today)
+        await database.update_task_status(task_id, 'done')
+        return await database.get_user_stats(1, local_today)
+
+    try:
+        result = run_db(stats)
+    finally:
+        utils.get_timezone.cache_clear()
+    # Yesterday was missed, today is done: a streak of one
+    assert result['today_done'] == 1 and result['streak'] == 1
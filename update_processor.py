@@ -0,0 +1,104 @@
+"""Concurrent update processing that keeps each user's updates in order"""
+import asyncio
+import collections
+import logging
+import sys
+import time
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Runs up to `concurrency` handlers at once, but one update at a time per user.
+
+    Updates of one user (button presses, conversation steps) are handled in the order
+    they arrived, so ConversationHandler state transitions stay consistent, while a slow
+    update of one user no longer holds up everyone else.
+
+    Each user has a queue; only the update at its head waits for a handler slot, the
+    rest wait in the queue without holding anything, so one user's backlog cannot
+    delay other users.
+    """
+
+    def __init__(self, concurrency):
+        # PTB takes its own semaphore before calling do_process_update, for as long as
+        # that call lasts; it must never be the limit, or updates queued behind one
+        # user would hold it. The handler limit is self._slots.
+        super().__init__(sys.maxsize)
+        self._slots = asyncio.Semaphore(max(concurrency, 1))
+        # user or chat id -> deque of (coroutine, queued_at) not started yet
+        self._queues = {}
+        self._waiting = 0
+        self._in_flight = 0
+
+    @staticmethod
+    def _key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._key(update)
+        self._waiting += 1
+        self._update_gauges()
+        if key is None:
+            await self._run(coroutine, time.perf_counter())
+            return
+        queue = self._queues.get(key)
+        if queue is not None:
+            # Handled by the call already draining this user's queue
+            queue.append((coroutine, time.perf_counter()))
+            return
+        queue = self._queues[key] = collections.deque([(coroutine, time.perf_counter())])
+        try:
+            while queue:
+                try:
+                    await self._run(*queue.popleft())
+                except Exception:
+                    # Application.process_update handles handler errors itself; anything
+                    # else must not stop the user's later updates
+                    logger.exception(f"Processing an update of {key} failed")
+        finally:
+            del self._queues[key]
+            # Cancelled, e.g. at shutdown: the rest of the queue never runs
+            for coroutine, _ in queue:
+                coroutine.close()
+                self._waiting -= 1
+            self._update_gauges()
+
+    async def _run(self, coroutine, queued_at):
+        started = False
+        try:
+            async with self._slots:
+                started = True
+                self._waiting -= 1
+                self._in_flight += 1
+                self._update_gauges()
+                metrics.observe("updates.wait_ms", (time.perf_counter() - queued_at) * 1000)
+                try:
+                    await coroutine
+                finally:
+                    self._in_flight -= 1
+                    self._update_gauges()
+        finally:
+            if not started:
+                # Cancelled while waiting for a slot
+                coroutine.close()
+                self._waiting -= 1
+                self._update_gauges()
+
+    def _update_gauges(self):
+        metrics.set_gauge("updates.in_flight", self._in_flight)
+        metrics.set_gauge("updates.waiting", self._waiting)
+
+    async def initialize(self):
+        """Nothing to set up"""
+
+    async def shutdown(self):
+        """Nothing to release"""
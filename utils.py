@@ -1,20 +1,30 @@
 from datetime import datetime, timedelta
+from functools import lru_cache
 import pytz
 import config
 
-def get_user_now():
-    """Get current time in configured timezone"""
-    # TIMEZONE is now a timezone object, not a string
-    tz = config.TIMEZONE
+@lru_cache(maxsize=None)
+def get_timezone(timezone_name=None):
+    """Timezone object for a users.timezone value, config.TIMEZONE for the default or unknown zones"""
+    if not timezone_name or timezone_name == config.DEFAULT_TIMEZONE_NAME:
+        return config.TIMEZONE
+    try:
+        return pytz.timezone(timezone_name)
+    except pytz.UnknownTimeZoneError:
+        return config.TIMEZONE
+
+def get_user_now(timezone_name=None):
+    """Get current time in the user's timezone (configured timezone by default)"""
+    tz = get_timezone(timezone_name)
     # Get UTC time first, then convert to target timezone to avoid system timezone issues
     utc_now = datetime.now(pytz.utc)
     return utc_now.astimezone(tz)
 
-def get_today_str():
-    return get_user_now().strftime("%Y-%m-%d")
+def get_today_str(timezone_name=None):
+    return get_user_now(timezone_name).strftime("%Y-%m-%d")
 
-def get_tomorrow_str():
-    return (get_user_now() + timedelta(days=1)).strftime("%Y-%m-%d")
+def get_tomorrow_str(timezone_name=None):
+    return (get_user_now(timezone_name) + timedelta(days=1)).strftime("%Y-%m-%d")
 
 def parse_time(time_str):
     try:
@@ -64,8 +74,18 @@ def is_real_task(task_name):
     
     return True
 
+def task_is_real(task):
+    """Use the stored is_real flag, classifying by name only for legacy rows"""
+    try:
+        flag = task['is_real']
+    except (IndexError, KeyError):
+        flag = None
+    if flag is None:
+        return is_real_task(task['task_name'])
+    return bool(flag)
+
 def filter_real_tasks(tasks):
     """Filter out non-task items from a list of tasks"""
     if not tasks:
         return []
-    return [task for task in tasks if is_real_task(task['task_name'])]
+    return [task for task in tasks if task_is_real(task)]
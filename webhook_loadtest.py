@@ -0,0 +1,292 @@
+"""Replay Telegram updates through the bot's handlers and report end-to-end latency and throughput.
+
+The bot's handlers and update processor run in this process, on a scratch database,
+with Telegram replaced by a local stand-in that answers every Bot API call after
+--api-latency-ms. Each update is timed from the moment it is offered until its
+handler has finished, over two transports:
+
+  webhook: updates are POSTed to the bot's webhook server; the time Telegram would
+           wait for the HTTP response is reported as well
+  polling: updates are returned by getUpdates to the polling updater, the baseline
+
+Updates come from a file with one JSON update per line (e.g. copied from logs of a
+test bot), or are generated with --synthetic as menu button presses of many users.
+
+    python webhook_loadtest.py --synthetic 5000 --users 200 --rate 500
+    python webhook_loadtest.py updates.jsonl --transport webhook --concurrency 50
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+import httpx
+from telegram import Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+from telegram.request import BaseRequest
+import bot
+import config
+import database
+import metrics
+import render
+from update_processor import PerUserUpdateProcessor
+
+MENU_BUTTONS = ['what_now', 'whats_next', 'what_missed', 'view_today', 'mark_done', 'stats', 'view_tomorrow']
+
+def synthetic_updates(count, users):
+    """Callback query updates pressing random menu buttons"""
+    for update_id in range(1, count + 1):
+        user_id = random.randint(1, users)
+        user = {'id': user_id, 'is_bot': False, 'first_name': f"load{user_id}"}
+        yield {
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'from': user,
+                'chat_instance': str(user_id),
+                'data': random.choice(MENU_BUTTONS),
+                'message': {
+                    'message_id': 1,
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'text': "🏠 Main Menu",
+                },
+            },
+        }
+
+def recorded_updates(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+class LocalBotAPI(BaseRequest):
+    """Stands in for Telegram: every Bot API call succeeds after a fixed delay.
+
+    getUpdates long-polls the updates given to push(), so the polling updater
+    can be driven like the webhook server.
+    """
+
+    def __init__(self, latency):
+        self._latency = latency
+        self._updates = asyncio.Queue()
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        """Nothing to set up"""
+
+    async def shutdown(self):
+        """Nothing to release"""
+
+    def push(self, update):
+        self._updates.put_nowait(update)
+
+    async def _get_updates(self, limit, timeout):
+        try:
+            updates = [await asyncio.wait_for(self._updates.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        while len(updates) < limit and not self._updates.empty():
+            updates.append(self._updates.get_nowait())
+        return updates
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data is not None else {}
+        await asyncio.sleep(self._latency)
+        if endpoint == "getUpdates":
+            result = await self._get_updates(params.get('limit', 100), params.get('timeout') or 0)
+        elif endpoint == "getMe":
+            result = {'id': 1, 'is_bot': True, 'first_name': "loadtest", 'username': "loadtest_bot"}
+        elif endpoint in ("sendMessage", "editMessageText"):
+            result = {
+                'message_id': params.get('message_id', 1),
+                'date': int(time.time()),
+                'chat': {'id': params.get('chat_id', 0), 'type': 'private'},
+                'text': params.get('text', ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+class Completions:
+    """Times each update from the moment it is offered until its handlers are done"""
+
+    def __init__(self, transport, expected):
+        self.transport = transport
+        self.expected = expected
+        self.offered = {}
+        self.completed = 0
+        self.errors = 0
+        self.all_done = asyncio.Event()
+
+    def offer(self, update):
+        self.offered[update['update_id']] = time.perf_counter()
+
+    async def handler_done(self, update, context):
+        # Registered in a later group than the bot's handlers, so it runs after them
+        offered_at = self.offered.pop(update.update_id, None)
+        if offered_at is None:
+            return
+        metrics.observe(f"loadtest.{self.transport}.e2e_ms", (time.perf_counter() - offered_at) * 1000)
+        self.completed += 1
+        if self.completed == self.expected:
+            self.all_done.set()
+
+    async def handler_error(self, update, context):
+        self.errors += 1
+
+def build_application(api, completions):
+    application = (
+        ApplicationBuilder()
+        .token("123:loadtest")
+        .request(api)
+        .get_updates_request(api)
+        .concurrent_updates(PerUserUpdateProcessor(config.UPDATE_CONCURRENCY))
+        .job_queue(None)
+        .build()
+    )
+    bot.add_handlers(application)
+    application.add_handler(TypeHandler(Update, completions.handler_done), group=1)
+    application.add_error_handler(completions.handler_error)
+    return application
+
+async def offer_all(updates, rate, send):
+    """Call send(update) for every update, rate per second (0 for all at once)"""
+    started = time.perf_counter()
+    sends = []
+    for i, update in enumerate(updates):
+        if rate:
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        sends.append(asyncio.create_task(send(update)))
+    await asyncio.gather(*sends)
+
+async def replay(transport, updates, args):
+    """Run the updates through a fresh bot, returns (completions, seconds, http statuses)"""
+    # A fresh scratch database and render state per run, so runs do not warm each other up
+    scratch = tempfile.mkdtemp(prefix="webhook_loadtest_")
+    database.DB_NAME = os.path.join(scratch, "loadtest.db")
+    database.ARCHIVE_DB_NAME = os.path.join(scratch, "loadtest_archive.db")
+    render._digests.clear()
+    await database.init_db()
+
+    api = LocalBotAPI(args.api_latency_ms / 1000)
+    completions = Completions(transport, len(updates))
+    application = build_application(api, completions)
+    statuses = {}
+    client = None
+    await application.initialize()
+    await application.start()
+    try:
+        if transport == "polling":
+            await application.updater.start_polling(allowed_updates=bot.ALLOWED_UPDATES)
+
+            async def send(update):
+                completions.offer(update)
+                api.push(update)
+        else:
+            await application.updater.start_webhook(
+                listen="127.0.0.1", port=args.port, url_path=config.WEBHOOK_PATH,
+                secret_token=config.WEBHOOK_SECRET_TOKEN, allowed_updates=bot.ALLOWED_UPDATES,
+            )
+            url = f"http://127.0.0.1:{args.port}/{config.WEBHOOK_PATH}"
+            headers = {'Content-Type': 'application/json'}
+            if config.WEBHOOK_SECRET_TOKEN:
+                headers['X-Telegram-Bot-Api-Secret-Token'] = config.WEBHOOK_SECRET_TOKEN
+            client = httpx.AsyncClient(limits=httpx.Limits(max_connections=args.concurrency), timeout=30)
+            connections = asyncio.Semaphore(args.concurrency)
+
+            async def send(update):
+                async with connections:
+                    completions.offer(update)
+                    with metrics.timer("loadtest.webhook.accept_ms"):
+                        try:
+                            response = await client.post(url, content=json.dumps(update).encode(), headers=headers)
+                            status = response.status_code
+                        except httpx.HTTPError as e:
+                            status = type(e).__name__
+                    statuses[status] = statuses.get(status, 0) + 1
+                    if status != 200:
+                        # Never reaches a handler
+                        completions.offered.pop(update['update_id'], None)
+                        completions.expected -= 1
+
+        started = time.perf_counter()
+        await offer_all(updates, args.rate, send)
+        if completions.completed < completions.expected:
+            try:
+                await asyncio.wait_for(completions.all_done.wait(), args.drain_timeout)
+            except asyncio.TimeoutError:
+                pass
+        elapsed = time.perf_counter() - started
+    finally:
+        if client is not None:
+            await client.aclose()
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        await database.close_db()
+    return completions, elapsed, statuses
+
+def _format(stats):
+    return f"p50 {stats['p50']:.1f}, p90 {stats['p90']:.1f}, p99 {stats['p99']:.1f}, max {stats['max']:.1f}"
+
+def report(transport, completions, elapsed, statuses):
+    stats = metrics.summary(f"loadtest.{transport}.e2e_ms")
+    print(f"{transport}: {completions.completed} of {completions.expected} updates "
+          f"handled in {elapsed:.2f}s ({completions.completed / elapsed:.0f} updates/s), "
+          f"{completions.errors} handler errors")
+    if stats['count']:
+        print(f"  Offered → handler done ms: {_format(stats)}")
+    if transport == "webhook":
+        print(f"  Webhook response ms: {_format(metrics.summary('loadtest.webhook.accept_ms'))}")
+        print(f"  Responses: {statuses}")
+
+async def run(updates, args):
+    transports = ["polling", "webhook"] if args.transport == "both" else [args.transport]
+    for transport in transports:
+        report(transport, *await replay(transport, updates, args))
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay updates through the bot's handlers, by webhook and polling")
+    parser.add_argument("file", nargs="?", help="JSON lines file of recorded updates")
+    parser.add_argument("--synthetic", type=int, metavar="N", help="send N generated button presses instead")
+    parser.add_argument("--users", type=int, default=100, help="distinct users for --synthetic")
+    parser.add_argument("--limit", type=int, help="send at most this many updates")
+    parser.add_argument("--transport", choices=["both", "webhook", "polling"], default="both")
+    parser.add_argument("--rate", type=float, default=200, help="updates offered per second, 0 for all at once")
+    parser.add_argument("--concurrency", type=int, default=20, help="webhook connections, like WEBHOOK_MAX_CONNECTIONS")
+    parser.add_argument("--api-latency-ms", type=float, default=50, help="simulated Bot API round trip")
+    parser.add_argument("--port", type=int, default=config.WEBHOOK_PORT)
+    parser.add_argument("--drain-timeout", type=float, default=60, help="seconds to wait for handlers at the end")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        updates = synthetic_updates(args.synthetic, args.users)
+    elif args.file:
+        updates = recorded_updates(args.file)
+    else:
+        parser.error("give a file of recorded updates or --synthetic N")
+    if args.limit:
+        updates = itertools.islice(updates, args.limit)
+    updates = list(updates)
+    if not updates:
+        print("No updates to send")
+        return
+
+    # The handlers log every action at INFO
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(run(updates, args))
+
+if __name__ == '__main__':
+    main()